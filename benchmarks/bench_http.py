@@ -0,0 +1,337 @@
+"""
+HTTP load test of the customer endpoints
+
+Starts the service, seeds it with customers through POST /customers/bulk,
+then sends each scenario a fixed number of requests from concurrent clients
+and reports the requests per second and the p50, p95 and p99 latency of each
+one. The scenarios cover every route of CustomerResource, CustomerCollection
+and SuspendResource.
+
+Run it with:
+    python -m benchmarks.bench_http --rows 100000 --concurrency 16
+
+By default the service runs in this process on a threaded development server,
+which shares the interpreter with the clients. Use --server gunicorn to start
+gunicorn workers instead, or --url to test a service that is already running
+(against an empty database, since the seeded customers are added to it). It
+uses a throw-away SQLite database unless DATABASE_URI is set.
+
+The results are saved as JSON (--output). Pass a saved file as --baseline to
+compare with it; the exit status is 1 if any scenario got slower than
+--tolerance allows. It is also 1 if any request of a scenario got another
+status than expected, since the timings of failed requests say nothing about
+the service, and then the errors are compared with the baseline too.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import socket
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import namedtuple
+
+os.environ.setdefault(
+    "DATABASE_URI", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+)
+
+import requests  # noqa: E402
+from benchmarks import report  # noqa: E402
+from tests.customer_generator import LAST_NAMES, CustomerGenerator  # noqa: E402
+
+# The repository, where gunicorn finds the app and gunicorn.conf.py
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Rows per POST /customers/bulk while seeding
+SEED_CHUNK = 10000
+
+# Customers that creates and updates pick their bodies from
+BODIES = 1000
+
+# What a scenario sends: build(context, rng) returns the path and JSON body of
+# one request, and a response with any other status than expected is an error
+Scenario = namedtuple("Scenario", ["name", "method", "expected", "build"])
+
+# Compared with the baseline: True if a higher value is better
+METRICS = {"rps": True, "p50_ms": False, "p95_ms": False, "p99_ms": False}
+
+
+class Context:
+    """ What the scenarios know about the service under test """
+
+    def __init__(self, base_url, ids, bodies):
+        self.base_url = base_url
+        self.ids = ids
+        self.bodies = bodies
+        self.doomed = []
+        self.next_doomed = 0
+        self._lock = threading.Lock()
+
+    def any_id(self, rng):
+        """ Returns the id of a seeded customer """
+        return rng.choice(self.ids)
+
+    def any_body(self, rng):
+        """ Returns the JSON of a customer to create or update """
+        return rng.choice(self.bodies)
+
+    def doomed_id(self):
+        """ Returns the id of a customer that was created to be deleted """
+        with self._lock:
+            self.next_doomed += 1
+            return self.doomed[self.next_doomed - 1]
+
+
+SCENARIOS = [
+    Scenario("list", "GET", 200, lambda ctx, rng: ("/customers?limit=100", None)),
+    Scenario("list_filtered", "GET", 200, lambda ctx, rng: (
+        "/customers?limit=100&last_name={}".format(rng.choice(LAST_NAMES[:10])), None)),
+    Scenario("get", "GET", 200, lambda ctx, rng: (
+        "/customers/{}".format(ctx.any_id(rng)), None)),
+    Scenario("create", "POST", 201, lambda ctx, rng: (
+        "/customers", ctx.any_body(rng))),
+    Scenario("update", "PUT", 200, lambda ctx, rng: (
+        "/customers/{}".format(ctx.any_id(rng)), ctx.any_body(rng))),
+    Scenario("suspend", "PUT", 200, lambda ctx, rng: (
+        "/customers/{}/suspend".format(ctx.any_id(rng)), None)),
+    Scenario("delete", "DELETE", 204, lambda ctx, rng: (
+        "/customers/{}".format(ctx.doomed_id()), None)),
+]
+
+
+######################################################################
+#  S E R V E R
+######################################################################
+def free_port():
+    """ Returns a TCP port that nothing listens on """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_thread_server():
+    """ Serves the app from this process on a threaded server """
+    from werkzeug.serving import make_server  # pylint: disable=import-outside-toplevel
+    from service import app  # pylint: disable=import-outside-toplevel
+
+    # keep the log, slow statements included, out of the report
+    for name in (app.logger.name, "flask.app", "werkzeug"):
+        logging.getLogger(name).setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "http://127.0.0.1:{}".format(server.server_port), server.shutdown
+
+
+def start_gunicorn(workers):
+    """ Starts gunicorn workers in a subprocess """
+    port = free_port()
+    process = subprocess.Popen([
+        sys.executable, "-m", "gunicorn", "--workers", str(workers), "--threads", "4",
+        "--bind", "127.0.0.1:{}".format(port), "--log-level", "warning", "service:app",
+    ], cwd=ROOT)
+    return "http://127.0.0.1:{}".format(port), process
+
+
+def wait_until_up(base_url, process=None, timeout=60.0):
+    """ Waits for the service to answer, or for its process to exit """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            requests.get(base_url + "/", timeout=1)
+            return
+        except requests.ConnectionError:
+            if process is not None and process.poll() is not None:
+                raise RuntimeError("The service exited with status {}".format(process.returncode))
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+
+
+######################################################################
+#  S E E D I N G
+######################################################################
+def seed(session, base_url, generator, count, start=0):
+    """Creates count customers through POST /customers/bulk
+
+    :return: the ids of the new customers
+    :rtype: list
+    """
+    ids = []
+    for offset in range(start, start + count, SEED_CHUNK):
+        size = min(SEED_CHUNK, start + count - offset)
+        lines = [json.dumps(customer) for customer in generator.customers(size, offset)]
+        response = session.post(
+            base_url + "/customers/bulk",
+            data="\n".join(lines).encode("utf-8"),
+            headers={"Content-Type": "application/x-ndjson"},
+        )
+        response.raise_for_status()
+        ids.extend(result["id"] for result in response.json()["results"] if "id" in result)
+    return ids
+
+
+######################################################################
+#  L O A D
+######################################################################
+def percentile(ordered, fraction):
+    """ Returns the nearest rank percentile of sorted values """
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(math.ceil(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+def run_scenario(scenario, context, total, concurrency, seed_value):
+    """Sends total requests of a scenario from concurrency clients
+
+    :return: the throughput and latency of the scenario
+    :rtype: dict
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    remaining = [total]
+
+    def client(number):
+        rng = random.Random("{}-{}-{}".format(seed_value, scenario.name, number))
+        session = requests.Session()
+        mine = []
+        failed = 0
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+            path, body = scenario.build(context, rng)
+            started = time.perf_counter()
+            response = session.request(scenario.method, context.base_url + path, json=body)
+            mine.append(time.perf_counter() - started)
+            if response.status_code != scenario.expected:
+                failed += 1
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "seconds": round(elapsed, 3),
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(1000 * percentile(latencies, 0.50), 3),
+        "p95_ms": round(1000 * percentile(latencies, 0.95), 3),
+        "p99_ms": round(1000 * percentile(latencies, 0.99), 3),
+        "max_ms": round(1000 * latencies[-1], 3) if latencies else 0.0,
+    }
+
+
+def check_errors(results, baseline=None):
+    """Reports the scenarios with failed requests
+
+    :param results: maps the scenarios to their results
+    :param baseline: the results of an earlier run, if any
+    :return: True if any scenario had errors
+    :rtype: bool
+    """
+    failed = False
+    for name in sorted(results):
+        errors = results[name]["errors"]
+        if not errors:
+            continue
+        failed = True
+        message = "{}: {:,} of {:,} requests failed".format(name, errors, results[name]["requests"])
+        if baseline and name in baseline:
+            before = baseline[name].get("errors", 0)
+            message += ", {:,} in the baseline{}".format(before, "  GREW" if errors > before else "")
+        print(message)
+    return failed
+
+
+def main(argv=None):
+    """ Seeds the service, runs the scenarios and reports the results """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=1000, help="customers to seed, e.g. 1000, 100000 or 1000000")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per scenario")
+    parser.add_argument("--warmup", type=int, default=100, help="requests per scenario before measuring")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--scenarios", default=",".join(s.name for s in SCENARIOS),
+                        help="comma separated scenarios to run")
+    parser.add_argument("--server", choices=["thread", "gunicorn"], default="thread",
+                        help="how to start the service")
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn workers")
+    parser.add_argument("--url", help="test a service that is already running at this URL")
+    parser.add_argument("--seed", type=int, default=42, help="seed of the random data")
+    parser.add_argument("--output", default="bench_http.json", help="where to save the results")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="how much worse a metric may get, e.g. 0.1 for 10%%")
+    args = parser.parse_args(argv)
+
+    names = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    scenarios = [scenario for scenario in SCENARIOS if scenario.name in names]
+    stop = process = None
+    if args.url:
+        base_url = args.url.rstrip("/")
+    elif args.server == "gunicorn":
+        base_url, process = start_gunicorn(args.workers)
+
+        def stop():
+            process.terminate()
+            process.wait()
+    else:
+        base_url, stop = start_thread_server()
+    try:
+        wait_until_up(base_url, process)
+        generator = CustomerGenerator(args.seed)
+        session = requests.Session()
+        print("Seeding {:,} customers into {}".format(args.rows, os.environ["DATABASE_URI"]))
+        ids = seed(session, base_url, generator, args.rows)
+        if not ids:
+            parser.error("there are no customers to read, seed at least one")
+        doomed = args.requests + args.warmup
+        context = Context(base_url, ids, list(generator.customers(BODIES, args.rows + doomed)))
+        if any(scenario.name == "delete" for scenario in scenarios):
+            context.doomed = seed(session, base_url, generator, doomed, start=args.rows)
+
+        results = {}
+        print("{:<14} {:>9} {:>7} {:>10} {:>9} {:>9} {:>9}".format(
+            "scenario", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms"))
+        for scenario in scenarios:
+            if args.warmup:
+                run_scenario(scenario, context, args.warmup, args.concurrency, args.seed)
+            result = run_scenario(scenario, context, args.requests, args.concurrency, args.seed)
+            results[scenario.name] = result
+            print("{:<14} {:>9,} {:>7,} {:>10,.1f} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+                scenario.name, result["requests"], result["errors"], result["rps"],
+                result["p50_ms"], result["p95_ms"], result["p99_ms"]))
+    finally:
+        if stop is not None:
+            stop()
+
+    meta = report.environment(os.environ["DATABASE_URI"])
+    meta.update(rows=args.rows, requests=args.requests, concurrency=args.concurrency,
+                server="url" if args.url else args.server)
+    report.save(args.output, meta, results)
+    print("Saved the results to {}".format(args.output))
+    baseline = report.load(args.baseline) if args.baseline else None
+    failed = check_errors(results, baseline)
+    if baseline:
+        rows = report.compare(results, baseline, METRICS, args.tolerance)
+        failed = report.print_comparison(rows, args.tolerance) or failed
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""
+Benchmark of the collection read paths
+
+Reads the whole customer table a page at a time and encodes every page to
+JSON, once through the ORM path (Customer instances, serialize(), Flask-RESTX
+marshalling and json.dumps) and once through the fast path that GET /customers
+uses (SQLAlchemy Core rows, row_formatter() and dumps()), then prints the rows
+per second of each.
+
+Run it with:
+    python -m benchmarks.bench_list --rows 100000
+
+It uses a throw-away SQLite database unless DATABASE_URI is set.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+os.environ.setdefault(
+    "DATABASE_URI", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+)
+
+from flask_restx import marshal  # noqa: E402
+from service.models import Customer, db  # noqa: E402
+from service.service import (  # noqa: E402
+    CUSTOMER_FIELDS, customer_model, dumps, row_formatter
+)
+from tests.customer_generator import CustomerGenerator, insert_customers  # noqa: E402
+
+
+def seed(count):
+    """ Fills the customer table with count customers """
+    db.session.query(Customer).delete()
+    db.session.commit()
+    insert_customers(db.engine, CustomerGenerator().customers(count), batch_size=5000)
+
+
+def orm_path(page_size):
+    """ Pages through the table with ORM instances and marshalling """
+    after = None
+    rows = 0
+    while True:
+        customers, after = Customer.paginate(Customer.query, page_size, after)
+        body = json.dumps(marshal([c.serialize() for c in customers], customer_model))
+        rows += len(customers)
+        db.session.remove()
+        if after is None:
+            return rows, body
+
+
+def fast_path(page_size):
+    """ Pages through the table with Core rows and the fast encoder """
+    format_row = row_formatter(CUSTOMER_FIELDS)
+    after = None
+    rows = 0
+    while True:
+        customers, after = Customer.paginate(
+            Customer.query, page_size, after, CUSTOMER_FIELDS
+        )
+        body = dumps([format_row(row) for row in customers])
+        rows += len(customers)
+        db.session.remove()
+        if after is None:
+            return rows, body
+
+
+def measure(name, path, page_size, repeat):
+    """ Runs a path repeat times and prints its best rows per second """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows, _ = path(page_size)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("{:<6} {:>9,} rows in {:7.3f}s  {:>12,.0f} rows/sec".format(
+        name, rows, best, rows / best))
+    return rows / best
+
+
+def main(argv=None):
+    """ Seeds the database and compares the two paths """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=100000, help="customers to seed")
+    parser.add_argument("--page-size", type=int, default=1000, help="customers per page")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each path")
+    args = parser.parse_args(argv)
+
+    Customer.app.config["PAGE_SIZE_MAX"] = max(args.page_size, 1)
+    print("Seeding {:,} customers into {}".format(args.rows, os.environ["DATABASE_URI"]))
+    seed(args.rows)
+    orm = measure("orm", orm_path, args.page_size, args.repeat)
+    fast = measure("fast", fast_path, args.page_size, args.repeat)
+    print("speedup {:.1f}x".format(fast / orm))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
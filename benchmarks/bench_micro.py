@@ -0,0 +1,142 @@
+"""
+Microbenchmarks of the per row model code
+
+Times the code that runs for every customer of every response, i.e.
+Customer.serialize(), Customer.deserialize() and marshalling with the
+Flask-RESTX customer_model, and the building of the queries of find() and
+the find_by_* lookups (without running them). For each operation it reports
+the nanoseconds per call, the best of several runs, and the bytes that one
+call allocates, as traced by tracemalloc.
+
+Run it with:
+    python -m benchmarks.bench_micro --output baseline.json
+    python -m benchmarks.bench_micro --baseline baseline.json --tolerance 0.15
+
+With --baseline the exit status is 1 if any operation got slower, or
+allocates more, than the tolerance allows. Timings are only comparable on the
+same machine and Python version. It uses a throw-away SQLite database unless
+DATABASE_URI is set.
+"""
+import os
+import sys
+import timeit
+import argparse
+import statistics
+import tempfile
+import tracemalloc
+
+os.environ.setdefault(
+    "DATABASE_URI", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+)
+
+from flask_restx import marshal  # noqa: E402
+from benchmarks import report  # noqa: E402
+from service.models import Customer, db  # noqa: E402
+from service.service import customer_model  # noqa: E402
+
+# Compared with the baseline: True if a higher value is better
+METRICS = {"ns_per_op": False, "alloc_bytes": False}
+
+DATA = {
+    "first_name": "Jennifer",
+    "last_name": "Williams",
+    "email": "jennifer.williams@example.com",
+    "address": "1600 Amphitheatre Parkway, Mountain View, CA 94043",
+    "active": True,
+}
+
+
+def operations():
+    """Returns the operations to measure, by name
+
+    Every operation is a function without arguments. The customer that
+    find() looks up is created first and kept in the cache, so that only the
+    lookup itself is measured.
+    """
+    customer = Customer(**DATA)
+    customer.create()
+    Customer.cache.set(customer.id, customer.cache_entry())
+    serialized = customer.serialize()
+    page = [dict(serialized, id=number) for number in range(100)]
+    filters = {"last_name": ["Williams", "Smith"], "first_name": "Jen*", "active": True}
+    dialect = db.engine.dialect
+    return {
+        "serialize": customer.serialize,
+        "deserialize": lambda: Customer().deserialize(DATA),
+        "marshal": lambda: marshal(serialized, customer_model),
+        "marshal_page_100": lambda: marshal(page, customer_model),
+        "find_cached": lambda: Customer.find(customer.id),
+        "find_by_first_name": lambda: Customer.find_by_first_name("Jennifer"),
+        "find_by_last_name": lambda: Customer.find_by_last_name("Williams"),
+        "find_by_email": lambda: Customer.find_by_email("jennifer.williams@example.com"),
+        "find_by_address": lambda: Customer.find_by_address("1600 Amphitheatre Parkway"),
+        "find_by_active": lambda: Customer.find_by_active(True),
+        "find_by_filters": lambda: Customer.find_by_filters(filters),
+        "compile_find_by_filters": lambda: str(
+            Customer.find_by_filters(filters).statement.compile(dialect=dialect)
+        ),
+    }
+
+
+def time_per_op(function, repeat, min_time):
+    """ Returns the nanoseconds per call of the fastest of repeat runs """
+    timer = timeit.Timer(function)
+    number, elapsed = timer.autorange()
+    # autorange stops at 0.2 seconds, scale up to min_time
+    number = max(number, int(number * min_time / max(elapsed, 1e-9)))
+    return 1e9 * min(timer.repeat(repeat, number)) / number
+
+
+def alloc_per_op(function, calls=50):
+    """ Returns the median of the bytes that one call had allocated at its peak """
+    function()  # fill any caches first
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(calls):
+            tracemalloc.clear_traces()
+            function()
+            peaks.append(tracemalloc.get_traced_memory()[1])
+    finally:
+        tracemalloc.stop()
+    return int(statistics.median(peaks))
+
+
+def main(argv=None):
+    """ Measures every operation and reports the results """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--filter", default="", help="only measure operations whose name contains this")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs of each operation")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per timed run")
+    parser.add_argument("--output", default="bench_micro.json", help="where to save the results")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="how much worse a metric may get, e.g. 0.15 for 15%%")
+    args = parser.parse_args(argv)
+
+    db.drop_all()
+    db.create_all()
+    results = {}
+    print("{:<26} {:>12} {:>12}".format("operation", "ns/op", "bytes/op"))
+    for name, function in operations().items():
+        if args.filter not in name:
+            continue
+        ns_per_op = time_per_op(function, args.repeat, args.min_time)
+        alloc_bytes = alloc_per_op(function)
+        results[name] = {"ns_per_op": round(ns_per_op, 1), "alloc_bytes": alloc_bytes}
+        print("{:<26} {:>12,.1f} {:>12,}".format(name, ns_per_op, alloc_bytes))
+        db.session.remove()
+
+    meta = report.environment(os.environ["DATABASE_URI"])
+    meta.update(repeat=args.repeat, min_time=args.min_time)
+    report.save(args.output, meta, results)
+    print("Saved the results to {}".format(args.output))
+    if args.baseline:
+        rows = report.compare(results, report.load(args.baseline), METRICS, args.tolerance)
+        if report.print_comparison(rows, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
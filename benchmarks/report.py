@@ -0,0 +1,88 @@
+"""
+Machine readable benchmark results
+
+A benchmark saves its results as JSON:
+
+    {"meta": {"python": "3.8.6", ...},
+     "results": {"get_customer": {"rps": 812.4, "p99_ms": 21.7, ...}, ...}}
+
+and compare() checks the results of a run against a baseline saved by an
+earlier run, metric by metric, so that a change that makes any of them worse
+than the tolerance allows can fail a build.
+"""
+import json
+import platform
+from datetime import datetime, timezone
+from sqlalchemy.engine.url import make_url
+
+
+def environment(database_uri=None):
+    """ Returns what a result depends on besides the code, to save with it """
+    meta = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+    }
+    if database_uri:
+        meta["database"] = repr(make_url(database_uri))  # without the password
+    return meta
+
+
+def save(path, meta, results):
+    """ Writes results and their meta data to a JSON file """
+    with open(path, "w") as output:
+        json.dump({"meta": meta, "results": results}, output, indent=2, sort_keys=True)
+        output.write("\n")
+
+
+def load(path):
+    """ Returns the results saved in a JSON file """
+    with open(path) as source:
+        return json.load(source)["results"]
+
+
+def compare(results, baseline, metrics, tolerance=0.1):
+    """Compares results with a baseline
+
+    :param results: maps benchmark names to their metrics
+    :param baseline: the same for the baseline, benchmarks that are not in
+        it are not compared
+    :param metrics: maps the names of the metrics to compare to True if a
+        higher value is better, e.g. {"rps": True, "p99_ms": False}
+    :param tolerance: how much worse a metric may get, e.g. 0.1 for 10%
+    :return: a (benchmark, metric, baseline, current, change, regressed)
+        tuple for every metric compared, where change is the relative change
+    :rtype: list
+    """
+    rows = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        for metric, higher_is_better in metrics.items():
+            current = results[name].get(metric)
+            base = baseline[name].get(metric)
+            if current is None or not base:
+                continue
+            change = (current - base) / base
+            worse = -change if higher_is_better else change
+            rows.append((name, metric, base, current, change, worse > tolerance))
+    return rows
+
+
+def print_comparison(rows, tolerance):
+    """Prints the rows of compare() as a table
+
+    :return: True if any metric regressed
+    :rtype: bool
+    """
+    print("\n{:<24} {:<10} {:>12} {:>12} {:>8}".format(
+        "benchmark", "metric", "baseline", "current", "change"))
+    for name, metric, base, current, change, regressed in rows:
+        print("{:<24} {:<10} {:>12.3f} {:>12.3f} {:>+7.1%}{}".format(
+            name, metric, base, current, change, "  REGRESSED" if regressed else ""))
+    regressions = sum(1 for row in rows if row[-1])
+    if regressions:
+        print("\n{} metric(s) regressed by more than {:.0%}".format(regressions, tolerance))
+    else:
+        print("\nNo regressions beyond {:.0%}".format(tolerance))
+    return bool(regressions)
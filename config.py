@@ -23,7 +23,100 @@ if 'VCAP_SERVICES' in os.environ:
         if item['name'] == "ElephantSQL-Prod":
         	DATABASE_URI = item['credentials']['url']
 
+# Optional read replicas for GET traffic, separated by commas
+DATABASE_READ_URI = [uri.strip() for uri in os.getenv("DATABASE_READ_URI", "").split(",") if uri.strip()]
+# Seconds that a failing replica is left out before it is tried again
+DATABASE_REPLICA_EJECT_SECONDS = float(os.getenv("DATABASE_REPLICA_EJECT_SECONDS", "30"))
+
 # Configure SQLAlchemy
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Database connection pool, set per process (the pool settings do not apply
+# to SQLite, which does not pool connections to a file)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("true", "yes", "1")
+# Milliseconds before PostgreSQL cancels a statement (0 means no limit)
+DB_STATEMENT_TIMEOUT = int(os.getenv("DB_STATEMENT_TIMEOUT", "0"))
+
+# Statements slower than this many milliseconds go to the slow query log (0
+# turns it off), and whether responses get a Server-Timing header of their SQL
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+SERVER_TIMING = os.getenv("SERVER_TIMING", "true").lower() in ("true", "yes", "1")
+
+# Logging: "json" or "text" lines, the most records that may wait for the
+# writer thread before new ones are dropped, and the fraction of the records
+# of a level to keep, e.g. "INFO=0.1,DEBUG=0.01" (all of them by default)
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+
+# Keyset pagination for the list endpoints
+PAGE_SIZE_DEFAULT = int(os.getenv("PAGE_SIZE_DEFAULT", "100"))
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "1000"))
+
+# Bulk creates: rows per INSERT statement and Customers per request
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "1000"))
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", "100000"))
+
+# Read-through cache of single Customer lookups (0 disables it)
+CACHE_SIZE = int(os.getenv("CACHE_SIZE", "10000"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "30"))
+
+# Changes younger than this are held back from the change feed, so that a
+# transaction that commits late cannot slip in behind a consumer's cursor
+# (not used on PostgreSQL, where the feed stops at the oldest open transaction)
+CHANGES_SETTLE_SECONDS = float(os.getenv("CHANGES_SETTLE_SECONDS", "1"))
+
+# Events of GET /customers/stream: how many may wait for each client, how
+# often an idle stream is kept alive, and "postgres" to share them between
+# workers with LISTEN/NOTIFY instead of keeping them in each process
+EVENTS_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", "1000"))
+EVENTS_HEARTBEAT_SECONDS = float(os.getenv("EVENTS_HEARTBEAT_SECONDS", "15"))
+EVENTS_TRANSPORT = os.getenv("EVENTS_TRANSPORT", "memory")
+# Threads of each gunicorn worker, the Procfile passes it to --threads
+WEB_THREADS = int(os.getenv("WEB_THREADS", "8"))
+# Every open stream holds a worker thread, so keep this below WEB_THREADS or
+# streams leave none for the other requests
+EVENTS_MAX_STREAMS = int(os.getenv("EVENTS_MAX_STREAMS", "4"))
+
+# Group commit: coalesce the creates and updates of concurrent requests that
+# arrive within GROUP_COMMIT_WINDOW_MS into one transaction (off by default)
+GROUP_COMMIT = os.getenv("GROUP_COMMIT", "false").lower() in ("true", "yes", "1")
+GROUP_COMMIT_WINDOW_MS = float(os.getenv("GROUP_COMMIT_WINDOW_MS", "2"))
+GROUP_COMMIT_MAX_BATCH = int(os.getenv("GROUP_COMMIT_MAX_BATCH", "100"))
+
+# Idempotency-Key for POST /customers: "memory" keeps the keys in each worker,
+# "database" shares them between workers, "off" ignores the header
+IDEMPOTENCY_STORE = os.getenv("IDEMPOTENCY_STORE", "memory")
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("IDEMPOTENCY_MAX_KEYS", "100000"))
+# Seconds a key is held for a request that has not answered yet, after which a
+# retry takes it over (keep it above the slowest create, below the client retry)
+IDEMPOTENCY_LEASE = float(os.getenv("IDEMPOTENCY_LEASE", "60"))
+
+# Token bucket rate limits per API key and route: requests per second (0 turns
+# them off), burst size, and overrides like "POST /customers/bulk=0.5:2;..."
+RATE_LIMIT_PER_SECOND = float(os.getenv("RATE_LIMIT_PER_SECOND", "0"))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "20"))
+RATE_LIMIT_ROUTES = os.getenv("RATE_LIMIT_ROUTES", "")
+
+# Load shedding: refuse requests with 503 while this many are in flight in a
+# worker, or while database checkouts wait longer than this on average (0 = off).
+# Requests are counted once they have a thread, and open streams hold threads
+# without being counted, so the default leaves room for EVENTS_MAX_STREAMS and
+# for the thread that answers with 503; anything above that never triggers
+SHED_MAX_IN_FLIGHT = int(
+    os.getenv("SHED_MAX_IN_FLIGHT", str(max(1, WEB_THREADS - EVENTS_MAX_STREAMS - 1)))
+)
+SHED_MAX_POOL_WAIT_MS = float(os.getenv("SHED_MAX_POOL_WAIT_MS", "500"))
+
+# Most ids that one batch get may ask for
+BATCH_GET_MAX_IDS = int(os.getenv("BATCH_GET_MAX_IDS", "1000"))
+
+# Rows fetched per round trip when streaming the whole collection
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+
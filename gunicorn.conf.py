@@ -0,0 +1,26 @@
+"""
+Gunicorn settings for the Customers service
+
+gunicorn reads this file from the working directory. It gives the workers a
+directory to share their Prometheus samples in, so that /metrics adds up the
+counters of every worker rather than those of whichever one answers.
+"""
+import os
+import glob
+import tempfile
+
+# Must be set before prometheus_client is imported by the app
+os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "customers-metrics")
+)
+metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+os.makedirs(metrics_dir, exist_ok=True)
+# samples left by a previous run would be added to this one
+for path in glob.glob(os.path.join(metrics_dir, "*.db")):
+    os.remove(path)
+
+
+def child_exit(server, worker):
+    """ Drops the in flight gauges of a worker that exited """
+    from prometheus_client import multiprocess  # pylint: disable=import-outside-toplevel
+    multiprocess.mark_process_dead(worker.pid)
@@ -18,20 +18,15 @@ app.config['LOGGING_LEVEL'] = logging.INFO
 app.config['API_KEY'] = os.getenv('API_KEY')
 
 # Import the rutes After the Flask app is created
-from service import service, models
+from service import service, models, log
 
 # Set up logging for production
 if __name__ != "__main__":
     gunicorn_logger = logging.getLogger("gunicorn.error")
-    app.logger.handlers = gunicorn_logger.handlers
     app.logger.setLevel(gunicorn_logger.level)
-    app.logger.propagate = False
-    # Make all log formats consistent
-    formatter = logging.Formatter(
-        "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z"
-    )
-    for handler in app.logger.handlers:  # pragma: no cover
-        handler.setFormatter(formatter)
+    # Write through gunicorn's handlers from a background thread, in the same
+    # format as gunicorn's own lines
+    log.init_app(app, gunicorn_logger.handlers)
     app.logger.info("Logging handler established")
 
 app.logger.info(70 * "*")
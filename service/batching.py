@@ -0,0 +1,189 @@
+"""
+Group commit for the Customers service
+
+Every create and update normally commits its own transaction, and each
+commit waits for the database to flush its log to disk. GroupCommitter lets
+the writes of concurrent requests share that wait: a request hands its write
+to a writer thread and blocks, while the writer collects every write that
+arrives within a short window (or until it has max_batch of them) and applies
+them with one transaction for the creates and one for the updates. Each
+request then gets back its own result, or its own exception.
+
+If a batch fails as a whole, its writes are retried one at a time so that a
+single bad write only fails its own request.
+
+The statistics (batch sizes and how long writes waited for their batch) are
+served at /group-commit/stats.
+"""
+import os
+import queue
+import logging
+import threading
+import time
+
+logger = logging.getLogger("flask.app")
+
+# Upper bounds of the batch size histogram
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class PendingWrite:
+    """ A write that is waiting for its batch to be committed """
+
+    def __init__(self, kind, args, enqueued):
+        self.kind = kind
+        self.args = args
+        self.enqueued = enqueued
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommitter:
+    """ Commits the creates and updates of concurrent requests together """
+
+    def __init__(self, app, create_many, update_many, window=0.002, max_batch=100,
+                 clock=time.monotonic):
+        """
+        :param app: the Flask app, whose context the writer thread runs in
+        :param create_many: inserts a list of Customers in one transaction
+        :param update_many: applies a list of updates in one transaction and
+            returns a result for each one
+        :param window: seconds to wait for more writes after the first one
+        :param max_batch: the most writes to commit together
+        """
+        self.app = app
+        self.create_many = create_many
+        self.update_many = update_many
+        self.window = window
+        self.max_batch = max_batch
+        self.clock = clock
+        self.batches = 0
+        self.writes = 0
+        self.retried = 0
+        self.max_size = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.sizes = {bucket: 0 for bucket in SIZE_BUCKETS}
+        self._queue = queue.Queue()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def create(self, customer):
+        """ Creates a Customer in the next batch and sets its id """
+        self.submit("create", customer)
+
+    def update(self, customer_id, values, version=None, op="update"):
+        """Updates a Customer in the next batch, like Customer.update_by_id()
+
+        :return: the updated Customer, or None if not found
+        :raises VersionConflictError: if the Customer is at another version
+        """
+        return self.submit("update", (customer_id, values, version, op))
+
+    def submit(self, kind, args):
+        """ Queues a write and waits for the commit of its batch """
+        self.start()
+        pending = PendingWrite(kind, args, self.clock())
+        self._queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def start(self):
+        """ Starts the writer thread, once per process """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        thread = threading.Thread(target=self.run, name="group-commit", daemon=True)
+        thread.start()
+
+    def run(self):
+        """ Writes batches for ever """
+        while True:
+            self.write(self.collect())
+
+    def collect(self):
+        """ Waits for a write, then takes whatever else arrives within the window """
+        batch = [self._queue.get()]
+        deadline = self.clock() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - self.clock()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def write(self, batch):
+        """ Commits a batch and hands every write its result """
+        started = self.clock()
+        try:
+            for kind in ("create", "update"):
+                writes = [pending for pending in batch if pending.kind == kind]
+                if not writes:
+                    continue
+                try:
+                    self.apply(kind, writes)
+                except Exception as error:  # pylint: disable=broad-except
+                    logger.warning("Group commit of %s writes failed, retrying one at a time: %s",
+                                   len(writes), error)
+                    self.retried += 1
+                    for pending in writes:
+                        try:
+                            self.apply(kind, [pending])
+                        except Exception as error:  # pylint: disable=broad-except
+                            pending.error = error
+        finally:
+            self.record(batch, started)
+            for pending in batch:
+                pending.done.set()
+
+    def apply(self, kind, writes):
+        """ Applies writes of one kind in a single transaction """
+        # leaving the app context removes the session, rolling back on errors
+        with self.app.app_context():
+            if kind == "create":
+                self.create_many([pending.args for pending in writes], len(writes))
+                return
+            results = self.update_many([pending.args for pending in writes])
+            for pending, result in zip(writes, results):
+                if isinstance(result, Exception):
+                    pending.error = result
+                else:
+                    pending.result = result
+
+    def record(self, batch, started):
+        """ Adds a committed batch to the statistics """
+        size = len(batch)
+        wait = max(started - pending.enqueued for pending in batch)
+        with self._lock:
+            self.batches += 1
+            self.writes += size
+            self.max_size = max(self.max_size, size)
+            self.total_wait += sum(started - pending.enqueued for pending in batch)
+            self.max_wait = max(self.max_wait, wait)
+            for bucket in SIZE_BUCKETS:
+                if size <= bucket:
+                    self.sizes[bucket] += 1
+                    break
+
+    def stats(self):
+        """ Returns the batch size and wait statistics as a dictionary """
+        with self._lock:
+            return {
+                "window_ms": self.window * 1000.0,
+                "max_batch": self.max_batch,
+                "batches": self.batches,
+                "writes": self.writes,
+                "retried_batches": self.retried,
+                "mean_batch_size": self.writes / self.batches if self.batches else 0.0,
+                "max_batch_size": self.max_size,
+                "batch_sizes": {"le_{}".format(bucket): count for bucket, count in self.sizes.items()},
+                "mean_wait_ms": 1000.0 * self.total_wait / self.writes if self.writes else 0.0,
+                "max_wait_ms": 1000.0 * self.max_wait,
+            }
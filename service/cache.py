@@ -0,0 +1,146 @@
+"""
+Read-through cache for the Customers service
+
+LRUCache keeps at most maxsize entries and forgets each one ttl seconds after
+it was stored, so a value that was changed by another worker process is never
+served for longer than ttl. Writes in this process invalidate their entries
+straight away.
+
+The cache holds plain dictionaries rather than ORM instances, so an entry can
+be shared between threads and database sessions.
+
+A reader that missed must not put back a value that a writer invalidated
+while it was being read. So it takes generation() before it reads, and
+passes it to set(), which drops the value if the key was invalidated since.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """ A thread safe least recently used cache whose entries expire """
+
+    def __init__(self, maxsize=1024, ttl=30.0, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        # called with "hit", "miss", "eviction" or "expiration", e.g. by metrics
+        self.observer = None
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # bumped by every invalidation, which is remembered per key for the
+        # last maxsize keys; anything older counts as invalidated everywhere
+        self._generation = 0
+        self._invalidated = OrderedDict()
+        self._forgotten = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def enabled(self):
+        """ True unless the cache was configured with no size or no ttl """
+        return self.maxsize > 0 and self.ttl > 0
+
+    def get(self, key):
+        """Returns the value stored for the key
+
+        :return: the value, or None if it is missing or has expired
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                self._observe("miss")
+                return None
+            value, expires = entry
+            if expires <= self.clock():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                self._observe("expiration")
+                self._observe("miss")
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            self._observe("hit")
+            return value
+
+    def generation(self):
+        """ Returns a token to take before reading a value that will be passed to set() """
+        with self._lock:
+            return self._generation
+
+    def remembered(self):
+        """Returns the oldest generation whose invalidations are still known
+
+        Passed to set() it stores a value only if its key has not been
+        invalidated for as long as the cache can tell, e.g. for a value read
+        from a replica that may not have the latest writes yet.
+        """
+        with self._lock:
+            return self._forgotten
+
+    def set(self, key, value, generation=None):
+        """Stores the value for the key, evicting the least recently used
+
+        :param generation: what generation() returned before the value was
+            read; if the key was invalidated since then, nothing is stored
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if generation is not None and (
+                    generation < self._forgotten
+                    or self._invalidated.get(key, -1) > generation):
+                return
+            self._data[key] = (value, self.clock() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+                self._observe("eviction")
+
+    def _observe(self, event):
+        """ Tells the observer about a cache event """
+        if self.observer is not None:
+            self.observer(event)
+
+    def invalidate(self, key):
+        """ Forgets the value stored for the key """
+        with self._lock:
+            self._data.pop(key, None)
+            self._generation += 1
+            self._invalidated[key] = self._generation
+            self._invalidated.move_to_end(key)
+            while len(self._invalidated) > max(self.maxsize, 1):
+                _, generation = self._invalidated.popitem(last=False)
+                self._forgotten = generation
+
+    def clear(self):
+        """ Forgets every value """
+        with self._lock:
+            self._data.clear()
+            self._generation += 1
+            self._invalidated.clear()
+            self._forgotten = self._generation
+
+    def stats(self):
+        """ Returns the counters of the cache as a dictionary """
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
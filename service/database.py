@@ -0,0 +1,191 @@
+"""
+Database engine setup for the Customers service
+
+engine_options() turns the DB_* settings of config.py into the arguments of
+create_engine(), so that the size of the pool, how long connections live and
+how long a statement may run can be tuned per deployment.
+
+install_fork_guard() makes the pool safe to share with forked processes. When
+gunicorn is started with --preload the app (and its engine) is created in the
+master process and then forked into the workers. A connection that was opened
+before the fork would be shared by every worker, so each connection remembers
+the process that opened it and is quietly dropped, without being closed, when
+another process tries to check it out. Customer.init_db() also disposes of the
+pool once the schema is ready, so normally there is nothing to inherit at all.
+
+TimedQueuePool measures how long each checkout waited for a free connection,
+so that the service can shed load once the pool is the bottleneck.
+
+ReplicaRouter holds the engines of the read replicas named by
+DATABASE_READ_URI and hands them out round robin, skipping any replica that
+recently failed.
+"""
+import os
+import time
+import logging
+import itertools
+import threading
+from sqlalchemy import event, exc
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import Pool, QueuePool
+
+logger = logging.getLogger("flask.app")
+
+
+def engine_options(config, uri=None):
+    """Returns the create_engine() arguments for the configured database
+
+    :param config: the Flask app configuration
+    :type config: dict
+    :param uri: the database to connect to, defaults to SQLALCHEMY_DATABASE_URI
+    :type uri: str
+    :return: the keyword arguments for create_engine()
+    :rtype: dict
+    """
+    uri = uri or config["SQLALCHEMY_DATABASE_URI"]
+    options = {"pool_pre_ping": config["DB_POOL_PRE_PING"]}
+    if uri.startswith("sqlite"):
+        return options
+    options.update(
+        poolclass=TimedQueuePool,
+        pool_size=config["DB_POOL_SIZE"],
+        max_overflow=config["DB_MAX_OVERFLOW"],
+        pool_timeout=config["DB_POOL_TIMEOUT"],
+        pool_recycle=config["DB_POOL_RECYCLE"],
+    )
+    if config["DB_STATEMENT_TIMEOUT"] and uri.startswith("postgres"):
+        options["connect_args"] = {
+            "options": "-c statement_timeout={}".format(config["DB_STATEMENT_TIMEOUT"])
+        }
+    return options
+
+
+class WaitTracker:
+    """ Keeps a moving average of recent waits that is forgotten once it is old """
+
+    def __init__(self, weight=0.2, max_age=5.0, clock=time.monotonic):
+        self.weight = weight
+        self.max_age = max_age
+        self.clock = clock
+        self.average = 0.0
+        self.updated = None
+        # also called with every wait, e.g. by metrics
+        self.listeners = []
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        """ Adds a wait to the average """
+        with self._lock:
+            if self.updated is None or self.clock() - self.updated > self.max_age:
+                self.average = seconds
+            else:
+                self.average += self.weight * (seconds - self.average)
+            self.updated = self.clock()
+        for listener in self.listeners:
+            listener(seconds)
+
+    def current(self):
+        """ Returns the average wait, or 0 if nothing waited lately """
+        with self._lock:
+            if self.updated is None or self.clock() - self.updated > self.max_age:
+                return 0.0
+            return self.average
+
+
+# Checkout waits of every TimedQueuePool in this process
+pool_wait = WaitTracker()
+
+
+class TimedQueuePool(QueuePool):
+    """ A QueuePool that records how long each checkout waited in pool_wait """
+
+    def _do_get(self):
+        started = time.monotonic()
+        try:
+            return super()._do_get()
+        finally:
+            pool_wait.observe(time.monotonic() - started)
+
+
+def remember_pid(dbapi_connection, connection_record):
+    """ Records which process opened a new connection """
+    connection_record.info["pid"] = os.getpid()
+
+
+def check_pid(dbapi_connection, connection_record, connection_proxy):
+    """ Refuses to check out a connection that another process opened """
+    pid = os.getpid()
+    if connection_record.info.get("pid", pid) != pid:
+        # forget the connection without closing it: it still belongs to
+        # the process that opened it
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            "Connection record belongs to pid {}, attempting to check out in pid {}".format(
+                connection_record.info["pid"], pid
+            )
+        )
+
+
+def install_fork_guard():
+    """ Makes every connection pool safe to use after a fork """
+    if not event.contains(Pool, "connect", remember_pid):
+        event.listen(Pool, "connect", remember_pid)
+        event.listen(Pool, "checkout", check_pid)
+
+
+class ReplicaRouter:
+    """
+    Spreads reads over a set of read replicas
+
+    Replicas are used round robin. A replica that fails is ejected for
+    eject_seconds, after which it gets another chance. Each replica has its own
+    scoped session, so every thread reads through a session of its own.
+    """
+
+    def __init__(self, engines, eject_seconds=30.0, clock=time.monotonic):
+        self.engines = list(engines)
+        self.sessions = {
+            engine: scoped_session(sessionmaker(bind=engine)) for engine in self.engines
+        }
+        self.eject_seconds = eject_seconds
+        self.clock = clock
+        self._ejected = {}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def pick(self):
+        """ Returns the next replica that is not ejected, or None if there is none """
+        now = self.clock()
+        with self._lock:
+            for _ in range(len(self.engines)):
+                engine = self.engines[next(self._counter) % len(self.engines)]
+                if self._ejected.get(engine, now) <= now:
+                    return engine
+        return None
+
+    def session(self, engine):
+        """ Returns the session of the current scope for a replica """
+        return self.sessions[engine]()
+
+    def eject(self, engine, error=None):
+        """ Stops using a replica for a while after it failed """
+        logger.warning("Ejecting read replica %s: %s", engine.url, error)
+        with self._lock:
+            self._ejected[engine] = self.clock() + self.eject_seconds
+
+    def restore(self, engine):
+        """ Marks a replica as healthy again """
+        with self._lock:
+            if self._ejected.pop(engine, None) is not None:
+                logger.info("Read replica %s is back", engine.url)
+
+    def healthy(self):
+        """ Returns the replicas that are not ejected """
+        now = self.clock()
+        with self._lock:
+            return [e for e in self.engines if self._ejected.get(e, now) <= now]
+
+    def dispose(self):
+        """ Closes the pooled connections of every replica """
+        for engine in self.engines:
+            engine.dispose()
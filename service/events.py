@@ -0,0 +1,179 @@
+"""
+Customer change events for the Customers service
+
+Broker fans every event out to its subscribers, the GET /customers/stream
+connections of this worker. Each subscriber has a bounded queue: when a slow
+client lets its queue fill up, new events for it are dropped and counted
+rather than blocking the write that raised them, and the client is told how
+many it missed so it can catch up from GET /customers/changes.
+
+On its own a Broker only reaches the subscribers of its own process. With
+EVENTS_TRANSPORT=postgres every event is sent with NOTIFY instead, and a
+thread in each worker LISTENs and hands what arrives to its local Broker, so
+every subscriber sees the writes of every worker.
+"""
+import os
+import json
+import queue
+import select
+import logging
+import threading
+import time
+from sqlalchemy import text
+
+logger = logging.getLogger("flask.app")
+
+
+class Subscription:
+    """ The queue of events waiting for one subscriber """
+
+    def __init__(self, maxsize):
+        self.events = queue.Queue(maxsize)
+        self.dropped = 0
+
+    def put(self, event):
+        """ Queues an event, or drops it if the queue is full """
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def get(self, timeout=None):
+        """Returns the next event
+
+        :param timeout: seconds to wait for one
+        :return: the event, or None if none came in time
+        """
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def take_dropped(self):
+        """ Returns how many events were dropped since the last call """
+        dropped, self.dropped = self.dropped, 0
+        return dropped
+
+
+class Broker:
+    """ Publishes events to every subscriber without ever blocking """
+
+    def __init__(self, maxsize=1000, transport=None, max_subscribers=0):
+        """
+        :param maxsize: the most events that may wait for each subscriber
+        :param transport: carries events between processes, None for this one only
+        :param max_subscribers: the most subscribers at once, 0 for no limit
+        """
+        self.maxsize = maxsize
+        self.transport = transport
+        self.max_subscribers = max_subscribers
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def publish(self, op, customer_id, customer=None):
+        """Publishes that a Customer changed
+
+        :param op: "create", "update", "suspend" or "delete"
+        :param customer_id: the id of the Customer
+        :param customer: the serialized Customer, None after a delete
+        """
+        event = {"op": op, "id": customer_id, "customer": customer}
+        if self.transport is None:
+            self.deliver(event)
+            return
+        try:
+            self.transport.send(event)
+        except Exception as error:  # pylint: disable=broad-except
+            # the write is already committed, so losing the event is better than failing it
+            logger.error("Could not send %s event for Customer %s: %s", op, customer_id, error)
+
+    def deliver(self, event):
+        """ Queues an event for every subscriber of this process """
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            subscription.put(event)
+
+    def subscribe(self):
+        """Returns a new Subscription to every event from now on
+
+        :return: the Subscription, or None if max_subscribers are subscribed
+        """
+        subscription = Subscription(self.maxsize)
+        with self._lock:
+            if self.max_subscribers and len(self._subscribers) >= self.max_subscribers:
+                return None
+            self._subscribers.add(subscription)
+        if self.transport is not None:
+            self.transport.listen(self)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """ Stops queuing events for a Subscription """
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+
+class PostgresTransport:
+    """ Carries events between worker processes with LISTEN/NOTIFY """
+
+    CHANNEL = "customer_events"
+
+    def __init__(self, engine, channel=CHANNEL, poll_seconds=5.0):
+        self.engine = engine
+        self.channel = channel
+        self.poll_seconds = poll_seconds
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def send(self, event):
+        """ Sends an event to the listeners of every process """
+        with self.engine.connect() as connection:
+            connection.execute(
+                text("SELECT pg_notify(:channel, :payload)"),
+                channel=self.channel,
+                payload=json.dumps(event),
+            )
+
+    def listen(self, broker):
+        """ Starts delivering notifications to a Broker, once per process """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        thread = threading.Thread(
+            target=self.run, args=(broker,), name="customer-events", daemon=True
+        )
+        thread.start()
+
+    def run(self, broker):
+        """ Listens for notifications for ever, reconnecting after errors """
+        while True:
+            try:
+                self.receive(broker)
+            except Exception as error:  # pylint: disable=broad-except
+                logger.error("Lost the %s listener: %s", self.channel, error)
+                time.sleep(self.poll_seconds)
+
+    def receive(self, broker):
+        """ Delivers the notifications of one connection to a Broker """
+        connection = self.engine.raw_connection()
+        # the listener keeps its connection, so do not hold a slot in the pool
+        connection.detach()
+        dbapi_connection = connection.connection
+        try:
+            dbapi_connection.autocommit = True
+            dbapi_connection.cursor().execute("LISTEN " + self.channel)
+            while True:
+                ready, _, _ = select.select([dbapi_connection], [], [], self.poll_seconds)
+                if not ready:
+                    continue
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    notify = dbapi_connection.notifies.pop(0)
+                    broker.deliver(json.loads(notify.payload))
+        finally:
+            connection.close()
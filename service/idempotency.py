@@ -0,0 +1,221 @@
+"""
+Idempotency keys for the Customers service
+
+A client that sends an Idempotency-Key header can safely retry a request: the
+first request with the key runs and its response is stored, and any retry with
+the same key gets that stored response back without running the request again.
+
+A key is remembered together with a fingerprint of the request (its method,
+path and body), so a key that is reused for a different request is refused
+rather than answered with the response of another one. While the first request
+is still running the key is held, and a retry that arrives in the meantime is
+told to try again later. The hold is a lease of IDEMPOTENCY_LEASE seconds: if
+the worker that held the key died without answering, the next retry after the
+lease has run out takes the key over and runs the request itself.
+
+MemoryStore keeps the keys in the worker process, which is enough for a single
+worker. DatabaseStore keeps them in the idempotency_key table so that every
+worker sees them. Both forget a key IDEMPOTENCY_TTL seconds after it was first
+used.
+"""
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+from service.models import IdempotencyKey
+
+logger = logging.getLogger("flask.app")
+
+# What is stored for a key: response is None while the first request runs,
+# then a dictionary with its status, body and headers
+Record = namedtuple("Record", ["fingerprint", "response"])
+
+
+def fingerprint(method, path, body):
+    """Returns a digest that identifies a request
+
+    A JSON body is normalized first, so the order of its keys does not matter.
+
+    :param method: the HTTP method
+    :param path: the path of the request
+    :param body: the raw body of the request
+    :type body: bytes
+    :return: a hexadecimal SHA-256 digest
+    :rtype: str
+    """
+    try:
+        body = json.dumps(json.loads(body), sort_keys=True, separators=(",", ":")).encode("utf-8")
+    except ValueError:
+        pass
+    digest = hashlib.sha256()
+    for part in (method.encode("utf-8"), path.encode("utf-8"), body):
+        digest.update(part)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class MemoryStore:
+    """ Keeps the idempotency keys of this process, the oldest ones go first """
+
+    def __init__(self, maxsize=100000, ttl=86400.0, lease=60.0, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lease = lease
+        self.clock = clock
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._records)
+
+    def begin(self, key, digest):
+        """Holds a key for a new request
+
+        A key whose request has not answered within the lease is taken over.
+
+        :return: None if the key was free and is now held, or the Record
+            of the request that used it first
+        """
+        now = self.clock()
+        with self._lock:
+            entry = self._records.get(key)
+            if entry is not None and entry[1] > now:
+                record, _, held_until = entry
+                if record.response is not None or held_until > now:
+                    return record
+            self._records.pop(key, None)
+            self._records[key] = (Record(digest, None), now + self.ttl, now + self.lease)
+            while len(self._records) > self.maxsize:
+                self._records.popitem(last=False)
+        return None
+
+    def complete(self, key, digest, response):
+        """ Stores the response of the request that holds a key """
+        with self._lock:
+            entry = self._records.get(key)
+            if entry is not None:
+                self._records[key] = (Record(digest, response), entry[1], entry[2])
+
+    def release(self, key):
+        """ Frees a key whose request failed, so that it can be retried """
+        with self._lock:
+            self._records.pop(key, None)
+
+
+class DatabaseStore:
+    """ Keeps the idempotency keys in the database, shared by every worker """
+
+    def __init__(self, engine, ttl=86400.0, lease=60.0, purge_interval=60.0,
+                 clock=time.monotonic):
+        self.engine = engine
+        self.ttl = ttl
+        self.lease = lease
+        self.purge_interval = purge_interval
+        self.clock = clock
+        self._next_purge = 0.0
+
+    def begin(self, key, digest):
+        """Holds a key for a new request
+
+        A key that is still held created_at + lease after it was taken is
+        taken over by moving its created_at forward, which only one of the
+        retries racing for it can do.
+
+        :return: None if the key was free and is now held, or the Record
+            of the request that used it first
+        """
+        self.purge_if_due()
+        table = IdempotencyKey.__table__
+        for _ in range(2):
+            try:
+                with self.engine.begin() as connection:
+                    connection.execute(
+                        table.insert(), key=key, fingerprint=digest, created_at=datetime.utcnow()
+                    )
+                return None
+            except IntegrityError:
+                pass
+            with self.engine.begin() as connection:
+                row = connection.execute(table.select().where(table.c.key == key)).first()
+                if row is None:
+                    continue  # purged in the meantime
+                if row.response is None and row.created_at <= self.lease_expired_before():
+                    taken = connection.execute(
+                        table.update().where(table.c.key == key)
+                        .where(table.c.response.is_(None))
+                        .where(table.c.created_at == row.created_at)
+                        .values(fingerprint=digest, created_at=datetime.utcnow())
+                    ).rowcount
+                    if taken:
+                        logger.warning("Took over idempotency key %r after its lease ran out", key)
+                        return None
+                    continue
+                if row.created_at > self.expired_before():
+                    response = None if row.response is None else json.loads(row.response)
+                    return Record(row.fingerprint, response)
+                connection.execute(
+                    table.delete().where(table.c.key == key)
+                    .where(table.c.created_at == row.created_at)
+                )
+        # another request won the race for the expired key
+        return Record(digest, None)
+
+    def complete(self, key, digest, response):
+        """ Stores the response of the request that holds a key """
+        table = IdempotencyKey.__table__
+        with self.engine.begin() as connection:
+            connection.execute(
+                table.update().where(table.c.key == key).where(table.c.fingerprint == digest)
+                .values(response=json.dumps(response))
+            )
+
+    def release(self, key):
+        """ Frees a key whose request failed, so that it can be retried """
+        table = IdempotencyKey.__table__
+        with self.engine.begin() as connection:
+            connection.execute(
+                table.delete().where(table.c.key == key).where(table.c.response.is_(None))
+            )
+
+    def expired_before(self):
+        """ Returns the time before which keys have expired """
+        return datetime.utcnow() - timedelta(seconds=self.ttl)
+
+    def lease_expired_before(self):
+        """ Returns the time before which a held key can be taken over """
+        return datetime.utcnow() - timedelta(seconds=self.lease)
+
+    def purge_if_due(self):
+        """ Deletes the expired keys, at most once every purge_interval """
+        now = self.clock()
+        if now < self._next_purge:
+            return
+        self._next_purge = now + self.purge_interval
+        table = IdempotencyKey.__table__
+        with self.engine.begin() as connection:
+            purged = connection.execute(
+                table.delete().where(table.c.created_at <= self.expired_before())
+            ).rowcount
+        if purged:
+            logger.info("Purged %s expired idempotency keys", purged)
+
+
+def make_store(config, engine):
+    """Returns the store named by IDEMPOTENCY_STORE
+
+    :param config: the Flask app configuration
+    :param engine: the engine of the primary database
+    :return: a MemoryStore, a DatabaseStore, or None if keys are ignored
+    """
+    kind = config["IDEMPOTENCY_STORE"]
+    if kind == "memory":
+        return MemoryStore(
+            config["IDEMPOTENCY_MAX_KEYS"], config["IDEMPOTENCY_TTL"], config["IDEMPOTENCY_LEASE"]
+        )
+    if kind == "database":
+        return DatabaseStore(engine, config["IDEMPOTENCY_TTL"], config["IDEMPOTENCY_LEASE"])
+    return None
@@ -0,0 +1,155 @@
+"""
+Rate limiting and load shedding for the Customers service
+
+RateLimiter gives every API key a token bucket per route. A bucket holds up
+to burst tokens and refills at rate tokens per second; each request takes one,
+and a request that finds the bucket empty is refused with 429 Too Many
+Requests and told in Retry-After when the next token will be there. Routes can
+have their own rate and burst, e.g. a low one for bulk creates.
+
+LoadShedder refuses requests with 503 Service Unavailable, before they do any
+work, while too many requests are already in flight or while checkouts from
+the database pool have lately been waiting too long. Failing fast keeps the
+latency of the requests that are let in from growing without bound.
+"""
+import math
+import time
+import threading
+from collections import OrderedDict
+
+
+def parse_routes(spec):
+    """Parses the per route limits of RATE_LIMIT_ROUTES
+
+    :param spec: entries separated by ";" like "POST /customers/bulk=0.5:2",
+        i.e. the method and rule of the route, its rate per second and burst
+    :type spec: str
+    :return: maps "METHOD rule" to (rate, burst)
+    :rtype: dict
+    :raises ValueError: if an entry is malformed
+    """
+    routes = {}
+    for entry in (spec or "").split(";"):
+        if not entry.strip():
+            continue
+        route, _, limit = entry.rpartition("=")
+        rate, _, burst = limit.partition(":")
+        if not route.strip() or not burst:
+            raise ValueError("Invalid rate limit: " + entry)
+        routes[" ".join(route.split())] = (float(rate), float(burst))
+    return routes
+
+
+class TokenBucket:
+    """ Allows rate requests per second on average and burst at once """
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        """Takes a token if there is one
+
+        :return: 0 if the request may go ahead, or the seconds until a token
+            will be available
+        :rtype: float
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """ Keeps a token bucket for every API key and route """
+
+    def __init__(self, rate, burst, routes=None, maxsize=10000, clock=time.monotonic):
+        """
+        :param rate: the default tokens per second, 0 for no limit
+        :param burst: the default size of a bucket
+        :param routes: maps "METHOD rule" to its own (rate, burst)
+        :param maxsize: the most buckets to keep, the least recently used go first
+        """
+        self.rate = rate
+        self.burst = burst
+        self.routes = routes or {}
+        self.maxsize = maxsize
+        self.clock = clock
+        self.limited = 0
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, client, route):
+        """Takes a token for a request of a client to a route
+
+        :param client: who sent the request, e.g. its API key
+        :param route: the method and rule of the route, e.g. "GET /customers"
+        :return: 0 if the request may go ahead, or the seconds to wait
+        :rtype: float
+        """
+        rate, burst = self.routes.get(route, (self.rate, self.burst))
+        if rate <= 0:
+            return 0.0
+        now = self.clock()
+        key = (client, route)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(rate, max(burst, 1), now)
+                while len(self._buckets) > self.maxsize:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            wait = bucket.take(now)
+            if wait:
+                self.limited += 1
+            return wait
+
+
+class LoadShedder:
+    """ Counts the requests in flight and decides when to refuse more """
+
+    def __init__(self, max_in_flight=0, max_pool_wait=0.0, pool_wait=None):
+        """
+        :param max_in_flight: refuse requests while this many are running, 0 for no limit
+        :param max_pool_wait: refuse requests while the average wait for a
+            database connection is above this many seconds, 0 for no limit
+        :param pool_wait: a function that returns the recent average wait
+        """
+        self.max_in_flight = max_in_flight
+        self.max_pool_wait = max_pool_wait
+        self.pool_wait = pool_wait or (lambda: 0.0)
+        self.in_flight = 0
+        self.shed = 0
+        self._lock = threading.Lock()
+
+    def enter(self):
+        """Lets a request in if there is room for it
+
+        :return: the reason it was refused, or None if it was let in
+        :rtype: str
+        """
+        if self.max_pool_wait and self.pool_wait() > self.max_pool_wait:
+            with self._lock:
+                self.shed += 1
+            return "the database is busy"
+        with self._lock:
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                self.shed += 1
+                return "too many requests are in progress"
+            self.in_flight += 1
+        return None
+
+    def leave(self):
+        """ Marks a request that was let in as finished """
+        with self._lock:
+            self.in_flight -= 1
+
+
+def retry_after(seconds):
+    """ Rounds a wait up to the whole seconds of a Retry-After header """
+    return max(1, int(math.ceil(seconds)))
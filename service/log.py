@@ -0,0 +1,210 @@
+"""
+Logging for the Customers service
+
+Requests never write the log themselves. AsyncLogHandler puts each record on
+a bounded queue and returns, and a listener thread takes them off the queue
+and hands them to the real handlers (gunicorn's streams in production). When
+the writer falls behind and the queue fills up, new records are dropped and
+counted instead of making requests wait, and the next record that fits is
+followed by a warning with the number that were lost.
+
+Records are written as one JSON object per line (LOG_FORMAT=json) with the
+method and path of the request that logged them and any fields that were
+logged with extra={"fields": {...}}, or as plain text (LOG_FORMAT=text).
+High volume levels can be sampled with LOG_SAMPLE_RATES, e.g. "INFO=0.1"
+keeps about one INFO record in ten.
+"""
+import os
+import sys
+import copy
+import json
+import queue
+import random
+import logging
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from flask import has_request_context, request
+
+# The format of LOG_FORMAT=text
+TEXT_FORMAT = "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s"
+TEXT_DATE_FORMAT = "%Y-%m-%d %H:%M:%S %z"
+
+
+def parse_rates(spec):
+    """Parses the per level sample rates of LOG_SAMPLE_RATES
+
+    :param spec: entries separated by "," like "INFO=0.1", i.e. a level name
+        and the fraction of its records to keep
+    :type spec: str
+    :return: maps level numbers to rates
+    :rtype: dict
+    :raises ValueError: if an entry is malformed
+    """
+    rates = {}
+    for entry in (spec or "").split(","):
+        if not entry.strip():
+            continue
+        name, _, rate = entry.partition("=")
+        level = logging.getLevelName(name.strip().upper())
+        if not isinstance(level, int) or not rate.strip():
+            raise ValueError("Invalid log sample rate: " + entry)
+        rates[level] = float(rate)
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """ Keeps a fraction of the records of some levels """
+
+    def __init__(self, rates=None, random_fn=random.random):
+        """
+        :param rates: maps level numbers to the fraction of records to keep,
+            levels that are not in it are always kept
+        """
+        super().__init__()
+        self.rates = rates or {}
+        self.random = random_fn
+
+    def filter(self, record):
+        rate = self.rates.get(record.levelno, 1.0)
+        return rate >= 1.0 or self.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    """ Formats a record as a JSON object on one line """
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+        for name in ("method", "path"):
+            if hasattr(record, name):
+                entry[name] = getattr(record, name)
+        # structured fields passed as extra={"fields": {...}}
+        for name, value in getattr(record, "fields", {}).items():
+            entry.setdefault(name, value)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class LogListener(QueueListener):
+    """ A QueueListener that can be stopped while its queue is full """
+
+    def enqueue_sentinel(self):
+        # wait for room rather than lose the sentinel
+        self.queue.put(self._sentinel)
+
+
+class AsyncLogHandler(QueueHandler):
+    """ Hands records to a writer thread through a bounded queue """
+
+    def __init__(self, handlers, maxsize=10000):
+        """
+        :param handlers: the handlers that the writer thread passes records to
+        :param maxsize: the most records that may wait for the writer
+        """
+        super().__init__(queue.Queue(maxsize))
+        self.targets = list(handlers)
+        self.maxsize = maxsize
+        self.listener = None
+        self.dropped = 0
+        self._unreported = 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """ Starts the writer thread, once per process """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            # a forked worker has no writer thread, and the queue of its parent
+            # may have been locked at the time of the fork
+            self.queue = queue.Queue(self.maxsize)
+            self.listener = LogListener(self.queue, *self.targets, respect_handler_level=True)
+            self.listener.start()
+
+    def stop(self):
+        """ Writes the records that are still queued and stops the writer """
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            self._pid = None
+            self.listener.stop()
+
+    def close(self):
+        self.stop()
+        super().close()
+
+    def prepare(self, record):
+        """ Copies what the writer needs while the request is still there """
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        if has_request_context():
+            record.method = request.method
+            record.path = request.path
+        return record
+
+    def enqueue(self, record):
+        """ Queues a record, or drops it if the queue is full """
+        if self._pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+                self._unreported += 1
+            return
+        if self._unreported:
+            with self._lock:
+                unreported, self._unreported = self._unreported, 0
+            warning = logging.makeLogRecord({
+                "name": record.name,
+                "levelno": logging.WARNING,
+                "levelname": "WARNING",
+                "msg": "Dropped {} log records, the log queue was full".format(unreported),
+            })
+            try:
+                self.queue.put_nowait(warning)
+            except queue.Full:
+                with self._lock:
+                    self._unreported += unreported
+
+
+def init_app(app, handlers=None):
+    """Sends the log of the app and of the service modules through an AsyncLogHandler
+
+    :param app: the Flask app, whose LOG_FORMAT, LOG_QUEUE_SIZE and
+        LOG_SAMPLE_RATES are used
+    :param handlers: the handlers that write the records, a stream handler
+        on stderr if there are none
+    :return: the AsyncLogHandler
+    """
+    handlers = list(handlers or []) or [logging.StreamHandler(sys.stderr)]
+    if app.config["LOG_FORMAT"] == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(TEXT_FORMAT, TEXT_DATE_FORMAT)
+    for target in handlers:
+        target.setFormatter(formatter)
+    handler = AsyncLogHandler(handlers, app.config["LOG_QUEUE_SIZE"])
+    handler.addFilter(SamplingFilter(parse_rates(app.config["LOG_SAMPLE_RATES"])))
+    # the modules of the service log to "flask.app", the name of the app
+    # logger before Flask 1.1
+    for logger in (app.logger, logging.getLogger("flask.app")):
+        logger.handlers = [handler]
+        logger.propagate = False
+    logging.getLogger("flask.app").setLevel(app.logger.level)
+    return handler
@@ -0,0 +1,186 @@
+"""
+Prometheus metrics for the Customers service
+
+The metrics are served at /metrics in the Prometheus text format:
+
+- customers_http_requests_total and customers_http_request_duration_seconds
+  count and time the requests by method, route rule and status, e.g.
+  route="/customers/<customer_id>", so that a route is one series however
+  many ids it is called with
+- customers_http_requests_in_flight is the number of requests in progress
+- customers_db_pool_wait_seconds is how long checkouts waited for a
+  connection, customers_db_pool_checked_out how many connections are in use
+- customers_db_statements_total and customers_db_statement_duration_seconds
+  count and time the SQL statements by operation (SELECT, INSERT, ...)
+- customers_cache_events_total counts the hits, misses, evictions and
+  expirations of the Customer cache
+
+Every gunicorn worker is a process with its own counters. When
+PROMETHEUS_MULTIPROC_DIR is set (gunicorn.conf.py sets it), each worker writes
+its samples to files in that directory and /metrics adds up the files of all
+of them, whichever worker answers the scrape. The variable has to be set
+before this module is imported.
+"""
+import os
+import time
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest, multiprocess
+from service import database
+
+# Upper bounds in seconds for the database histograms, which are far shorter
+# than whole requests
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# SQL statements are labelled with their first keyword if it is one of these
+OPERATIONS = {"SELECT", "INSERT", "UPDATE", "DELETE", "BEGIN", "COMMIT", "ROLLBACK"}
+
+REQUESTS = Counter(
+    "customers_http_requests_total",
+    "HTTP requests by method, route and status",
+    ["method", "route", "status"],
+)
+REQUEST_DURATION = Histogram(
+    "customers_http_request_duration_seconds",
+    "Time spent answering HTTP requests",
+    ["method", "route"],
+)
+IN_FLIGHT = Gauge(
+    "customers_http_requests_in_flight",
+    "HTTP requests in progress",
+    multiprocess_mode="livesum",
+)
+POOL_WAIT = Histogram(
+    "customers_db_pool_wait_seconds",
+    "Time spent waiting for a connection from the database pool",
+    buckets=DB_BUCKETS,
+)
+POOL_CHECKED_OUT = Gauge(
+    "customers_db_pool_checked_out",
+    "Database connections checked out of the pool",
+    multiprocess_mode="livesum",
+)
+POOL_CHECKOUTS = Counter(
+    "customers_db_pool_checkouts_total",
+    "Database connections checked out of the pool",
+)
+STATEMENTS = Counter(
+    "customers_db_statements_total",
+    "SQL statements executed by operation",
+    ["operation"],
+)
+STATEMENT_DURATION = Histogram(
+    "customers_db_statement_duration_seconds",
+    "Time spent executing SQL statements",
+    ["operation"],
+    buckets=DB_BUCKETS,
+)
+CACHE_EVENTS = Counter(
+    "customers_cache_events_total",
+    "Hits, misses, evictions and expirations of the Customer cache",
+    ["event"],
+)
+
+
+def multiprocess_dir():
+    """ Returns the directory shared by the worker processes, or None """
+    return os.getenv("PROMETHEUS_MULTIPROC_DIR") or os.getenv("prometheus_multiproc_dir")
+
+
+def render():
+    """Returns the current metrics of every worker
+
+    :return: the body and its content type
+    :rtype: tuple
+    """
+    registry = REGISTRY
+    if multiprocess_dir():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+######################################################################
+#  R E Q U E S T S
+######################################################################
+def request_started(in_flight=True):
+    """Counts a request as in flight and returns when it started
+
+    :param in_flight: False for a stream that may stay open for hours, which
+        is timed but not counted, so request_closed() must not be called
+    """
+    if in_flight:
+        IN_FLIGHT.inc()
+    return time.perf_counter()
+
+
+def request_finished(method, route, status, started):
+    """Records a request that was answered
+
+    :param route: the rule of the route, e.g. "/customers/<customer_id>"
+    :param status: the status code of the response
+    :param started: what request_started() returned
+    """
+    REQUESTS.labels(method, route, str(status)).inc()
+    REQUEST_DURATION.labels(method, route).observe(time.perf_counter() - started)
+
+
+def request_closed():
+    """ Counts a request as no longer in flight """
+    IN_FLIGHT.dec()
+
+
+######################################################################
+#  D A T A B A S E
+######################################################################
+def operation(statement):
+    """ Returns the operation of a SQL statement, e.g. "SELECT" """
+    words = statement.lstrip().split(None, 1)
+    keyword = words[0].upper() if words else ""
+    return keyword if keyword in OPERATIONS else "OTHER"
+
+
+def statement_started(conn, cursor, statement, parameters, context, executemany):
+    """ Notes when a statement started """
+    if context is not None:
+        context.metrics_started = time.perf_counter()
+
+
+def statement_finished(conn, cursor, statement, parameters, context, executemany):
+    """ Counts and times a statement that succeeded """
+    name = operation(statement)
+    STATEMENTS.labels(name).inc()
+    started = getattr(context, "metrics_started", None)
+    if started is not None:
+        STATEMENT_DURATION.labels(name).observe(time.perf_counter() - started)
+
+
+def connection_checked_out(dbapi_connection, connection_record, connection_proxy):
+    """ Counts a connection taken from a pool """
+    POOL_CHECKOUTS.inc()
+    POOL_CHECKED_OUT.inc()
+
+
+def connection_returned(dbapi_connection, connection_record):
+    """ Counts a connection given back to, or taken away from, its pool """
+    POOL_CHECKED_OUT.dec()
+
+
+def install():
+    """ Starts recording the statements and pool usage of every engine """
+    if event.contains(Engine, "before_cursor_execute", statement_started):
+        return
+    event.listen(Engine, "before_cursor_execute", statement_started)
+    event.listen(Engine, "after_cursor_execute", statement_finished)
+    event.listen(Pool, "checkout", connection_checked_out)
+    event.listen(Pool, "checkin", connection_returned)
+    # a detached connection is closed without ever being checked in
+    event.listen(Pool, "detach", connection_returned)
+    database.pool_wait.listeners.append(POOL_WAIT.observe)
+
+
+def instrument_cache(cache):
+    """ Counts the events of a Customer cache """
+    cache.observer = lambda name: CACHE_EVENTS.labels(name).inc()
@@ -0,0 +1,188 @@
+"""
+Schema migrations for the Customers service
+
+db.create_all() only creates tables that are missing, so it can never change
+a table that already holds data. Changes to existing tables are made here as
+numbered migrations instead, and the last version that was applied is kept in
+the schema_version table.
+
+A brand new database gets the current schema from create_all() and is stamped
+with the latest version. An existing database only runs the migrations that
+it has not seen yet. Migrations must be safe to run against a live table: on
+PostgreSQL indexes are built with CREATE INDEX CONCURRENTLY so that reads and
+writes are not blocked while they build.
+"""
+import logging
+from sqlalchemy import Column, Integer, MetaData, Table, inspect, text
+
+logger = logging.getLogger("flask.app")
+
+CUSTOMER_TABLE = "customer"
+CHANGE_TABLE = "customer_change"
+
+# The columns that GET /customers/search matches against
+SEARCH_COLUMNS = ("first_name", "last_name", "email", "address")
+
+# Kept out of db.metadata so that db.drop_all() does not forget the version
+version_table = Table(
+    "schema_version", MetaData(), Column("version", Integer, nullable=False)
+)
+
+
+######################################################################
+#  M I G R A T I O N   H E L P E R S
+######################################################################
+def create_index(connection, name, target, where=None, concurrently=True):
+    """Creates an index if it does not exist without locking the table
+
+    :param connection: an autocommit connection
+    :param name: the name of the index
+    :param target: the table and column list, e.g. "customer (last_name)"
+    :param where: an optional predicate for a partial index
+    :param concurrently: False to build the index inside a transaction
+    """
+    concurrently = concurrently and connection.dialect.name == "postgresql"
+    concurrently = " CONCURRENTLY" if concurrently else ""
+    sql = "CREATE INDEX{} IF NOT EXISTS {} ON {}".format(concurrently, name, target)
+    if where:
+        sql += " WHERE " + where
+    logger.info("Migration: %s", sql)
+    connection.execute(text(sql))
+
+
+def add_column(connection, table, name, definition):
+    """Adds a column to a table if it does not have it yet
+
+    :param connection: an autocommit connection
+    :param table: the name of the table
+    :param name: the name of the column
+    :param definition: the type and constraints, e.g. "INTEGER NOT NULL DEFAULT 1"
+    """
+    columns = {column["name"] for column in inspect(connection).get_columns(table)}
+    if name in columns:
+        return
+    sql = "ALTER TABLE {} ADD COLUMN {} {}".format(table, name, definition)
+    logger.info("Migration: %s", sql)
+    connection.execute(text(sql))
+
+
+######################################################################
+#  M I G R A T I O N S
+######################################################################
+def add_filter_indexes(connection):
+    """Indexes every column that GET /customers can filter on"""
+    for column in ("first_name", "last_name", "email", "address"):
+        create_index(
+            connection,
+            "ix_customer_{}".format(column),
+            "{} ({})".format(CUSTOMER_TABLE, column),
+        )
+    create_index(connection, "ix_customer_email_lower", CUSTOMER_TABLE + " (lower(email))")
+    create_index(
+        connection, "ix_customer_inactive", CUSTOMER_TABLE + " (id)", where="active = false"
+    )
+
+
+def add_name_index(connection):
+    """Indexes last name and first name together for combined filters"""
+    create_index(
+        connection,
+        "ix_customer_last_name_first_name",
+        CUSTOMER_TABLE + " (last_name, first_name)",
+    )
+
+
+def add_version_columns(connection):
+    """Adds the row version and last update time used by conditional requests"""
+    # constant defaults are applied without rewriting the table
+    add_column(connection, CUSTOMER_TABLE, "version", "INTEGER NOT NULL DEFAULT 1")
+    add_column(connection, CUSTOMER_TABLE, "updated_at", "TIMESTAMP")
+
+
+def add_search_indexes(connection, concurrently=True):
+    """Adds trigram indexes for substring search (PostgreSQL only)
+
+    A GIN index with gin_trgm_ops answers lower(column) LIKE '%term%' without
+    scanning the table. SQLite has no equivalent, so there search scans.
+    """
+    if connection.dialect.name != "postgresql":
+        return
+    connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    for column in SEARCH_COLUMNS:
+        create_index(
+            connection,
+            "ix_customer_{}_trgm".format(column),
+            "{} USING gin (lower({}) gin_trgm_ops)".format(CUSTOMER_TABLE, column),
+            concurrently=concurrently,
+        )
+
+
+def add_created_at_column(connection):
+    """Adds the creation time reported by the change feed"""
+    add_column(connection, CUSTOMER_TABLE, "created_at", "TIMESTAMP")
+
+
+def add_change_txid_column(connection):
+    """Adds the transaction id that orders the change feed on PostgreSQL
+
+    The changes that are already there have all committed, so they are given
+    txid 0, which puts them ahead of every new one in their seq order.
+    """
+    add_column(connection, CHANGE_TABLE, "txid", "BIGINT")
+    if connection.dialect.name == "postgresql":
+        sql = "UPDATE {} SET txid = 0 WHERE txid IS NULL".format(CHANGE_TABLE)
+        logger.info("Migration: %s", sql)
+        connection.execute(text(sql))
+    create_index(connection, "ix_customer_change_txid_seq", CHANGE_TABLE + " (txid, seq)")
+
+
+# (version, description, migration) in the order they must be applied
+MIGRATIONS = [
+    (1, "Add indexes on the filterable columns", add_filter_indexes),
+    (2, "Add a composite index on last name and first name", add_name_index),
+    (3, "Add the version and updated_at columns", add_version_columns),
+    (4, "Add trigram indexes for search", add_search_indexes),
+    (5, "Add the created_at column", add_created_at_column),
+    (6, "Add the transaction id of changes", add_change_txid_column),
+]
+
+HEAD = MIGRATIONS[-1][0]
+
+
+######################################################################
+#  U P G R A D E
+######################################################################
+def current_version(connection):
+    """Returns the version of the schema, or None if it was never stamped"""
+    return connection.execute(version_table.select()).scalar()
+
+
+def stamp(connection, version):
+    """Records that the schema is at the given version"""
+    connection.execute(version_table.delete())
+    connection.execute(version_table.insert().values(version=version))
+
+
+def upgrade(engine, metadata):
+    """Creates any missing tables and applies the pending migrations
+
+    :param engine: the engine of the database to upgrade
+    :param metadata: the metadata of the models
+    """
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        version_table.create(connection, checkfirst=True)
+        version = current_version(connection)
+        fresh = version is None and not engine.dialect.has_table(connection, CUSTOMER_TABLE)
+        metadata.create_all(connection)
+        if fresh:
+            logger.info("Created a new schema at version %s", HEAD)
+            stamp(connection, HEAD)
+            return
+        for number, description, migration in MIGRATIONS:
+            if version is not None and number <= version:
+                continue
+            logger.info("Applying migration %s: %s", number, description)
+            migration(connection)
+            stamp(connection, number)
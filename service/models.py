@@ -6,6 +6,8 @@ All of the models are stored in this module
 Models
 ------
 Customer - A Customer is a resource that represents a customer account of an eCommerce website
+CustomerChange - An entry of the change feed: a Customer was created, updated or deleted
+IdempotencyKey - The stored response of a request that was sent with an Idempotency-Key
 
 Attributes:
 ----------
@@ -14,10 +16,33 @@ last name (string) - the last name of the customer
 email (string) - email of the the customer
 address (string) - shipping address of the customer
 active (boolean) - whether the customer account is active or disabled
+version (integer) - incremented every time the customer is updated
+created_at (datetime) - when the customer was created (UTC)
+updated_at (datetime) - when the customer was last written (UTC)
+
+Reads and writes
+----------------
+Writes always go to the primary database. When DATABASE_READ_URI names read
+replicas, find(), find_many(), all(), search(), paginate() and stream() read
+from them instead, except during a request that has already written or that
+sent "X-Read-Consistency: strong", which must see its own writes. The
+find_by_* queries only build a query, which runs on the replica that
+paginate() or stream() picks for it.
 
 """
 import logging
+from datetime import datetime, timedelta
+from flask import g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, case, create_engine, event, func, or_, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.orm.exc import StaleDataError
+from service import database, migrations
+from service.cache import LRUCache
+from service.batching import GroupCommitter
+from service.events import Broker, PostgresTransport
 
 logger = logging.getLogger("flask.app")
 
@@ -25,12 +50,29 @@ logger = logging.getLogger("flask.app")
 db = SQLAlchemy()
 
 
+def reads_own_writes():
+    """ True when the current request must read from the primary database """
+    return has_request_context() and g.get("read_primary", False)
+
+
+def wrote_to_primary():
+    """ Sends the rest of the current request's reads to the primary database """
+    if has_request_context():
+        g.read_primary = True
+
+
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
 
     pass
 
 
+class VersionConflictError(Exception):
+    """ Used when a Customer is not at the version the writer expected """
+
+    pass
+
+
 class Customer(db.Model):
     """
     Class that represents a Customer
@@ -41,16 +83,51 @@ class Customer(db.Model):
 
     logger = logging.getLogger(__name__)
     app = None
+    # Read-through cache of find() keyed by id, configured in init_db()
+    cache = LRUCache()
+    # Publishes every committed write to GET /customers/stream
+    events = Broker()
+    # Router over the read replicas, or None to read from the primary
+    replicas = None
+    # Coalesces the writes of concurrent requests, or None to commit each one
+    group_commit = None
+
+    # The columns that a list of Customers can be filtered on
+    FILTERS = ("first_name", "last_name", "email", "address", "active")
+    # Shorter search terms only match the start of a value
+    SEARCH_MIN_SUBSTRING = 3
 
     ##################################################
     # Table Schema
     ##################################################
     id = db.Column(db.Integer, primary_key=True)
-    first_name = db.Column(db.String(63))
-    last_name = db.Column(db.String(63))
-    email = db.Column(db.String(127))
-    address = db.Column(db.String(255))
+    first_name = db.Column(db.String(63), index=True)
+    last_name = db.Column(db.String(63), index=True)
+    email = db.Column(db.String(127), index=True)
+    address = db.Column(db.String(255), index=True)
     active = db.Column(db.Boolean())
+    version = db.Column(db.Integer, nullable=False, default=1)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    # Every UPDATE and DELETE through the ORM checks and increments version
+    __mapper_args__ = {"version_id_col": version}
+
+    # Keep in sync with the DDL in service/migrations.py
+    __table_args__ = (
+        # case-insensitive lookups by email
+        db.Index("ix_customer_email_lower", db.func.lower(email)),
+        # filtering by last name and first name together
+        db.Index("ix_customer_last_name_first_name", last_name, first_name),
+        # suspended customers are the minority, so only they are indexed
+        db.Index(
+            "ix_customer_inactive",
+            id,
+            postgresql_where=(active == False),  # noqa: E712
+            sqlite_where=(active == False),  # noqa: E712
+        ),
+    )
+    # The trigram indexes for search are PostgreSQL only, see below
 
     ##################################################
     # INSTANCE METHODS
@@ -82,6 +159,12 @@ class Customer(db.Model):
             data (dict): A dictionary containing the resource data
         """
         try:
+            for name in ("first_name", "last_name", "email", "address"):
+                if not isinstance(data[name], (str, type(None))):
+                    raise DataValidationError("Invalid customer: {} must be a string".format(name))
+            # 1 and 0 are accepted too, as SQLite hands them back for booleans
+            if not isinstance(data["active"], (bool, type(None))) and data["active"] not in (0, 1):
+                raise DataValidationError("Invalid customer: active must be a boolean")
             self.first_name = data["first_name"]
             self.last_name = data["last_name"]
             self.email = data["email"]
@@ -98,16 +181,27 @@ class Customer(db.Model):
     def create(self):
         """
         Creates a Customer to the data store
+
+        With group commit on, the Customer is inserted together with the
+        Customers of other requests and this waits for their commit.
         """
+        if Customer.group_commit is not None:
+            Customer.group_commit.create(self)
+            wrote_to_primary()
+            return
         db.session.add(self)
+        db.session.flush()
+        data = self.serialize()
         db.session.commit()
+        wrote_to_primary()
+        Customer.events.publish("create", self.id, data)
 
     def delete(self):
         """
         Deletes a Customer from the database
         """
         db.session.delete(self)
-        db.session.commit()
+        self.commit_versioned("delete")
 
     def update(self):
         """
@@ -115,12 +209,48 @@ class Customer(db.Model):
         """
         if not self.id:
             raise DataValidationError("Update called with empty ID field")
-        db.session.commit()
+        self.commit_versioned("update")
 
-    def save(self):
-        """ Saves a Customer in the database """
+    def commit_versioned(self, op):
+        """ Commits a change that only applies if nobody changed the Customer first """
+        # read the values now, as the commit expires them
+        customer_id = self.id
+        data = None if op == "delete" else self.serialize()
+        try:
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            raise VersionConflictError(
+                "Customer with id '{}' was changed by another request".format(customer_id)
+            )
+        finally:
+            Customer.cache.invalidate(customer_id)
+            wrote_to_primary()
+        Customer.events.publish(op, customer_id, data)
+
+    def row_values(self):
+        """ Returns the values of the columns that a client can write """
+        data = self.serialize()
+        del data["id"]
+        return data
+
+    def etag(self):
+        """ Returns a strong entity tag that changes whenever the Customer does """
+        return "{}-{}".format(self.id, self.version)
+
+    def cache_entry(self):
+        """ Returns the column values of a Customer to keep in the cache """
+        return {column.key: getattr(self, column.key) for column in self.__table__.columns}
+
+    def validate(self):
+        """ Checks that a Customer can be saved, and raises DataValidationError if not """
         if not self.first_name and not self.last_name:   # name is the only required field
             raise DataValidationError('name attribute is not set')
+        return self
+
+    def save(self):
+        """ Saves a Customer in the database """
+        self.validate()
         if self.id:
             self.update()
         else:
@@ -141,32 +271,542 @@ class Customer(db.Model):
         logger.info("Initializing database")
         cls.app = app
         # This is where we initialize SQLAlchemy from the Flask app
+        cls.cache = LRUCache(app.config["CACHE_SIZE"], app.config["CACHE_TTL"])
+        cls.events = Broker(
+            app.config["EVENTS_QUEUE_SIZE"], max_subscribers=app.config["EVENTS_MAX_STREAMS"]
+        )
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = database.engine_options(app.config)
+        database.install_fork_guard()
+        cls.init_replicas(app.config)
         db.init_app(app)
         app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        migrations.upgrade(db.engine, db.metadata)  # make our sqlalchemy tables
+        if app.config["EVENTS_TRANSPORT"] == "postgres":
+            cls.events.transport = PostgresTransport(db.engine)
+        cls.group_commit = None
+        if app.config["GROUP_COMMIT"]:
+            cls.group_commit = GroupCommitter(
+                app,
+                cls.create_many,
+                cls.update_many,
+                app.config["GROUP_COMMIT_WINDOW_MS"] / 1000.0,
+                app.config["GROUP_COMMIT_MAX_BATCH"],
+            )
+        # gunicorn --preload forks the workers after this, so leave no
+        # connections in the pool for them to inherit
+        db.session.remove()
+        db.engine.dispose()
+
+    @classmethod
+    def init_replicas(cls, config):
+        """Creates an engine for every read replica in DATABASE_READ_URI
+
+        :param config: the Flask app configuration
+        :type config: dict
+        """
+        if cls.replicas is not None:
+            cls.replicas.dispose()
+            cls.replicas = None
+        uris = config["DATABASE_READ_URI"]
+        if not uris:
+            return
+        logger.info("Reading from %s replicas", len(uris))
+        engines = [create_engine(uri, **database.engine_options(config, uri)) for uri in uris]
+        cls.replicas = database.ReplicaRouter(
+            engines, config["DATABASE_REPLICA_EJECT_SECONDS"]
+        )
+
+    @classmethod
+    def replica(cls):
+        """Returns the replica engine that the next read should use
+
+        :return: an engine, or None if the read must go to the primary
+        :rtype: Engine
+        """
+        if cls.replicas is None or reads_own_writes():
+            return None
+        return cls.replicas.pick()
+
+    @classmethod
+    def on_replica(cls, read):
+        """Runs a read on a replica, or on the primary if there is none
+
+        A replica that cannot be reached is ejected and the read is retried
+        on the primary, so a failing replica never fails a request.
+
+        :param read: a function that takes a session and returns the result
+        :type read: function
+        :return: whatever read returned
+        """
+        engine = cls.replica()
+        if engine is None:
+            return read(db.session())
+        session = cls.replicas.session(engine)
+        try:
+            result = read(session)
+        except OperationalError as error:
+            session.rollback()
+            cls.replicas.eject(engine, error)
+            return read(db.session())
+        finally:
+            session.close()
+        cls.replicas.restore(engine)
+        return result
+
+    @classmethod
+    def create_many(cls, customers: list, batch_size: int = None):
+        """Creates many Customers in batches instead of one by one
+
+        Each batch is written by a single multi-row INSERT on databases that
+        can return the new ids (PostgreSQL), or by one INSERT per row inside a
+        single transaction otherwise, and is committed once.
+
+        :param customers: the Customers to create, their ids are set in place
+        :type customers: list
+        :param batch_size: the number of Customers per transaction
+        :type batch_size: int
+        """
+        table = cls.__table__
+        batch_size = batch_size or cls.app.config["BULK_BATCH_SIZE"]
+        returning = db.engine.dialect.implicit_returning
+        cls.logger.info("Processing bulk create of %s customers ...", len(customers))
+        for start in range(0, len(customers), batch_size):
+            batch = customers[start:start + batch_size]
+            rows = [customer.row_values() for customer in batch]
+            if returning:
+                result = db.session.execute(
+                    table.insert().values(rows).returning(table.c.id)
+                )
+                ids = [row[0] for row in result]
+            else:
+                ids = [
+                    db.session.execute(table.insert(), row).inserted_primary_key[0]
+                    for row in rows
+                ]
+            CustomerChange.record(db.session, "create", ids)
+            db.session.commit()
+            wrote_to_primary()
+            for customer, customer_id in zip(batch, ids):
+                customer.id = customer_id
+                cls.events.publish("create", customer_id, customer.serialize())
+
+    @classmethod
+    def from_entry(cls, entry: dict):
+        """Rebuilds a Customer from all of its column values without a query
+        :param entry: the column values, e.g. from cache_entry()
+        :type entry: dict
+        :return: a Customer in the session, as if it had been loaded
+        :rtype: Customer
+        """
+        existing = db.session.identity_map.get(identity_key(cls, entry["id"]))
+        if existing is not None:
+            return existing
+        customer = cls(**entry)
+        make_transient_to_detached(customer)
+        return db.session.merge(customer, load=False)
+
+    @classmethod
+    def update_by_id(cls, customer_id: int, values: dict, version: int = None, op: str = "update"):
+        """Updates a Customer with a single conditional UPDATE statement
+
+        UPDATE customer SET ..., version = version + 1
+        WHERE id = :customer_id [AND version = :version]
+
+        With group commit on, the update waits to be committed together with
+        the writes of other requests.
+
+        :param customer_id: the id of the Customer to update
+        :type customer_id: int
+        :param values: the new values of the columns to change
+        :type values: dict
+        :param version: only update if the Customer is at this version
+        :type version: int
+        :param op: the name of the event to publish, e.g. "suspend"
+        :type op: str
+        :return: the updated Customer, or None if not found
+        :rtype: Customer
+        :raises VersionConflictError: if the Customer is at another version
+        """
+        if cls.group_commit is not None:
+            result = cls.group_commit.update(customer_id, values, version, op)
+            wrote_to_primary()
+            return result
+        result = cls.update_many([(customer_id, values, version, op)])[0]
+        if isinstance(result, VersionConflictError):
+            raise result
+        return result
+
+    @classmethod
+    def update_many(cls, updates: list):
+        """Applies many conditional updates in a single transaction
+
+        :param updates: (customer_id, values, version, op) tuples, as taken
+            by update_by_id()
+        :type updates: list
+        :return: for each update in order, the updated Customer, None if it
+            was not found, or the VersionConflictError it ran into
+        :rtype: list
+        """
+        table = cls.__table__
+        returning = db.engine.dialect.implicit_returning
+        applied = []
+        for customer_id, values, version, op in updates:
+            cls.logger.info("Processing update for id %s at version %s ...", customer_id, version)
+            try:
+                customer_id = int(customer_id)
+            except (TypeError, ValueError):
+                applied.append(None)
+                continue
+            statement = table.update().where(table.c.id == customer_id)
+            if version is not None:
+                statement = statement.where(table.c.version == version)
+            statement = statement.values(version=table.c.version + 1, **values)
+            if returning:
+                statement = statement.returning(*table.c)
+            result = db.session.execute(statement)
+            row = result.first() if returning else None
+            if result.rowcount:
+                CustomerChange.record(db.session, "update", [customer_id])
+            applied.append((customer_id, version, op, result.rowcount, row))
+        db.session.commit()
+        wrote_to_primary()
+        results = []
+        for update in applied:
+            if update is None:
+                results.append(None)
+                continue
+            customer_id, version, op, updated, row = update
+            cls.cache.invalidate(customer_id)
+            if not updated:
+                try:
+                    cls.check_version_conflict(customer_id, version)
+                except VersionConflictError as error:
+                    results.append(error)
+                    continue
+                results.append(None)
+                continue
+            if row is not None:
+                customer = cls.from_entry(dict(row))
+            else:
+                customer = cls.query.get(customer_id)
+            cls.events.publish(op, customer_id, customer.serialize())
+            results.append(customer)
+        return results
+
+    @classmethod
+    def delete_by_id(cls, customer_id: int, version: int = None):
+        """Deletes a Customer with a single conditional DELETE statement
+        :param customer_id: the id of the Customer to delete
+        :type customer_id: int
+        :param version: only delete if the Customer is at this version
+        :type version: int
+        :return: True if the Customer was deleted, False if not found
+        :rtype: bool
+        :raises VersionConflictError: if the Customer is at another version
+        """
+        cls.logger.info("Processing delete for id %s at version %s ...", customer_id, version)
+        try:
+            customer_id = int(customer_id)
+        except (TypeError, ValueError):
+            return False
+        table = cls.__table__
+        statement = table.delete().where(table.c.id == customer_id)
+        if version is not None:
+            statement = statement.where(table.c.version == version)
+        deleted = db.session.execute(statement).rowcount
+        if deleted:
+            CustomerChange.record(db.session, "delete", [customer_id])
+        db.session.commit()
+        cls.cache.invalidate(customer_id)
+        wrote_to_primary()
+        if not deleted:
+            cls.check_version_conflict(customer_id, version)
+        else:
+            cls.events.publish("delete", customer_id)
+        return bool(deleted)
+
+    @classmethod
+    def check_version_conflict(cls, customer_id: int, version: int):
+        """ Raises VersionConflictError if a conditional write missed an existing Customer """
+        if version is None:
+            return
+        if db.session.query(cls.id).filter(cls.id == customer_id).first() is not None:
+            raise VersionConflictError(
+                "Customer with id '{}' is not at version {}".format(customer_id, version)
+            )
 
     @classmethod
     def remove_all(cls):   # pragma: no cover
         """ Removes all customers from the database (use for testing)  """
         db.session.query(cls).delete()  # delete the customer table
+        db.session.query(CustomerChange).delete()
         db.session.commit()
+        cls.cache.clear()
 
     @classmethod
     def all(cls):
         """Returns all of the customers in the database"""
         cls.logger.info("Processing all of the customers...")
-        return cls.query.all()
+        return cls.on_replica(lambda session: session.query(cls).all())
+
+    @classmethod
+    def paginate(cls, query=None, limit: int = None, after: int = None, fields: list = None):
+        """Returns one page of Customers using keyset pagination on the id
+        :param query: the query to page through, defaults to all Customers
+        :type query: Query
+        :param limit: the maximum number of Customers to return
+        :type limit: int
+        :param after: only return Customers with an id greater than this
+        :type after: int
+        :param fields: only select these columns (plus id, version and
+            updated_at) with SQLAlchemy Core and return plain rows instead of
+            Customers, which skips building ORM instances
+        :type fields: list
+        :return: the page of Customers and the cursor of the next page, or
+            None if this is the last page
+        :rtype: tuple
+        """
+        if query is None:
+            query = cls.query
+        max_size = cls.app.config["PAGE_SIZE_MAX"]
+        if not limit:
+            limit = cls.app.config["PAGE_SIZE_DEFAULT"]
+        limit = min(limit, max_size)
+        if after is not None:
+            query = query.filter(cls.id > after)
+        cls.logger.info("Processing page of %s customers after %s ...", limit, after)
+        # fetch one extra row to find out if there is a next page
+        query = query.order_by(cls.id).limit(limit + 1)
+        if fields:
+            statement = query.with_entities(*cls.columns(fields)).statement
+            customers = cls.on_replica(lambda session: session.execute(statement).fetchall())
+        else:
+            customers = cls.on_replica(lambda session: query.with_session(session).all())
+        if len(customers) > limit:
+            customers = customers[:limit]
+            return customers, customers[-1].id
+        return customers, None
+
+    @classmethod
+    def columns(cls, fields: list):
+        """Returns the columns to select for a restricted list of fields
+
+        The id, version and updated_at columns are always included because
+        pagination and entity tags are built from them.
+
+        :param fields: the names of the fields to select
+        :type fields: list
+        :return: the column attributes to select
+        :rtype: list
+        """
+        names = ["id", "version", "updated_at"]
+        for name in fields:
+            if name != "id" and name not in cls.FILTERS:
+                raise DataValidationError("Invalid field: " + name)
+            if name not in names:
+                names.append(name)
+        return [getattr(cls, name) for name in names]
+
+    @classmethod
+    def find_by_filters(cls, filters: dict):
+        """Returns all Customers that match every one of the given filters
+        :param filters: maps a column in FILTERS to the value it must equal,
+            a list of values it must be one of, or a string ending in "*"
+            that it must start with
+        :type filters: dict
+        :return: a query of the Customers that match all of the filters
+        :rtype: Query
+        """
+        cls.logger.info("Processing filter query for %s ...", filters)
+        query = cls.query
+        for name, value in filters.items():
+            if name not in cls.FILTERS:
+                raise DataValidationError("Invalid filter: " + name)
+            column = getattr(cls, name)
+            if isinstance(value, (list, tuple)) and len(value) == 1:
+                value = value[0]
+            if isinstance(value, (list, tuple)):
+                query = query.filter(column.in_(value))
+            elif isinstance(value, str) and value.endswith("*"):
+                query = query.filter(column.startswith(value[:-1], autoescape=True))
+            else:
+                query = query.filter(column == value)
+        return query
+
+    @classmethod
+    def stream(cls, query=None, fields: list = None, batch_size: int = None):
+        """Yields the rows of the Customers in id order a batch at a time
+
+        The rows are selected with SQLAlchemy Core and fetched batch_size at a
+        time through a server-side cursor (on PostgreSQL), so memory stays
+        flat no matter how many there are.
+
+        :param query: the query to stream, defaults to all Customers
+        :type query: Query
+        :param fields: the fields to select, defaults to all of them
+        :type fields: list
+        :param batch_size: the number of rows to fetch per round trip
+        :type batch_size: int
+        :return: an iterator over the rows
+        :rtype: generator
+        """
+        if query is None:
+            query = cls.query
+        batch_size = batch_size or cls.app.config["EXPORT_BATCH_SIZE"]
+        cls.logger.info("Processing stream of customers ...")
+        statement = query.order_by(cls.id).with_entities(*cls.columns(fields or cls.FILTERS))
+        # a stream cannot move to the primary halfway through, so pick once
+        engine = cls.replica()
+        session = db.session if engine is None else cls.replicas.session(engine)
+        try:
+            result = session.execute(
+                statement.statement.execution_options(stream_results=True)
+            )
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            if engine is not None:
+                session.close()
+
+    @classmethod
+    def search(cls, term: str, limit: int = None, after: str = None, fields: list = None):
+        """Returns one page of the Customers that match a search term
+
+        The term is matched case-insensitively against the start of, or on
+        PostgreSQL with the trigram indexes anywhere in, the first name, last
+        name, email and address. Terms shorter than SEARCH_MIN_SUBSTRING
+        characters only match by prefix, which an index can still answer.
+        Exact matches come first, then prefix matches, then the rest, each in
+        id order.
+
+        :param term: the text to search for
+        :type term: str
+        :param limit: the maximum number of Customers to return
+        :type limit: int
+        :param after: the cursor returned with the previous page
+        :type after: str
+        :param fields: the fields to select, defaults to all of them
+        :type fields: list
+        :return: the page of rows and the cursor of the next page, or None
+            if this is the last page
+        :rtype: tuple
+        """
+        term = (term or "").strip().lower()
+        if not term:
+            raise DataValidationError("Search term is empty")
+        cls.logger.info("Processing search for %s after %s ...", term, after)
+        values = [func.lower(getattr(cls, name)) for name in migrations.SEARCH_COLUMNS]
+        exact = or_(*[value == term for value in values])
+        prefix = or_(*[value.startswith(term, autoescape=True) for value in values])
+        if len(term) < cls.SEARCH_MIN_SUBSTRING:
+            match = prefix
+        else:
+            match = or_(*[value.contains(term, autoescape=True) for value in values])
+        rank = case([(exact, 0), (prefix, 1)], else_=2)
+        statement = select(cls.columns(fields or cls.FILTERS) + [rank.label("rank")])
+        statement = statement.where(match)
+        if after:
+            try:
+                after_rank, after_id = (int(part) for part in after.split("-"))
+            except ValueError:
+                raise DataValidationError("Invalid search cursor: " + after)
+            statement = statement.where(
+                or_(rank > after_rank, and_(rank == after_rank, cls.id > after_id))
+            )
+        max_size = cls.app.config["PAGE_SIZE_MAX"]
+        limit = min(limit or cls.app.config["PAGE_SIZE_DEFAULT"], max_size)
+        statement = statement.order_by(rank, cls.id).limit(limit + 1)
+        rows = cls.on_replica(lambda session: session.execute(statement).fetchall())
+        if len(rows) > limit:
+            rows = rows[:limit]
+            return rows, "{}-{}".format(rows[-1].rank, rows[-1].id)
+        return rows, None
 
     @classmethod
     def find(cls, customer_id: int):
         """Finds a Customer by it's ID
+
+        Lookups are answered from the cache when they can be, and from a read
+        replica otherwise. Either way the Customer is merged into the primary
+        session without a query, so it can be updated or deleted like one
+        that was loaded from the primary. A request that must see its own
+        writes skips the cache, and a row from a replica is not cached if
+        its Customer was written recently, as the replica may lag behind.
+
         :param customer_id: the id of the Customer to find
         :type customer_id: int
         :return: an instance with the customer_id, or None if not found
         :rtype: Customer
         """
         cls.logger.info("Processing lookup for id %s ...", customer_id)
-        return cls.query.get(customer_id)
+        try:
+            customer_id = int(customer_id)
+        except (TypeError, ValueError):
+            return None
+        # a request that must see its own writes skips the cache, which
+        # another worker or a lagging replica may have filled
+        entry = None if reads_own_writes() else cls.cache.get(customer_id)
+        if entry is None:
+            generation = cls.cache.generation()
+            entry, primary = cls.on_replica(
+                lambda session: (cls.load_entry(session, customer_id), cls.is_primary(session))
+            )
+            if entry is None:
+                return None
+            cls.cache.set(customer_id, entry, generation if primary else cls.cache.remembered())
+        return cls.from_entry(entry)
+
+    @staticmethod
+    def is_primary(session):
+        """ True if a session that on_replica() handed out is the primary's """
+        return session is db.session()
+
+    @staticmethod
+    def load_entry(session, customer_id: int):
+        """ Loads the column values of a Customer through a session, or None """
+        customer = session.query(Customer).get(customer_id)
+        return None if customer is None else customer.cache_entry()
+
+    @classmethod
+    def find_many(cls, customer_ids: list):
+        """Finds many Customers by id with at most one query
+
+        Ids that are in the cache are answered from it and the rest are read
+        with a single SELECT ... WHERE id IN (...), whose rows are then cached.
+
+        :param customer_ids: the ids of the Customers to find
+        :type customer_ids: list
+        :return: maps each id to the column values of its Customer, or to
+            None if there is no such Customer
+        :rtype: dict
+        """
+        cls.logger.info("Processing batch lookup for %s ids ...", len(customer_ids))
+        found = {}
+        missing = []
+        pinned = reads_own_writes()
+        for customer_id in dict.fromkeys(customer_ids):
+            entry = None if pinned else cls.cache.get(customer_id)
+            if entry is None:
+                missing.append(customer_id)
+            else:
+                found[customer_id] = entry
+        if missing:
+            table = cls.__table__
+            statement = table.select().where(table.c.id.in_(missing))
+            generation = cls.cache.generation()
+            rows, primary = cls.on_replica(
+                lambda session: (session.execute(statement).fetchall(), cls.is_primary(session))
+            )
+            if not primary:
+                generation = cls.cache.remembered()
+            for row in rows:
+                entry = dict(row)
+                cls.cache.set(entry["id"], entry, generation)
+                found[entry["id"]] = entry
+        return {customer_id: found.get(customer_id) for customer_id in customer_ids}
 
     @classmethod
     def find_by_first_name(cls, first_name: str):
@@ -222,3 +862,163 @@ class Customer(db.Model):
         """
         cls.logger.info("Processing active query for %s ...", active)
         return cls.query.filter(cls.active == active)
+
+
+class CustomerChange(db.Model):
+    """
+    Class that represents an entry of the change feed
+
+    Every write to a Customer adds one in the same transaction, and a delete
+    leaves a tombstone behind. On PostgreSQL each change also keeps the id
+    of its transaction, and the feed is ordered by (txid, seq) so that it
+    can stop at the oldest transaction that is still open. Elsewhere the seq
+    primary key orders the feed.
+    """
+
+    logger = logging.getLogger(__name__)
+
+    ##################################################
+    # Table Schema
+    ##################################################
+    seq = db.Column(db.Integer, primary_key=True)
+    customer_id = db.Column(db.Integer, nullable=False, index=True)
+    op = db.Column(db.String(6), nullable=False)
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    txid = db.Column(db.BigInteger)  # PostgreSQL only
+
+    __table_args__ = (db.Index("ix_customer_change_txid_seq", "txid", "seq"),)
+
+    def __repr__(self):
+        return "<CustomerChange %r %r seq = [%s]>" % (self.op, self.customer_id, self.seq)
+
+    @classmethod
+    def record(cls, connection, op: str, customer_ids: list):
+        """Adds a change for each Customer to the current transaction
+
+        :param connection: the session or connection that made the change
+        :param op: "create", "update" or "delete"
+        :type op: str
+        :param customer_ids: the ids of the Customers that changed
+        :type customer_ids: list
+        """
+        if customer_ids:
+            insert = cls.__table__.insert()
+            if db.engine.dialect.name == "postgresql":
+                insert = insert.values(txid=func.txid_current())
+            connection.execute(
+                insert,
+                [{"customer_id": customer_id, "op": op} for customer_id in customer_ids],
+            )
+
+    @classmethod
+    def since(cls, seq: int = 0, limit: int = None):
+        """Returns the changes after a cursor with the Customers as they are now
+
+        Sequence numbers are handed out before commit, so a transaction can
+        commit a change behind a cursor that has already passed it. On
+        PostgreSQL the feed is ordered by transaction id and ends before the
+        oldest transaction that is still open, which can never commit behind
+        it. Elsewhere changes younger than CHANGES_SETTLE_SECONDS are left for
+        the next call instead, and a transaction that stays open for longer
+        than that can still have its changes skipped.
+
+        :param seq: the seq of the last change that was read
+        :type seq: int
+        :param limit: the maximum number of changes to return
+        :type limit: int
+        :return: rows of the change and the columns of its Customer (all
+            None if it was deleted since), and True if there are more
+        :rtype: tuple
+        """
+        cls.logger.info("Processing changes since %s ...", seq)
+        config = Customer.app.config
+        limit = min(limit or config["PAGE_SIZE_DEFAULT"], config["PAGE_SIZE_MAX"])
+        statement = cls.after(seq, db.engine.dialect.name).limit(limit + 1)
+        rows = Customer.on_replica(lambda session: session.execute(statement).fetchall())
+        return rows[:limit], len(rows) > limit
+
+    @classmethod
+    def after(cls, seq: int, dialect: str):
+        """Returns a select of the changes that come after a cursor, in order
+
+        :param seq: the seq of the last change that was read
+        :type seq: int
+        :param dialect: the name of the database dialect
+        :type dialect: str
+        :rtype: Select
+        """
+        change = cls.__table__
+        customer = Customer.__table__
+        statement = (
+            select([change.c.seq, change.c.customer_id, change.c.op, change.c.changed_at]
+                   + [customer.c[name] for name in ("id",) + Customer.FILTERS])
+            .select_from(change.outerjoin(customer, customer.c.id == change.c.customer_id))
+        )
+        if dialect != "postgresql":
+            settle = Customer.app.config["CHANGES_SETTLE_SECONDS"]
+            return (
+                statement.where(change.c.seq > seq)
+                .where(change.c.changed_at <= datetime.utcnow() - timedelta(seconds=settle))
+                .order_by(change.c.seq)
+            )
+        # every change of a transaction older than the oldest open one is final
+        oldest_open = func.txid_snapshot_xmin(func.txid_current_snapshot())
+        # a cursor that names no change starts after the changes before it
+        named = change.alias("last_read")
+        cursor = func.coalesce(
+            select([named.c.txid]).where(named.c.seq == seq).correlate(None).as_scalar(), 0
+        )
+        return (
+            statement.where(change.c.txid < oldest_open)
+            .where(or_(change.c.txid > cursor, and_(change.c.txid == cursor, change.c.seq > seq)))
+            .order_by(change.c.txid, change.c.seq)
+        )
+
+
+class IdempotencyKey(db.Model):
+    """
+    Class that represents the stored response of an idempotent request
+
+    A response of null means that the first request with the key is still
+    being processed, until IDEMPOTENCY_LEASE after created_at. Keys are purged once they are older than
+    IDEMPOTENCY_TTL, see service/idempotency.py.
+    """
+
+    ##################################################
+    # Table Schema
+    ##################################################
+    key = db.Column(db.String(320), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    response = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return "<IdempotencyKey %r>" % self.key
+
+
+# The trigram indexes of search() need the pg_trgm extension, so they are
+# created with the table by the migration rather than declared as Indexes
+event.listen(
+    Customer.__table__,
+    "after_create",
+    lambda target, connection, **kw: migrations.add_search_indexes(connection, False),
+)
+
+
+# Writes through the ORM (create, update, delete) feed the change log too
+@event.listens_for(Customer, "after_insert")
+def customer_created(mapper, connection, target):
+    """ Records the creation of a Customer in the change feed """
+    CustomerChange.record(connection, "create", [target.id])
+
+
+@event.listens_for(Customer, "after_update")
+def customer_updated(mapper, connection, target):
+    """ Records an update of a Customer in the change feed """
+    CustomerChange.record(connection, "update", [target.id])
+
+
+@event.listens_for(Customer, "after_delete")
+def customer_deleted(mapper, connection, target):
+    """ Records the deletion of a Customer in the change feed """
+    CustomerChange.record(connection, "delete", [target.id])
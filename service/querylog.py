@@ -0,0 +1,127 @@
+"""
+Per request SQL instrumentation for the Customers service
+
+Every statement that a request runs is counted and timed. The count, the
+total time in the database and the slowest statement are sent back with the
+response as a Server-Timing header, e.g.
+
+    Server-Timing: db;dur=3.521;desc="4 statements", db-slowest;dur=2.114;desc="UPDATE"
+
+which browser developer tools and most HTTP clients can show. Statements that
+take longer than SLOW_QUERY_MS are logged as warnings whose fields (which
+the JSON log format writes out) hold the route of the request and the shapes
+(types and lengths) of the bound parameters, but never their values.
+"""
+import time
+import logging
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from service.metrics import operation
+
+logger = logging.getLogger("flask.app")
+
+# Longest statement text written to the slow query log
+MAX_STATEMENT_LENGTH = 2000
+
+
+class RequestQueries:
+    """ The statements run by one request """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.slowest = 0.0
+        self.slowest_operation = None
+
+    def add(self, name, seconds):
+        """ Adds a statement that took seconds to run """
+        self.count += 1
+        self.total += seconds
+        if self.slowest_operation is None or seconds > self.slowest:
+            self.slowest = seconds
+            self.slowest_operation = name
+
+    def server_timing(self):
+        """ Returns the statistics as the value of a Server-Timing header """
+        timing = 'db;dur={:.3f};desc="{} statement{}"'.format(
+            1000.0 * self.total, self.count, "" if self.count == 1 else "s"
+        )
+        if self.slowest_operation is not None:
+            timing += ', db-slowest;dur={:.3f};desc="{}"'.format(
+                1000.0 * self.slowest, self.slowest_operation
+            )
+        return timing
+
+
+def shape(value):
+    """Describes a bound parameter without giving its value away
+
+    :return: the type name, with the length of strings, e.g. "str[12]",
+        and the same for every item of a list, tuple or dictionary
+    """
+    if isinstance(value, dict):
+        return {key: shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [shape(item) for item in value]
+    if isinstance(value, (str, bytes)):
+        return "{}[{}]".format(type(value).__name__, len(value))
+    return type(value).__name__
+
+
+class QueryLog:
+    """ Records the statements of each request and logs the slow ones """
+
+    def __init__(self, slow_seconds=0.0):
+        """
+        :param slow_seconds: log statements that take at least this long, 0 for none
+        """
+        self.slow_seconds = slow_seconds
+
+    def started(self, conn, cursor, statement, parameters, context, executemany):
+        """ Notes when a statement started """
+        if context is not None:
+            context.querylog_started = time.perf_counter()
+
+    def finished(self, conn, cursor, statement, parameters, context, executemany):
+        """ Adds a statement to its request and logs it if it was slow """
+        started = getattr(context, "querylog_started", None)
+        if started is None:
+            return
+        seconds = time.perf_counter() - started
+        name = operation(statement)
+        in_request = has_request_context()
+        if in_request and g.get("queries") is not None:
+            g.queries.add(name, seconds)
+        if self.slow_seconds and seconds >= self.slow_seconds:
+            self.log_slow(statement, parameters, executemany, name, seconds, in_request)
+
+    @staticmethod
+    def log_slow(statement, parameters, executemany, name, seconds, in_request):
+        """ Writes a slow statement to the log with its details as fields """
+        if executemany:
+            parameters = {"rows": len(parameters), "each": shape(parameters[0]) if parameters else None}
+        else:
+            parameters = shape(parameters)
+        route = None
+        if in_request:
+            rule = request.url_rule.rule if request.url_rule is not None else request.path
+            route = "{} {}".format(request.method, rule)
+        duration_ms = round(1000.0 * seconds, 3)
+        logger.warning("Slow SQL statement: %s took %s ms", name, duration_ms, extra={"fields": {
+            "duration_ms": duration_ms,
+            "operation": name,
+            "route": route,
+            "statement": " ".join(statement.split())[:MAX_STATEMENT_LENGTH],
+            "parameters": parameters,
+        }})
+
+    def install(self):
+        """ Starts recording the statements of every engine """
+        if not event.contains(Engine, "before_cursor_execute", self.started):
+            event.listen(Engine, "before_cursor_execute", self.started)
+            event.listen(Engine, "after_cursor_execute", self.finished)
+
+
+# Shared by every engine of the process
+query_log = QueryLog()
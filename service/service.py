@@ -3,7 +3,7 @@ Customer Service
 
 PATHS:
 ------
-GET /customers - returns a list of all the Customers
+GET /customers - returns a page of the Customers (?limit=&after= to page through them)
 GET /customers/{id} - returns the Customer with a given id number
 POST /customers - creates a new Customer record in the database
 PUT /customers/{id} - updates a Customer record in the database
@@ -11,19 +11,42 @@ DELETE /customers/{id} - deletes a Customer record in the databse
 
 PUT /customers/{id}/suspend - suspend the Customer with the given id number
 
+POST /customers/bulk - creates many Customers from a JSON array or NDJSON body
+GET /customers/export - streams every Customer as NDJSON (one object per line)
+POST /customers:batchGet - returns the Customers with the given ids, keyed by id
+GET /customers/changes?since= - returns the creates, updates and deletes after a cursor
+GET /customers/stream - pushes every create, update, suspend and delete as Server-Sent Events
+GET /customers/search?q= - finds Customers by part of their names, email or address
+
+GET /metrics - request, database and cache metrics in the Prometheus text format
+
 """
 import sys
+import json
 import uuid
+import hmac
+import hashlib
 from functools import wraps
 from flask import Flask, jsonify, request, url_for, make_response, abort, render_template
+from flask import Response, stream_with_context, g
 from flask_api import status  # HTTP Status Codes
 from flask_restx import Api, Resource, fields, reqparse, inputs
-from werkzeug.exceptions import NotFound, PreconditionFailed
+from werkzeug.exceptions import Conflict, NotFound, PreconditionFailed, UnprocessableEntity
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+from werkzeug.urls import url_encode
+from werkzeug.http import http_date, quote_etag
+
+try:
+    import orjson  # much faster JSON encoding when it is installed
+except ImportError:  # pragma: no cover
+    orjson = None
 
 # For this example we'll use SQLAlchemy, a popular ORM that supports a
 # variety of backends including SQLite, MySQL, and PostgreSQL
 from flask_sqlalchemy import SQLAlchemy
-from service.models import Customer, DataValidationError
+from sqlalchemy.exc import InterfaceError, OperationalError, SQLAlchemyError, StatementError
+from service.models import Customer, CustomerChange, DataValidationError, VersionConflictError, db
+from service import database, idempotency, limits, metrics, querylog
 
 # Import Flask application
 from . import app
@@ -98,6 +121,36 @@ def mediatype_not_supported(error):  # pragma: no cover
     )
 
 
+@app.errorhandler(status.HTTP_429_TOO_MANY_REQUESTS)
+def too_many_requests(error):
+    """ Handles requests over the rate limit with 429_TOO_MANY_REQUESTS """
+    app.logger.warning(str(error))
+    return (
+        jsonify(
+            status=status.HTTP_429_TOO_MANY_REQUESTS,
+            error="Too Many Requests",
+            message=str(error),
+        ),
+        status.HTTP_429_TOO_MANY_REQUESTS,
+        {'Retry-After': str(error.retry_after)},
+    )
+
+
+@app.errorhandler(status.HTTP_503_SERVICE_UNAVAILABLE)
+def service_unavailable(error):
+    """ Handles requests that were shed with 503_SERVICE_UNAVAILABLE """
+    app.logger.warning(str(error))
+    return (
+        jsonify(
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            error="Service Unavailable",
+            message=str(error),
+        ),
+        status.HTTP_503_SERVICE_UNAVAILABLE,
+        {'Retry-After': str(error.retry_after)},
+    )
+
+
 @app.errorhandler(status.HTTP_500_INTERNAL_SERVER_ERROR)
 def internal_server_error(error):  # pragma: no cover
     """ Handles unexpected server error with 500_SERVER_ERROR """
@@ -112,6 +165,107 @@ def internal_server_error(error):  # pragma: no cover
     )
 
 
+######################################################################
+# Request metrics
+######################################################################
+@app.before_request
+def start_metrics():
+    """ Counts a request as in flight, before anything can refuse it """
+    g.metrics_in_flight = request.endpoint not in STREAMING_ENDPOINTS
+    g.metrics_started = metrics.request_started(g.metrics_in_flight)
+
+
+@app.after_request
+def record_metrics(response):
+    """ Counts and times a request by method, route and status """
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.request_finished(request.method, route, response.status_code, g.metrics_started)
+    return response
+
+
+@app.teardown_request
+def finish_metrics(exception=None):
+    """ Counts a request as no longer in flight """
+    in_flight = g.pop('metrics_in_flight', False)
+    if g.pop('metrics_started', None) is not None and in_flight:
+        metrics.request_closed()
+
+######################################################################
+# SQL statements per request
+######################################################################
+@app.before_request
+def start_queries():
+    """ Starts counting the SQL statements of a request """
+    g.queries = querylog.RequestQueries()
+
+
+@app.after_request
+def server_timing(response):
+    """ Tells the client how many statements its request ran and how long they took """
+    queries = g.pop('queries', None)
+    if queries is not None and app.config['SERVER_TIMING']:
+        response.headers.add('Server-Timing', queries.server_timing())
+    return response
+
+######################################################################
+# Read consistency
+######################################################################
+@app.before_request
+def read_consistency():
+    """ Sends the reads of a request to the primary if it asks for strong consistency """
+    g.read_primary = request.headers.get('X-Read-Consistency', '').lower() == 'strong'
+
+######################################################################
+# Rate limiting and load shedding
+######################################################################
+# The home page, static files, statistics and metrics are never limited
+UNLIMITED_ENDPOINTS = {'index', 'static', 'cache_stats', 'group_commit_stats', 'metrics_endpoint'}
+# Streams stay open for minutes or hours, so they are rate limited but not
+# counted as in flight: a few idle subscribers would otherwise shed everything
+STREAMING_ENDPOINTS = {'event_stream', 'export_collection'}
+
+
+@app.before_request
+def limit_requests():
+    """ Refuses requests over their rate limit, or all of them when overloaded """
+    g.in_flight = False
+    if request.url_rule is None or request.endpoint in UNLIMITED_ENDPOINTS:
+        return
+    if rate_limiter is not None:
+        client = rate_limit_client()
+        route = '{} {}'.format(request.method, request.url_rule.rule)
+        wait = rate_limiter.check(client, route)
+        if wait:
+            raise TooManyRequests("Rate limit exceeded for " + route,
+                                  retry_after=limits.retry_after(wait))
+    if load_shedder is not None and request.endpoint not in STREAMING_ENDPOINTS:
+        reason = load_shedder.enter()
+        if reason:
+            raise ServiceUnavailable("Try again later, " + reason, retry_after=1)
+        g.in_flight = True
+
+
+def rate_limit_client():
+    """
+    Returns who a request is rate limited as
+
+    That is its API key if it is the configured one, and its address
+    otherwise, so that making up a new key for every request neither gets
+    a fresh bucket nor evicts the buckets of other clients.
+    """
+    key = request.headers.get('X-Api-Key')
+    if key and app.config['API_KEY'] and hmac.compare_digest(key, app.config['API_KEY']):
+        return 'key ' + key
+    return 'address {}'.format(request.remote_addr)
+
+
+@app.teardown_request
+def finish_request(exception=None):
+    """ Counts a request that was let in as no longer in flight """
+    if g.get('in_flight'):
+        g.in_flight = False
+        load_shedder.leave()
+
 ######################################################################
 # GET INDEX
 ######################################################################
@@ -120,6 +274,33 @@ def index():
     """ Root URL response """
     return app.send_static_file('index.html')
 
+######################################################################
+# GET CACHE STATISTICS
+######################################################################
+@app.route("/cache/stats")
+def cache_stats():
+    """ Returns the hit, miss and eviction counters of the Customer cache """
+    return jsonify(Customer.cache.stats()), status.HTTP_200_OK
+
+######################################################################
+# GET GROUP COMMIT STATISTICS
+######################################################################
+@app.route("/group-commit/stats")
+def group_commit_stats():
+    """ Returns the batch size and wait statistics of group commit """
+    if Customer.group_commit is None:
+        return jsonify(enabled=False), status.HTTP_200_OK
+    return jsonify(enabled=True, **Customer.group_commit.stats()), status.HTTP_200_OK
+
+######################################################################
+# GET METRICS
+######################################################################
+@app.route("/metrics")
+def metrics_endpoint():
+    """ Returns the metrics of every worker in the Prometheus text format """
+    body, content_type = metrics.render()
+    return Response(body, status=status.HTTP_200_OK, content_type=content_type)
+
 ######################################################################
 # Configure Swagger before initializing it
 ######################################################################
@@ -156,6 +337,14 @@ customer_model = api.inherit(
     }
 )
 
+batch_get_model = api.model('BatchGet', {
+    'ids': fields.List(fields.Integer, required=True,
+                       description='The ids of the Customers to return'),
+})
+
+# The fields of a Customer in the order they are returned
+CUSTOMER_FIELDS = list(customer_model.resolved)
+
 # query string arguments
 customer_args = reqparse.RequestParser()
 customer_args.add_argument('first_name', type=str, required=False, help='List Customers by first name')
@@ -163,6 +352,19 @@ customer_args.add_argument('last_name', type=str, required=False, help='List Cus
 customer_args.add_argument('email', type=str, required=False, help='List Customers by email')
 customer_args.add_argument('address', type=str, required=False, help='List Customers by address')
 customer_args.add_argument('active', type=str, required=False, help='List Customers by availability')
+customer_args.add_argument('limit', type=int, required=False, help='Maximum number of Customers per page')
+customer_args.add_argument('after', type=int, required=False, help='Cursor: only list Customers with a greater id')
+customer_args.add_argument('fields', type=str, required=False, help='Comma separated fields to return, e.g. id,email')
+
+changes_args = reqparse.RequestParser()
+changes_args.add_argument('since', type=int, required=False, help='Cursor: the X-Next-Cursor of the previous call, 0 for the start')
+changes_args.add_argument('limit', type=int, required=False, help='Maximum number of changes per call')
+
+search_args = reqparse.RequestParser()
+search_args.add_argument('q', type=str, required=True, help='Text to find in the names, email or address')
+search_args.add_argument('limit', type=int, required=False, help='Maximum number of Customers per page')
+search_args.add_argument('after', type=str, required=False, help='Cursor: the X-Next-Cursor of the previous page')
+search_args.add_argument('fields', type=str, required=False, help='Comma separated fields to return, e.g. id,email')
 
 ######################################################################
 # Function to generate a random API key (good for testing)
@@ -176,8 +378,215 @@ def generate_apikey():
 ######################################################################
 def init_db():
     """ Initialies the SQLAlchemy app """
-    global app
+    global app, idempotency_store, rate_limiter, load_shedder
     Customer.init_db(app)
+    metrics.install()
+    metrics.instrument_cache(Customer.cache)
+    querylog.query_log.slow_seconds = app.config['SLOW_QUERY_MS'] / 1000.0
+    querylog.query_log.install()
+    idempotency_store = idempotency.make_store(app.config, db.engine)
+    rate_limiter = limits.RateLimiter(
+        app.config['RATE_LIMIT_PER_SECOND'],
+        app.config['RATE_LIMIT_BURST'],
+        limits.parse_routes(app.config['RATE_LIMIT_ROUTES']),
+    )
+    load_shedder = limits.LoadShedder(
+        app.config['SHED_MAX_IN_FLIGHT'],
+        app.config['SHED_MAX_POOL_WAIT_MS'] / 1000.0,
+        database.pool_wait.current,
+    )
+
+
+# Where the responses of requests with an Idempotency-Key are kept
+idempotency_store = None
+# Token buckets per API key and route, and the count of requests in flight
+rate_limiter = None
+load_shedder = None
+
+
+def filter_args(args):
+    """
+    Builds the Customer filters from the query parameters
+
+    A repeated parameter matches any of its values and a value ending in "*"
+    matches by prefix, e.g. ?last_name=Smith&last_name=Jo*&active=true
+    """
+    filters = {}
+    for name in Customer.FILTERS:
+        values = [value for value in args.getlist(name) if value]
+        if not values:
+            continue
+        if name == 'active':
+            try:
+                values = [inputs.boolean(value) for value in values]
+            except ValueError as error:
+                api.abort(status.HTTP_400_BAD_REQUEST, str(error))
+        filters[name] = values if len(values) > 1 else values[0]
+    return filters
+
+
+def fields_arg(args):
+    """ Parses the fields query parameter into the list of fields to return """
+    if not args.get('fields'):
+        return None
+    names = [name.strip() for name in args['fields'].split(',') if name.strip()]
+    unknown = [name for name in names if name not in customer_model.resolved]
+    if unknown:
+        api.abort(status.HTTP_400_BAD_REQUEST, "Unknown fields: {}".format(", ".join(unknown)))
+    return names
+
+
+def limit_arg(args):
+    """ Parses the limit query parameter used for pagination """
+    try:
+        limit = int(args['limit']) if args.get('limit') else None
+    except ValueError:
+        api.abort(status.HTTP_400_BAD_REQUEST, "limit must be an integer")
+    if limit is not None and limit < 1:
+        api.abort(status.HTTP_400_BAD_REQUEST, "limit must be positive")
+    return limit
+
+
+def page_args(args):
+    """ Parses the limit and after query parameters used for pagination """
+    limit = limit_arg(args)
+    try:
+        after = int(args['after']) if args.get('after') else None
+    except ValueError:
+        api.abort(status.HTTP_400_BAD_REQUEST, "after must be an integer")
+    if after is not None and after < 0:
+        api.abort(status.HTTP_400_BAD_REQUEST, "after must be positive")
+    return limit, after
+
+
+def is_customer_id(value):
+    """ Returns True for an integer or a string of digits, but not for a bool or a float """
+    if isinstance(value, bool):
+        return False
+    return isinstance(value, int) or (isinstance(value, str) and value.isdecimal())
+
+
+def page_headers(args, limit, next_cursor):
+    """ Builds the Link and X-Next-Cursor headers for the next page """
+    if next_cursor is None:
+        return {}
+    next_args = args.copy()
+    next_args['after'] = next_cursor
+    if limit:
+        next_args['limit'] = limit
+    next_url = "{}?{}".format(request.base_url, url_encode(next_args))
+    return {
+        'Link': '<{}>; rel="next"'.format(next_url),
+        'X-Next-Cursor': str(next_cursor),
+    }
+
+
+def dumps(data):
+    """ Encodes data as compact JSON bytes, with orjson when it is installed """
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+def row_formatter(names):
+    """
+    Returns a function that turns a database row into a Customer dictionary
+
+    The output is the same as marshalling the row with customer_model (the id
+    becomes a string and active a boolean) without going through a
+    Flask-RESTX field for every value of every row.
+    """
+    def as_string(value):
+        return None if value is None else str(value)
+
+    def as_boolean(value):
+        return None if value is None else bool(value)
+
+    converters = {'id': as_string, 'active': as_boolean}
+    pairs = [(name, converters.get(name)) for name in names]
+
+    def format_row(row):
+        return {
+            name: convert(row[name]) if convert else row[name]
+            for name, convert in pairs
+        }
+
+    return format_row
+
+
+def json_response(body, code, headers=None):
+    """ Wraps already encoded JSON bytes in a response """
+    return app.response_class(body, status=code, headers=headers, mimetype='application/json')
+
+
+def expected_version(customer_id):
+    """
+    Returns the version of the Customer named by the If-Match header
+
+    None means that the write is unconditional. An If-Match that does not name
+    a version of this Customer fails with 412 Precondition Failed.
+    """
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    for etag in request.if_match:
+        etag_id, _, version = etag.partition("-")
+        if etag_id == str(customer_id) and version.isdigit():
+            return int(version)
+    raise PreconditionFailed("If-Match does not name a version of this Customer")
+
+
+def collection_etag(customers, fields=None):
+    """ Returns an entity tag for a list of Customers from their ids and versions """
+    versions = ",".join("{}-{}".format(c.id, c.version) for c in customers)
+    if fields:
+        versions += ";" + ",".join(fields)
+    return hashlib.sha1(versions.encode("utf-8")).hexdigest()
+
+
+def validator_headers(etag, modified):
+    """ Builds the ETag and Last-Modified headers of a response """
+    headers = {'ETag': quote_etag(etag)}
+    if modified:
+        headers['Last-Modified'] = http_date(modified)
+    return headers
+
+
+def not_modified(etag, modified):
+    """
+    Checks the If-None-Match and If-Modified-Since headers of the request
+
+    Returns True if the client already has the current representation, in
+    which case it should get a 304 without the body being serialized.
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if modified and request.if_modified_since:
+        return modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def bulk_items():
+    """
+    Yields the posted Customers for a bulk create
+
+    The body is either a JSON array or, with Content-Type application/x-ndjson,
+    one JSON object per line which is read as it streams in. A line that is not
+    valid JSON is yielded as None so that it is reported as invalid.
+    """
+    if request.mimetype == 'application/x-ndjson':
+        for line in request.stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+        return
+    items = request.get_json()
+    if not isinstance(items, list):
+        api.abort(status.HTTP_400_BAD_REQUEST, "Body must be a JSON array of Customers")
+    yield from items
 
 
 def check_content_type(content_type):  # pragma: no cover
@@ -187,6 +596,47 @@ def check_content_type(content_type):  # pragma: no cover
     app.logger.error("Invalid Content-Type: %s", request.headers["Content-Type"])
     abort(415, "Content-Type must be {}".format(content_type))
 
+
+def idempotent(function):
+    """
+    Replays the stored response when a request repeats its Idempotency-Key
+
+    The first request with a key runs and its response is stored. A retry
+    with the same key and body gets the stored response, marked with
+    Idempotent-Replayed: true, without running again. A key that is reused
+    for another body is refused with 422, and a retry that arrives while the
+    first request is still running gets 409. A request that fails does not
+    keep its key, so it can be retried.
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key or idempotency_store is None:
+            return function(*args, **kwargs)
+        if len(key) > 255:
+            api.abort(status.HTTP_400_BAD_REQUEST, "Idempotency-Key must be at most 255 characters")
+        # keys are chosen by clients, so one client cannot replay another's
+        client = hashlib.sha256(request.headers.get('X-Api-Key', '').encode('utf-8')).hexdigest()
+        key = "{}:{}".format(client[:32], key)
+        digest = idempotency.fingerprint(request.method, request.path, request.get_data())
+        record = idempotency_store.begin(key, digest)
+        if record is not None:
+            if record.fingerprint != digest:
+                raise UnprocessableEntity("Idempotency-Key was already used for a different request")
+            if record.response is None:
+                raise Conflict("A request with this Idempotency-Key is still being processed")
+            app.logger.info('Replaying the response for Idempotency-Key %s', key)
+            headers = dict(record.response['headers'], **{'Idempotent-Replayed': 'true'})
+            return record.response['body'], record.response['status'], headers
+        try:
+            body, code, headers = function(*args, **kwargs)
+        except Exception:
+            idempotency_store.release(key)
+            raise
+        idempotency_store.complete(key, digest, {'body': body, 'status': code, 'headers': headers})
+        return body, code, headers
+    return wrapper
+
 @api.route('/customers/<customer_id>')
 @api.param('customer_id', 'The Customer identifier')
 class CustomerResource(Resource):
@@ -202,6 +652,7 @@ class CustomerResource(Resource):
     # RETRIEVE A CUSTOMER
     #------------------------------------------------------------------
     @api.doc('get_customers')
+    @api.response(304, 'Customer not modified')
     @api.response(404, 'Customer not found')
     @api.marshal_with(customer_model)
     def get(self, customer_id):
@@ -213,88 +664,107 @@ class CustomerResource(Resource):
         customer = Customer.find(customer_id)
         if not customer:
             raise NotFound("404 Not Found: Customer with the id was not found.")
-        return customer.serialize(), status.HTTP_200_OK
+        headers = validator_headers(customer.etag(), customer.updated_at)
+        if not_modified(customer.etag(), customer.updated_at):
+            return {}, status.HTTP_304_NOT_MODIFIED, headers
+        return customer.serialize(), status.HTTP_200_OK, headers
 
     #------------------------------------------------------------------
     # DELETE A CUSTOMER
     #------------------------------------------------------------------
     @api.doc('delete_customers', security='apikey')
     @api.response(204, 'Customer deleted')
+    @api.response(412, 'Customer is not at the version named by If-Match')
     def delete(self, customer_id):
         """
         Delete a Customer
         This endpoint will delete a Customer based the id specified in the path
         """
         app.logger.info('Request to Delete a customer with id [%s]', customer_id)
-        customer = Customer.find(customer_id)
-        if customer:
-            customer.delete()
+        try:
+            Customer.delete_by_id(customer_id, expected_version(customer_id))
+        except VersionConflictError as error:
+            raise PreconditionFailed(str(error))
         return '', status.HTTP_204_NO_CONTENT
     # UPDATE AN EXISTING CUSTOMER
     #------------------------------------------------------------------
     @api.doc('update_customers', security='apikey')
     @api.response(404, 'Customer not found')
     @api.response(400, 'The posted Customer data was not valid')
+    @api.response(412, 'Customer is not at the version named by If-Match')
     @api.expect(customer_model)
     @api.marshal_with(customer_model)
     def put(self, customer_id):
         """
         Update a Customer
-        This endpoint will update a Customer based the body that is posted
+        This endpoint will update a Customer based the body that is posted.
+        Send the ETag of the Customer as If-Match to only update the version
+        that was read.
         """
         app.logger.info('Request to Update a customer with id [%s]', customer_id)
-        customer = Customer.find(customer_id)
-        if not customer:
-            api.abort(status.HTTP_404_NOT_FOUND, "Customer with id '{}' was not found.".format(customer_id))
         app.logger.debug('Payload = %s', api.payload)
         data = api.payload
-        customer.deserialize(data)
-        customer.id = customer_id
-        customer.save()
-        return customer.serialize(), status.HTTP_200_OK
+        values = Customer().deserialize(data).validate().row_values()
+        try:
+            customer = Customer.update_by_id(customer_id, values, expected_version(customer_id))
+        except VersionConflictError as error:
+            raise PreconditionFailed(str(error))
+        if not customer:
+            api.abort(status.HTTP_404_NOT_FOUND, "Customer with id '{}' was not found.".format(customer_id))
+        return customer.serialize(), status.HTTP_200_OK, {'ETag': quote_etag(customer.etag())}
 
 ######################################################################
 #  PATH: /customers
 ######################################################################
 @api.route('/customers', strict_slashes=False)
 class CustomerCollection(Resource):
-    """ Handles all interactions with collections of Customers """
+    """
+    Handles all interactions with collections of Customers
+
+    Lists are paged by id: at most PAGE_SIZE_MAX Customers are returned per
+    request and the Link header points at the next page
+    """
     #------------------------------------------------------------------
     # LIST ALL CUSTOMERS
     #------------------------------------------------------------------
     @api.doc('list_customers')
     @api.expect(customer_args, validate=False)
-    @api.marshal_list_with(customer_model)
+    @api.response(200, 'Success', [customer_model])
+    @api.response(304, 'Customers not modified')
     def get(self):
-        """ Returns all of the Customers unless a query parameter is specified """
+        """
+        Returns all of the Customers unless a query parameter is specified
+
+        Every filter that is given must match: repeat a parameter to match
+        any of its values, or end a value with * to match by prefix. Use
+        fields to only return some of the fields of each Customer.
+        """
         app.logger.info('Request to list Customers...')
-        customers = []
-        app.logger.info("First time")
         # args = customer_args.parse_args()
         # change to request args to by pass the odd bug for reqparse
         args = request.args
-        app.logger.info("Second time %s", args)
-        if args.get('last_name'):
-            app.logger.info('Filtering by last name: %s', args['last_name'])
-            customers = Customer.find_by_last_name(args['last_name'])
-        elif args.get('first_name'):
-            app.logger.info('Filtering by first name: %s', args['first_name'])
-            customers = Customer.find_by_first_name(args['first_name'])
-        elif args.get('email'):
-            app.logger.info('Filtering by email: %s', args['email'])
-            customers = Customer.find_by_email(args['email'])
-        elif args.get('address'):
-            app.logger.info('Filtering by address: %s', args['address'])
-            customers = Customer.find_by_address(args['address'])
-        elif args.get('active'):
-            app.logger.info('Filtering by active: %s', args['active'])
-            customers = Customer.find_by_active(args['active'])
-        else:
-            customers = Customer.all()
-
-        results = [customer.serialize() for customer in customers]
+        limit, after = page_args(args)
+        fields = fields_arg(args)
+        filters = filter_args(args)
+        if filters:
+            app.logger.info('Filtering by: %s', filters)
+        customers = Customer.find_by_filters(filters)
+
+        # Read plain rows with SQLAlchemy Core and encode them straight to
+        # JSON, without ORM instances or Flask-RESTX marshalling
+        names = fields or CUSTOMER_FIELDS
+        customers, next_cursor = Customer.paginate(customers, limit, after, names)
+        etag = collection_etag(customers, fields)
+        headers = page_headers(args, limit, next_cursor)
+        # no Last-Modified: deleting the newest Customer makes the date of
+        # the page go back, and If-Modified-Since would then answer 304
+        headers.update(validator_headers(etag, None))
+        if not_modified(etag, None):
+            return json_response(b'', status.HTTP_304_NOT_MODIFIED, headers)
+        format_row = row_formatter(names)
+        results = [format_row(customer) for customer in customers]
         app.logger.info('[%s] Customers returned', len(results))
-        return results, status.HTTP_200_OK
+        return json_response(dumps(results), status.HTTP_200_OK, headers)
 
     #------------------------------------------------------------------
     # ADD A NEW CUSTOMER
@@ -303,11 +773,16 @@ class CustomerCollection(Resource):
     @api.expect(create_model)
     @api.response(400, 'The posted data was not valid')
     @api.response(201, 'Customer created successfully')
+    @api.response(409, 'A request with the same Idempotency-Key is still being processed')
+    @api.response(422, 'The Idempotency-Key was used for a different request')
+    @api.header('Idempotency-Key', 'Makes retries safe: a repeat gets the first response back')
     @api.marshal_with(customer_model, code=201)
+    @idempotent
     def post(self):
         """
         Creates a Customer
-        This endpoint will create a Customer based the data in the body that is posted
+        This endpoint will create a Customer based the data in the body that is posted.
+        Send an Idempotency-Key to be able to retry without creating it twice.
         """
         app.logger.info('Request to Create a Customer')
         customer = Customer()
@@ -318,6 +793,316 @@ class CustomerCollection(Resource):
         location_url = api.url_for(CustomerResource, customer_id=customer.id, _external=True)
         return customer.serialize(), status.HTTP_201_CREATED, {'Location': location_url}
 
+######################################################################
+#  PATH: /customers/export
+######################################################################
+@api.route('/customers/export')
+class ExportCollection(Resource):
+    """ Streams the whole collection of Customers """
+    #------------------------------------------------------------------
+    # EXPORT ALL CUSTOMERS
+    #------------------------------------------------------------------
+    @api.doc('export_customers')
+    @api.expect(customer_args, validate=False)
+    @api.produces(['application/x-ndjson'])
+    @api.response(200, 'One Customer per line')
+    def get(self):
+        """
+        Exports all of the Customers as NDJSON
+        The rows are written to the response as they are read from the
+        database, so the size of the table does not matter. The same filters
+        as the list of Customers can be used.
+        """
+        app.logger.info('Request to Export Customers')
+        filters = filter_args(request.args)
+        rows = Customer.stream(Customer.find_by_filters(filters), CUSTOMER_FIELDS)
+        format_row = row_formatter(CUSTOMER_FIELDS)
+
+        def generate():
+            for row in rows:
+                yield dumps(format_row(row)) + b"\n"
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+######################################################################
+#  PATH: /customers:batchGet
+######################################################################
+@api.route('/customers:batchGet')
+class BatchGetCollection(Resource):
+    """ Looks up many Customers by id at once """
+    #------------------------------------------------------------------
+    # RETRIEVE MANY CUSTOMERS
+    #------------------------------------------------------------------
+    @api.doc('batch_get_customers')
+    @api.expect(batch_get_model)
+    @api.response(200, 'Every id with its Customer, or null if it was not found')
+    @api.response(400, 'The ids were not a list of integers or there were too many')
+    def post(self):
+        """
+        Retrieve many Customers
+        This endpoint takes {"ids": [...]} and returns {"customers": {...},
+        "not_found": [...]}, where customers maps every requested id to its
+        Customer or to null. All of the ids are read with a single query.
+        """
+        ids = (request.get_json(silent=True) or {}).get('ids')
+        if not isinstance(ids, list):
+            api.abort(status.HTTP_400_BAD_REQUEST, 'The body must be {"ids": [...]}')
+        max_ids = app.config['BATCH_GET_MAX_IDS']
+        if len(ids) > max_ids:
+            api.abort(status.HTTP_400_BAD_REQUEST,
+                      'Only {} Customers can be retrieved per request'.format(max_ids))
+        if not all(is_customer_id(customer_id) for customer_id in ids):
+            api.abort(status.HTTP_400_BAD_REQUEST, 'Every id must be an integer')
+        ids = [int(customer_id) for customer_id in ids]
+        app.logger.info('Request to Retrieve [%s] Customers', len(ids))
+        format_row = row_formatter(CUSTOMER_FIELDS)
+        customers = {}
+        not_found = []
+        for customer_id, entry in Customer.find_many(ids).items():
+            customers[str(customer_id)] = None if entry is None else format_row(entry)
+            if entry is None:
+                not_found.append(str(customer_id))
+        body = {'customers': customers, 'not_found': not_found}
+        return json_response(dumps(body), status.HTTP_200_OK)
+
+
+######################################################################
+#  PATH: /customers/changes
+######################################################################
+@api.route('/customers/changes')
+class ChangeFeed(Resource):
+    """ The creates, updates and deletes of Customers in the order they happened """
+    #------------------------------------------------------------------
+    # LIST CHANGES
+    #------------------------------------------------------------------
+    @api.doc('list_customer_changes')
+    @api.expect(changes_args, validate=False)
+    @api.response(200, 'Success')
+    @api.response(400, 'since or limit was not valid')
+    def get(self):
+        """
+        Returns the changes since a cursor
+        Each change has its seq, the id of the Customer, the op (create,
+        update or delete), when it happened, and the Customer as it is now,
+        or null once it is deleted. Pass the X-Next-Cursor header back as
+        since to get only the changes that came after.
+        """
+        args = request.args
+        limit = limit_arg(args)
+        try:
+            since = int(args.get('since') or 0)
+        except ValueError:
+            api.abort(status.HTTP_400_BAD_REQUEST, "since must be an integer")
+        app.logger.info('Request for Customer changes since [%s]', since)
+        changes, more = CustomerChange.since(since, limit)
+        format_row = row_formatter(CUSTOMER_FIELDS)
+        results = [
+            {
+                'seq': change.seq,
+                'id': str(change.customer_id),
+                'op': change.op,
+                'changed_at': change.changed_at.isoformat(),
+                'customer': None if change.id is None else format_row(change),
+            }
+            for change in changes
+        ]
+        cursor = changes[-1].seq if changes else since
+        headers = {}
+        if more:
+            next_args = args.copy()
+            next_args['since'] = cursor
+            headers['Link'] = '<{}?{}>; rel="next"'.format(request.base_url, url_encode(next_args))
+        headers['X-Next-Cursor'] = str(cursor)
+        app.logger.info('[%s] Customer changes returned', len(results))
+        return json_response(dumps(results), status.HTTP_200_OK, headers)
+
+
+######################################################################
+#  PATH: /customers/stream
+######################################################################
+@api.route('/customers/stream')
+class EventStream(Resource):
+    """ Pushes the writes to Customers to the client as they happen """
+    #------------------------------------------------------------------
+    # STREAM CHANGES
+    #------------------------------------------------------------------
+    @api.doc('stream_customer_events')
+    @api.produces(['text/event-stream'])
+    @api.response(200, 'One event per write')
+    @api.response(503, 'Too many streams are open, try again after Retry-After seconds')
+    def get(self):
+        """
+        Streams the writes to Customers as Server-Sent Events
+        Each event is named after its op (create, update, suspend or
+        delete) and its data is {"op", "id", "customer"}, where customer is
+        null after a delete. A client that falls too far behind gets an
+        overflow event with the number of events it missed, and should catch
+        up from /customers/changes.
+        """
+        app.logger.info('Request to Stream Customer events')
+        heartbeat = app.config['EVENTS_HEARTBEAT_SECONDS']
+        subscription = Customer.events.subscribe()
+        if subscription is None:
+            # every open stream holds a worker thread, keep some for the rest
+            raise ServiceUnavailable('Too many open event streams, try again later',
+                                     retry_after=limits.retry_after(heartbeat))
+        format_row = row_formatter(CUSTOMER_FIELDS)
+
+        def generate():
+            yield b': connected\n\n'
+            while True:
+                event = subscription.get(timeout=heartbeat)
+                dropped = subscription.take_dropped()
+                if dropped:
+                    yield b'event: overflow\ndata: ' + dumps({'dropped': dropped}) + b'\n\n'
+                if event is None:
+                    # a comment keeps proxies from closing an idle stream
+                    yield b': keepalive\n\n'
+                    continue
+                if event['customer'] is not None:
+                    event = dict(event, customer=format_row(event['customer']))
+                event = dict(event, id=str(event['id']))
+                yield 'event: {}\ndata: '.format(event['op']).encode() + dumps(event) + b'\n\n'
+
+        response = Response(generate(), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        response.call_on_close(lambda: Customer.events.unsubscribe(subscription))
+        return response
+
+
+######################################################################
+#  PATH: /customers/search
+######################################################################
+@api.route('/customers/search')
+class SearchCollection(Resource):
+    """ Finds Customers by part of their names, email or address """
+    #------------------------------------------------------------------
+    # SEARCH CUSTOMERS
+    #------------------------------------------------------------------
+    @api.doc('search_customers')
+    @api.expect(search_args, validate=False)
+    @api.response(200, 'Success', [customer_model])
+    @api.response(400, 'The search term or cursor was not valid')
+    def get(self):
+        """
+        Searches the Customers
+        Returns the Customers whose first name, last name, email or address
+        contains q, ignoring case. Exact matches come first, then the values
+        that start with q. Terms of one or two characters only match the
+        start of a value. Follow the Link header for the next page.
+        """
+        args = request.args
+        app.logger.info('Request to Search Customers for %s', args.get('q'))
+        limit = limit_arg(args)
+        fields = fields_arg(args)
+        names = fields or CUSTOMER_FIELDS
+        customers, next_cursor = Customer.search(args.get('q'), limit, args.get('after'), names)
+        format_row = row_formatter(names)
+        results = [format_row(customer) for customer in customers]
+        app.logger.info('[%s] Customers found', len(results))
+        headers = page_headers(args, limit, next_cursor)
+        return json_response(dumps(results), status.HTTP_200_OK, headers)
+
+
+######################################################################
+#  PATH: /customers/bulk
+######################################################################
+@api.route('/customers/bulk')
+class BulkCollection(Resource):
+    """ Creates many Customers in a single request """
+    #------------------------------------------------------------------
+    # ADD MANY NEW CUSTOMERS
+    #------------------------------------------------------------------
+    @api.doc('bulk_create_customers', security='apikey')
+    @api.expect([create_model])
+    @api.response(201, 'All of the Customers were created')
+    @api.response(207, 'Some of the Customers were not valid or not created')
+    def post(self):
+        """
+        Creates many Customers
+        This endpoint takes a JSON array of Customers, or one Customer per line
+        as application/x-ndjson, and returns the result of each one in order
+        """
+        app.logger.info('Request to Bulk Create Customers')
+        batch_size = app.config['BULK_BATCH_SIZE']
+        max_items = app.config['BULK_MAX_ITEMS']
+        results = []
+        batch = []
+        for index, data in enumerate(bulk_items()):
+            if index >= max_items:
+                # the rest of the body is not read
+                results.append({
+                    'index': index,
+                    'status': status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                    'error': 'Only {} Customers can be created per request, '
+                             'this one and the rest were not read'.format(max_items),
+                })
+                break
+            try:
+                customer = Customer().deserialize(data)
+            except DataValidationError as error:
+                results.append({'index': index, 'status': status.HTTP_400_BAD_REQUEST,
+                                'error': str(error)})
+                continue
+            results.append({'index': index, 'status': status.HTTP_201_CREATED})
+            batch.append((results[-1], customer))
+            if len(batch) >= batch_size:
+                self.create_batch(batch)
+                batch = []
+        if batch:
+            self.create_batch(batch)
+        created = sum(1 for result in results if result['status'] == status.HTTP_201_CREATED)
+        app.logger.info('[%s] of [%s] Customers created', created, len(results))
+        code = status.HTTP_201_CREATED if created == len(results) else status.HTTP_207_MULTI_STATUS
+        return {'created': created, 'failed': len(results) - created, 'results': results}, code
+
+    @staticmethod
+    def create_batch(batch):
+        """Inserts a batch of Customers and records their new ids
+
+        If the batch fails, which rolls all of it back, its Customers are
+        retried one by one so that a single bad row only fails itself. Once
+        the database cannot be reached, the rest of the batch is not tried.
+        """
+        try:
+            Customer.create_many([customer for _, customer in batch])
+        except SQLAlchemyError as error:
+            db.session.rollback()
+            app.logger.warning('Bulk create of %s Customers failed, retrying one by one: %s',
+                               len(batch), error)
+            BulkCollection.create_one_by_one(batch)
+            return
+        for result, customer in batch:
+            result['id'] = customer.id
+
+    @staticmethod
+    def create_one_by_one(batch):
+        """ Inserts the Customers of a failed batch one at a time """
+        unavailable = False
+        for result, customer in batch:
+            if unavailable:
+                result['status'] = status.HTTP_503_SERVICE_UNAVAILABLE
+                result['error'] = 'Not created, the database could not be reached'
+                continue
+            try:
+                Customer.create_many([customer])
+                result['id'] = customer.id
+            except SQLAlchemyError as error:
+                db.session.rollback()
+                if isinstance(error, (OperationalError, InterfaceError)) or \
+                        getattr(error, 'connection_invalidated', False):
+                    unavailable = True
+                    result['status'] = status.HTTP_503_SERVICE_UNAVAILABLE
+                elif isinstance(error, StatementError):
+                    # the database or the driver rejected the values of this row
+                    result['status'] = status.HTTP_400_BAD_REQUEST
+                else:
+                    result['status'] = status.HTTP_500_INTERNAL_SERVER_ERROR
+                result['error'] = str(getattr(error, 'orig', None) or error)
+
+
 ######################################################################
 #  PATH: /customers/{customer_id}/suspend
 ######################################################################
@@ -327,6 +1112,7 @@ class SuspendResource(Resource):
     """ Suspend Action on a Customer"""
     @api.doc('suspend_customers')
     @api.response(404, 'Customer not found')
+    @api.response(412, 'Customer is not at the version named by If-Match')
     @api.response(200, 'Success - action completed')
     def put(self, customer_id):
         """
@@ -334,11 +1120,14 @@ class SuspendResource(Resource):
         This endpoint will suspend a customer based on its ID
         """
         app.logger.info("Request to suspend customer with id: %s", customer_id)
-        customer = Customer.find(customer_id)
+        try:
+            customer = Customer.update_by_id(
+                customer_id, {"active": False}, expected_version(customer_id), op="suspend"
+            )
+        except VersionConflictError as error:
+            raise PreconditionFailed(str(error))
         if not customer:
             raise NotFound("Cus...tomer with id '{}' was not found.".format(customer_id))
-        customer.active = False
-        customer.update()
         app.logger.info("Customer with ID [%s] suspended.", customer.id)
-        return customer.serialize(), status.HTTP_200_OK 
+        return customer.serialize(), status.HTTP_200_OK, {'ETag': quote_etag(customer.etag())}
     
@@ -0,0 +1,202 @@
+"""
+Synthetic customers at production scale
+
+CustomerGenerator makes as many realistic customers as you like for scale
+testing. The same seed always gives the same customers. Last names follow a
+Zipf distribution, so a few of them are very common and most are rare, the
+way they are in real data. Every email is unique, and a given share of the
+customers is active. The customers are streamed, so millions of them never
+have to fit in memory. They can be inserted straight into the database in
+batches, or written to NDJSON or CSV files:
+
+    python -m tests.customer_generator --count 1000000 --to db
+    python -m tests.customer_generator --count 1000000 --to ndjson --output customers.ndjson
+
+A file made with --to ndjson can be posted to /customers/bulk as is. Only
+--to db imports the service, so files can be made without a database.
+"""
+import sys
+import csv
+import json
+import bisect
+import random
+import argparse
+import itertools
+
+# The fields of a generated customer, in the order of the CSV columns
+FIELDS = ("first_name", "last_name", "email", "address", "active")
+
+FIRST_NAMES = (
+    "James", "Mary", "Robert", "Patricia", "John", "Jennifer", "Michael", "Linda",
+    "David", "Elizabeth", "William", "Barbara", "Richard", "Susan", "Joseph", "Jessica",
+    "Thomas", "Sarah", "Christopher", "Karen", "Charles", "Lisa", "Daniel", "Nancy",
+    "Matthew", "Betty", "Anthony", "Sandra", "Mark", "Margaret", "Donald", "Ashley",
+    "Steven", "Kimberly", "Andrew", "Emily", "Paul", "Donna", "Joshua", "Michelle",
+    "Kenneth", "Carol", "Kevin", "Amanda", "Brian", "Melissa", "George", "Deborah",
+    "Wei", "Priya", "Mohammed", "Sofia", "Hiroshi", "Fatima", "Juan", "Olga",
+)
+
+# Ordered from the most to the least common, which is the rank used by Zipf
+LAST_NAMES = (
+    "Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis",
+    "Rodriguez", "Martinez", "Hernandez", "Lopez", "Gonzalez", "Wilson", "Anderson",
+    "Thomas", "Taylor", "Moore", "Jackson", "Martin", "Lee", "Perez", "Thompson",
+    "White", "Harris", "Sanchez", "Clark", "Ramirez", "Lewis", "Robinson", "Walker",
+    "Young", "Allen", "King", "Wright", "Scott", "Torres", "Nguyen", "Hill", "Flores",
+    "Green", "Adams", "Nelson", "Baker", "Hall", "Rivera", "Campbell", "Mitchell",
+    "Carter", "Roberts", "Gomez", "Phillips", "Evans", "Turner", "Diaz", "Parker",
+    "Cruz", "Edwards", "Collins", "Reyes", "Stewart", "Morris", "Morales", "Murphy",
+    "Cook", "Rogers", "Gutierrez", "Ortiz", "Morgan", "Cooper", "Peterson", "Bailey",
+    "Reed", "Kelly", "Howard", "Ramos", "Kim", "Cox", "Ward", "Richardson", "Watson",
+    "Brooks", "Chavez", "Wood", "James", "Bennett", "Gray", "Mendoza", "Ruiz", "Hughes",
+    "Price", "Alvarez", "Castillo", "Sanders", "Patel", "Myers", "Long", "Ross",
+    "Foster", "Jimenez", "Okafor", "Kowalski", "Nakamura", "Schmidt", "Ivanova",
+)
+
+STREETS = (
+    "Main", "Oak", "Pine", "Maple", "Cedar", "Elm", "Washington", "Lake", "Hill",
+    "Park", "Sunset", "Lincoln", "Jackson", "River", "Church", "Highland", "Mill",
+)
+STREET_TYPES = ("Street", "Avenue", "Road", "Boulevard", "Lane", "Drive", "Court")
+CITIES = (
+    ("New York", "NY", 10001), ("Los Angeles", "CA", 90001), ("Chicago", "IL", 60601),
+    ("Houston", "TX", 77001), ("Phoenix", "AZ", 85001), ("Philadelphia", "PA", 19101),
+    ("San Antonio", "TX", 78201), ("San Diego", "CA", 92101), ("Dallas", "TX", 75201),
+    ("Seattle", "WA", 98101), ("Denver", "CO", 80201), ("Boston", "MA", 2101),
+)
+DOMAINS = ("gmail.com", "yahoo.com", "hotmail.com", "outlook.com", "icloud.com", "example.com")
+
+
+class CustomerGenerator:
+    """ Generates a reproducible stream of realistic customers """
+
+    def __init__(self, seed=0, active_ratio=0.9, zipf_exponent=1.1, last_names=LAST_NAMES):
+        """
+        :param seed: the same seed always generates the same customers
+        :param active_ratio: the share of customers that are active
+        :param zipf_exponent: how skewed the last names are, 0 for uniform
+        :param last_names: the last names from the most to the least common
+        """
+        self.seed = seed
+        self.active_ratio = active_ratio
+        self.last_names = last_names
+        self.weights = [1.0 / rank ** zipf_exponent for rank in range(1, len(last_names) + 1)]
+        self.cumulative = list(itertools.accumulate(self.weights))
+
+    def last_name_share(self, last_name):
+        """ Returns the expected share of the customers with a last name """
+        return self.weights[self.last_names.index(last_name)] / self.cumulative[-1]
+
+    def customers(self, count, start=0):
+        """Yields count customers as dictionaries
+
+        :param count: the number of customers
+        :param start: the number of the first customer, which keeps the
+            emails of a later batch unique, e.g. 1000 after a first 1000
+        """
+        rng = random.Random("{}-{}".format(self.seed, start))
+        total = self.cumulative[-1]
+        for number in range(start, start + count):
+            first_name = rng.choice(FIRST_NAMES)
+            last_name = self.last_names[bisect.bisect(self.cumulative, rng.random() * total)]
+            city, state, zip_code = rng.choice(CITIES)
+            yield {
+                "first_name": first_name,
+                "last_name": last_name,
+                # the number makes every email unique
+                "email": "{}.{}.{}@{}".format(
+                    first_name.lower(), last_name.lower(), number, rng.choice(DOMAINS)
+                ),
+                "address": "{} {} {}, {}, {} {:05d}".format(
+                    rng.randint(1, 9999), rng.choice(STREETS), rng.choice(STREET_TYPES),
+                    city, state, zip_code + rng.randrange(100),
+                ),
+                "active": rng.random() < self.active_ratio,
+            }
+
+
+def batches(rows, batch_size):
+    """ Yields lists of up to batch_size rows """
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def insert_customers(engine, rows, batch_size=10000):
+    """Inserts customers into the database with one transaction per batch
+
+    Each batch is one executemany() of a Core INSERT, which skips the ORM,
+    so no change feed entries or events are made for the customers.
+
+    :return: the number of customers inserted
+    :rtype: int
+    """
+    from service.models import Customer  # pylint: disable=import-outside-toplevel
+
+    table = Customer.__table__
+    inserted = 0
+    for batch in batches(rows, batch_size):
+        with engine.begin() as connection:
+            connection.execute(table.insert(), batch)
+        inserted += len(batch)
+    return inserted
+
+
+def write_ndjson(rows, output):
+    """ Writes customers to a file as one JSON object per line """
+    written = 0
+    for row in rows:
+        output.write(json.dumps(row))
+        output.write("\n")
+        written += 1
+    return written
+
+
+def write_csv(rows, output):
+    """ Writes customers to a file as CSV with a header """
+    writer = csv.DictWriter(output, fieldnames=FIELDS, lineterminator="\n")
+    writer.writeheader()
+    written = 0
+    for row in rows:
+        writer.writerow(row)
+        written += 1
+    return written
+
+
+def main(argv=None):
+    """ Generates customers into the database or a file """
+    parser = argparse.ArgumentParser(description="Generates realistic customers")
+    parser.add_argument("--count", type=int, default=1000, help="customers to generate")
+    parser.add_argument("--start", type=int, default=0, help="number of the first customer")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random data")
+    parser.add_argument("--active-ratio", type=float, default=0.9, help="share of active customers")
+    parser.add_argument("--zipf", type=float, default=1.1, help="skew of the last names, 0 for none")
+    parser.add_argument("--to", choices=["db", "ndjson", "csv"], default="ndjson",
+                        help="insert into DATABASE_URI or write a file")
+    parser.add_argument("--output", default="-", help="the file to write, - for stdout")
+    parser.add_argument("--batch-size", type=int, default=10000, help="rows per transaction")
+    args = parser.parse_args(argv)
+
+    generator = CustomerGenerator(args.seed, args.active_ratio, args.zipf)
+    rows = generator.customers(args.count, args.start)
+    if args.to == "db":
+        from service.models import db  # pylint: disable=import-outside-toplevel
+
+        count = insert_customers(db.engine, rows, args.batch_size)
+        print("Inserted {:,} customers".format(count), file=sys.stderr)
+        return 0
+    write = write_ndjson if args.to == "ndjson" else write_csv
+    if args.output == "-":
+        count = write(rows, sys.stdout)
+    else:
+        with open(args.output, "w", newline="") as output:
+            count = write(rows, output)
+    print("Wrote {:,} customers".format(count), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,16 @@
+"""
+A clock for the tests of code that reads the time
+
+Code that expires or refills things takes its clock as an argument, e.g.
+LRUCache(clock=...), so the tests can move time forward by hand.
+"""
+
+
+class FakeClock:
+    """ A clock that only moves when it is told to """
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
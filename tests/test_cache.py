@@ -0,0 +1,126 @@
+"""
+Test cases for the Customer cache
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+
+import unittest
+from service.cache import LRUCache
+from .fake_clock import FakeClock
+
+
+######################################################################
+#  L R U   C A C H E   T E S T   C A S E S
+######################################################################
+class TestLRUCache(unittest.TestCase):
+    """ Test Cases for LRUCache """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.clock = FakeClock()
+        self.cache = LRUCache(maxsize=2, ttl=10, clock=self.clock)
+
+    def test_get_and_set(self):
+        """ Store and fetch a value """
+        self.assertIsNone(self.cache.get(1))
+        self.cache.set(1, {"id": 1})
+        self.assertEqual(self.cache.get(1), {"id": 1})
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 1)
+
+    def test_evicts_least_recently_used(self):
+        """ Evict the least recently used value when full """
+        self.cache.set(1, "one")
+        self.cache.set(2, "two")
+        self.cache.get(1)
+        self.cache.set(3, "three")
+        self.assertIsNone(self.cache.get(2))
+        self.assertEqual(self.cache.get(1), "one")
+        self.assertEqual(self.cache.get(3), "three")
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertEqual(len(self.cache), 2)
+
+    def test_expires(self):
+        """ Forget a value after its ttl """
+        self.cache.set(1, "one")
+        self.clock.now = 9.9
+        self.assertEqual(self.cache.get(1), "one")
+        self.clock.now = 10
+        self.assertIsNone(self.cache.get(1))
+        self.assertEqual(self.cache.expirations, 1)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_invalidate_and_clear(self):
+        """ Forget values on request """
+        self.cache.set(1, "one")
+        self.cache.set(2, "two")
+        self.cache.invalidate(1)
+        self.cache.invalidate(5)
+        self.assertIsNone(self.cache.get(1))
+        self.cache.clear()
+        self.assertIsNone(self.cache.get(2))
+
+    def test_set_after_invalidate(self):
+        """ A value read before its key was invalidated is not stored """
+        generation = self.cache.generation()
+        self.cache.invalidate(1)  # a writer commits while the value is read
+        self.cache.set(1, "old", generation)
+        self.assertIsNone(self.cache.get(1))
+        self.cache.set(2, "two", generation)
+        self.assertEqual(self.cache.get(2), "two")
+        generation = self.cache.generation()
+        self.cache.set(1, "new", generation)
+        self.assertEqual(self.cache.get(1), "new")
+
+    def test_set_after_forgotten_invalidate(self):
+        """ Once invalidations are forgotten, older reads are not stored at all """
+        generation = self.cache.generation()
+        for key in range(3, 6):  # more keys than maxsize
+            self.cache.invalidate(key)
+        self.cache.set(1, "old", generation)
+        self.assertIsNone(self.cache.get(1))
+        generation = self.cache.generation()
+        self.cache.clear()
+        self.cache.set(1, "old", generation)
+        self.assertIsNone(self.cache.get(1))
+
+    def test_disabled(self):
+        """ A cache with no size stores nothing """
+        cache = LRUCache(maxsize=0)
+        self.assertFalse(cache.enabled)
+        cache.set(1, "one")
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.stats()["misses"], 0)
+
+    def test_stats(self):
+        """ Report the counters """
+        self.cache.set(1, "one")
+        self.cache.get(1)
+        self.cache.get(2)
+        stats = self.cache.stats()
+        self.assertEqual(stats["size"], 1)
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["maxsize"], 2)
+
+    def test_observer(self):
+        """ An observer is told about every event """
+        events = []
+        self.cache.observer = events.append
+        self.cache.get(1)
+        self.cache.set(1, "one")
+        self.cache.get(1)
+        self.cache.set(2, "two")
+        self.cache.set(3, "three")
+        self.clock.now = 10
+        self.cache.get(3)
+        self.assertEqual(events, ["miss", "hit", "eviction", "expiration", "miss"])
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+"""
+Test cases for the Customer event broker
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+
+import unittest
+import mock
+from service.events import Broker
+
+
+######################################################################
+#  B R O K E R   T E S T   C A S E S
+######################################################################
+class TestBroker(unittest.TestCase):
+    """ Test Cases for Broker """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.broker = Broker(maxsize=2)
+
+    def test_publish_to_every_subscriber(self):
+        """ Every subscriber gets every event """
+        first = self.broker.subscribe()
+        second = self.broker.subscribe()
+        self.broker.publish("create", 1, {"id": 1})
+        self.broker.publish("delete", 1)
+        for subscription in (first, second):
+            self.assertEqual(subscription.get(0), {"op": "create", "id": 1, "customer": {"id": 1}})
+            self.assertEqual(subscription.get(0), {"op": "delete", "id": 1, "customer": None})
+            self.assertIsNone(subscription.get(0))
+
+    def test_slow_subscriber_drops_events(self):
+        """ A full queue drops events instead of blocking the publisher """
+        slow = self.broker.subscribe()
+        for customer_id in range(5):
+            self.broker.publish("update", customer_id, {})
+        self.assertEqual(slow.take_dropped(), 3)
+        self.assertEqual(slow.take_dropped(), 0)
+        self.assertEqual([slow.get(0)["id"] for _ in range(2)], [0, 1])
+
+    def test_unsubscribe(self):
+        """ An unsubscribed client gets no more events """
+        subscription = self.broker.subscribe()
+        self.assertEqual(len(self.broker), 1)
+        self.broker.unsubscribe(subscription)
+        self.assertEqual(len(self.broker), 0)
+        self.broker.publish("create", 1, {})
+        self.assertIsNone(subscription.get(0))
+
+    def test_max_subscribers(self):
+        """ No more than max_subscribers can subscribe at once """
+        broker = Broker(max_subscribers=1)
+        first = broker.subscribe()
+        self.assertIsNone(broker.subscribe())
+        broker.unsubscribe(first)
+        self.assertIsNotNone(broker.subscribe())
+
+    def test_transport(self):
+        """ With a transport events go out through it and come back by deliver() """
+        transport = mock.Mock()
+        self.broker.transport = transport
+        subscription = self.broker.subscribe()
+        transport.listen.assert_called_once_with(self.broker)
+        self.broker.publish("create", 1, {})
+        self.assertIsNone(subscription.get(0))
+        event = transport.send.call_args[0][0]
+        self.broker.deliver(event)
+        self.assertEqual(subscription.get(0)["op"], "create")
+
+    def test_transport_failure(self):
+        """ A transport that fails does not fail the publisher """
+        self.broker.transport = mock.Mock()
+        self.broker.transport.send.side_effect = OSError("connection refused")
+        self.broker.publish("create", 1, {})
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+"""
+Test cases for rate limiting and load shedding
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+
+import unittest
+from service import limits
+from .fake_clock import FakeClock
+
+
+######################################################################
+#  R A T E   L I M I T E R   T E S T   C A S E S
+######################################################################
+class TestRateLimiter(unittest.TestCase):
+    """ Test Cases for RateLimiter """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.clock = FakeClock()
+        self.limiter = limits.RateLimiter(
+            rate=2, burst=3, routes={"POST /customers/bulk": (0.5, 1)}, clock=self.clock
+        )
+
+    def test_burst_then_rate(self):
+        """ A full bucket allows a burst, then refills at the rate """
+        for _ in range(3):
+            self.assertEqual(self.limiter.check("key", "GET /customers"), 0)
+        self.assertAlmostEqual(self.limiter.check("key", "GET /customers"), 0.5)
+        self.clock.now = 0.5
+        self.assertEqual(self.limiter.check("key", "GET /customers"), 0)
+        self.assertEqual(self.limiter.limited, 1)
+
+    def test_buckets_are_per_key_and_route(self):
+        """ Every API key and route has a bucket of its own """
+        for _ in range(3):
+            self.limiter.check("key", "GET /customers")
+        self.assertGreater(self.limiter.check("key", "GET /customers"), 0)
+        self.assertEqual(self.limiter.check("other", "GET /customers"), 0)
+        self.assertEqual(self.limiter.check("key", "GET /customers/<customer_id>"), 0)
+
+    def test_route_override(self):
+        """ A route can have its own rate and burst """
+        self.assertEqual(self.limiter.check("key", "POST /customers/bulk"), 0)
+        self.assertAlmostEqual(self.limiter.check("key", "POST /customers/bulk"), 2.0)
+
+    def test_off(self):
+        """ A rate of 0 never limits """
+        limiter = limits.RateLimiter(rate=0, burst=1)
+        for _ in range(10):
+            self.assertEqual(limiter.check("key", "GET /customers"), 0)
+
+    def test_parse_routes(self):
+        """ Parse per route limits """
+        self.assertEqual(
+            limits.parse_routes("POST  /customers/bulk=0.5:2; GET /customers/export=0.1:1;"),
+            {"POST /customers/bulk": (0.5, 2.0), "GET /customers/export": (0.1, 1.0)},
+        )
+        self.assertEqual(limits.parse_routes(""), {})
+        self.assertRaises(ValueError, limits.parse_routes, "POST /customers=5")
+        self.assertRaises(ValueError, limits.parse_routes, "=1:2")
+
+    def test_retry_after(self):
+        """ Retry-After is rounded up to whole seconds """
+        self.assertEqual(limits.retry_after(0.2), 1)
+        self.assertEqual(limits.retry_after(2.1), 3)
+
+
+######################################################################
+#  L O A D   S H E D D E R   T E S T   C A S E S
+######################################################################
+class TestLoadShedder(unittest.TestCase):
+    """ Test Cases for LoadShedder """
+
+    def test_max_in_flight(self):
+        """ Requests are refused while too many are in flight """
+        shedder = limits.LoadShedder(max_in_flight=2)
+        self.assertIsNone(shedder.enter())
+        self.assertIsNone(shedder.enter())
+        self.assertIsNotNone(shedder.enter())
+        shedder.leave()
+        self.assertIsNone(shedder.enter())
+        self.assertEqual(shedder.in_flight, 2)
+        self.assertEqual(shedder.shed, 1)
+
+    def test_max_pool_wait(self):
+        """ Requests are refused while the database pool is slow """
+        wait = [0.0]
+        shedder = limits.LoadShedder(max_pool_wait=0.5, pool_wait=lambda: wait[0])
+        self.assertIsNone(shedder.enter())
+        wait[0] = 0.6
+        self.assertIsNotNone(shedder.enter())
+        self.assertEqual(shedder.in_flight, 1)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+"""
+Test cases for the logging pipeline
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+
+import sys
+import json
+import mock
+import logging
+import threading
+import unittest
+from service import app, log
+
+
+class ListHandler(logging.Handler):
+    """ A handler that keeps what it is given, once it is let go """
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+        self.ready = threading.Event()
+        self.ready.set()
+
+    def emit(self, record):
+        self.ready.wait()
+        self.records.append(record)
+
+
+def make_record(message, level=logging.INFO, args=None, exc_info=None):
+    """ Returns a log record of the service logger """
+    return logging.LogRecord("flask.app", level, __file__, 1, message, args, exc_info)
+
+
+######################################################################
+#  A S Y N C   L O G   H A N D L E R   T E S T   C A S E S
+######################################################################
+class TestAsyncLogHandler(unittest.TestCase):
+    """ Test Cases for AsyncLogHandler """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.target = ListHandler()
+        self.handler = log.AsyncLogHandler([self.target], maxsize=2)
+
+    def tearDown(self):
+        """ This runs after each test """
+        self.target.ready.set()
+        self.handler.close()
+
+    def test_writes_in_background(self):
+        """ Records are formatted before they are queued and written by the listener """
+        self.handler.handle(make_record("Customer %s saved", args=(7,)))
+        self.handler.stop()
+        self.assertEqual(len(self.target.records), 1)
+        record = self.target.records[0]
+        self.assertEqual(record.getMessage(), "Customer 7 saved")
+        self.assertIsNone(record.args)
+
+    def test_drops_when_full(self):
+        """ A full queue drops new records instead of blocking, then says how many """
+        self.target.ready.clear()
+        self.handler.handle(make_record("taken by the listener"))
+        # wait for the listener to hold the first record
+        while not self.handler.queue.empty():
+            pass
+        for number in range(5):
+            self.handler.handle(make_record("record {}".format(number)))
+        self.assertEqual(self.handler.dropped, 3)
+        self.target.ready.set()
+        self.handler.stop()
+        self.handler.handle(make_record("after the drops"))
+        self.handler.stop()
+        messages = [record.getMessage() for record in self.target.records]
+        self.assertEqual(messages[:3], ["taken by the listener", "record 0", "record 1"])
+        self.assertEqual(messages[3:], [
+            "after the drops", "Dropped 3 log records, the log queue was full"
+        ])
+
+    def test_request_fields(self):
+        """ The method and path of the request are kept with a record """
+        with app.test_request_context("/customers/1", method="DELETE"):
+            self.handler.handle(make_record("Request to Delete a customer"))
+        self.handler.stop()
+        record = self.target.records[0]
+        self.assertEqual((record.method, record.path), ("DELETE", "/customers/1"))
+
+    def test_restarts_after_fork(self):
+        """ A forked process starts its own queue and writer thread """
+        self.handler.handle(make_record("parent"))
+        parent_queue = self.handler.queue
+        with mock.patch("os.getpid", return_value=-1):
+            self.handler.handle(make_record("child"))
+            self.assertIsNot(self.handler.queue, parent_queue)
+            self.handler.stop()
+        self.assertIn("child", [record.getMessage() for record in self.target.records])
+
+
+######################################################################
+#  F O R M A T T I N G   A N D   S A M P L I N G   T E S T   C A S E S
+######################################################################
+class TestLogFormat(unittest.TestCase):
+    """ Test Cases for JsonFormatter, SamplingFilter and parse_rates """
+
+    def test_json(self):
+        """ A record is one JSON object with its exception """
+        try:
+            raise ValueError("bad")
+        except ValueError as error:
+            record = make_record("failed: %s", logging.ERROR, (error,), sys.exc_info())
+        record.path = "/customers"
+        line = log.JsonFormatter().format(record)
+        self.assertNotIn("\n", line)
+        entry = json.loads(line)
+        self.assertEqual(entry["level"], "ERROR")
+        self.assertEqual(entry["message"], "failed: bad")
+        self.assertEqual(entry["path"], "/customers")
+        self.assertIn("ValueError: bad", entry["exception"])
+
+    def test_json_fields(self):
+        """ Fields logged as extra are written as keys of the object """
+        handler = log.AsyncLogHandler([ListHandler()])
+        self.addCleanup(handler.close)
+        record = make_record("Slow SQL statement", logging.WARNING)
+        record.fields = {"duration_ms": 250.0, "level": "x"}
+        handler.handle(record)
+        handler.stop()
+        entry = json.loads(log.JsonFormatter().format(handler.targets[0].records[0]))
+        self.assertEqual(entry["message"], "Slow SQL statement")
+        self.assertEqual(entry["duration_ms"], 250.0)
+        self.assertEqual(entry["level"], "WARNING")
+
+    def test_sampling(self):
+        """ Sampled levels keep the records below their rate """
+        values = iter([0.05, 0.5])
+        sampler = log.SamplingFilter({logging.INFO: 0.1}, random_fn=lambda: next(values))
+        self.assertTrue(sampler.filter(make_record("kept")))
+        self.assertFalse(sampler.filter(make_record("dropped")))
+        self.assertTrue(sampler.filter(make_record("warning", logging.WARNING)))
+
+    def test_parse_rates(self):
+        """ Rates are read per level name """
+        self.assertEqual(log.parse_rates("info=0.1, DEBUG=0"), {logging.INFO: 0.1, logging.DEBUG: 0.0})
+        self.assertEqual(log.parse_rates(""), {})
+        self.assertRaises(ValueError, log.parse_rates, "LOUD=1")
+        self.assertRaises(ValueError, log.parse_rates, "INFO")
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    unittest.main()
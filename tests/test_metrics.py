@@ -0,0 +1,143 @@
+"""
+Test cases for the Prometheus metrics
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+from prometheus_client import REGISTRY
+from sqlalchemy import create_engine, text
+from service import metrics
+from service.cache import LRUCache
+from service.database import pool_wait
+
+
+def sample(name, **labels):
+    """ Returns the current value of a sample, 0 if it was never set """
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+######################################################################
+#  M E T R I C S   T E S T   C A S E S
+######################################################################
+class TestMetrics(unittest.TestCase):
+    """ Test Cases for the metrics """
+
+    @classmethod
+    def setUpClass(cls):
+        """ This runs once before the entire test suite """
+        metrics.install()
+
+    def test_operation(self):
+        """ Statements are labelled by their first keyword """
+        self.assertEqual(metrics.operation("SELECT 1"), "SELECT")
+        self.assertEqual(metrics.operation("\n  insert into customer VALUES (1)"), "INSERT")
+        self.assertEqual(metrics.operation("PRAGMA table_info(customer)"), "OTHER")
+        self.assertEqual(metrics.operation(""), "OTHER")
+
+    def test_requests(self):
+        """ Requests are counted by route and status, and timed """
+        labels = dict(method="GET", route="/test/<id>")
+        count = sample("customers_http_requests_total", status="200", **labels)
+        timed = sample("customers_http_request_duration_seconds_count", **labels)
+        in_flight = sample("customers_http_requests_in_flight")
+        started = metrics.request_started()
+        self.assertEqual(sample("customers_http_requests_in_flight"), in_flight + 1)
+        metrics.request_finished("GET", "/test/<id>", 200, started)
+        metrics.request_closed()
+        self.assertEqual(sample("customers_http_requests_in_flight"), in_flight)
+        # a stream is timed but not counted as in flight
+        metrics.request_started(in_flight=False)
+        self.assertEqual(sample("customers_http_requests_in_flight"), in_flight)
+        self.assertEqual(sample("customers_http_requests_total", status="200", **labels), count + 1)
+        self.assertEqual(sample("customers_http_request_duration_seconds_count", **labels), timed + 1)
+
+    def test_statements(self):
+        """ Every engine counts and times its statements and checkouts """
+        engine = create_engine("sqlite://")
+        selects = sample("customers_db_statements_total", operation="SELECT")
+        timed = sample("customers_db_statement_duration_seconds_count", operation="SELECT")
+        checkouts = sample("customers_db_pool_checkouts_total")
+        checked_out = sample("customers_db_pool_checked_out")
+        with engine.connect() as connection:
+            self.assertEqual(sample("customers_db_pool_checked_out"), checked_out + 1)
+            connection.execute(text("SELECT 1"))
+            connection.execute(text("SELECT 2"))
+        self.assertEqual(sample("customers_db_pool_checked_out"), checked_out)
+        self.assertEqual(sample("customers_db_pool_checkouts_total"), checkouts + 1)
+        self.assertEqual(sample("customers_db_statements_total", operation="SELECT"), selects + 2)
+        self.assertEqual(
+            sample("customers_db_statement_duration_seconds_count", operation="SELECT"), timed + 2
+        )
+
+    def test_pool_wait(self):
+        """ Waits for a pooled connection are observed """
+        waits = sample("customers_db_pool_wait_seconds_count")
+        pool_wait.observe(0.002)
+        self.assertEqual(sample("customers_db_pool_wait_seconds_count"), waits + 1)
+
+    def test_cache(self):
+        """ The events of an instrumented cache are counted """
+        cache = LRUCache(maxsize=1, ttl=10)
+        metrics.instrument_cache(cache)
+        hits = sample("customers_cache_events_total", event="hit")
+        misses = sample("customers_cache_events_total", event="miss")
+        evictions = sample("customers_cache_events_total", event="eviction")
+        cache.get(1)
+        cache.set(1, "one")
+        cache.get(1)
+        cache.set(2, "two")
+        self.assertEqual(sample("customers_cache_events_total", event="hit"), hits + 1)
+        self.assertEqual(sample("customers_cache_events_total", event="miss"), misses + 1)
+        self.assertEqual(sample("customers_cache_events_total", event="eviction"), evictions + 1)
+
+    def test_render(self):
+        """ The metrics are rendered in the Prometheus text format """
+        body, content_type = metrics.render()
+        self.assertTrue(content_type.startswith("text/plain"))
+        self.assertIn(b"customers_http_request_duration_seconds", body)
+
+
+######################################################################
+#  M U L T I P R O C E S S   T E S T   C A S E S
+######################################################################
+class TestMultiprocess(unittest.TestCase):
+    """ Test Cases for metrics shared by several worker processes """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.directory = tempfile.mkdtemp()
+        self.env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=self.directory)
+
+    def tearDown(self):
+        """ This runs after each test """
+        shutil.rmtree(self.directory)
+
+    def run_python(self, code):
+        """ Runs code in a new process that shares the metrics directory """
+        return subprocess.run(
+            [sys.executable, "-c", code], env=self.env, check=True, stdout=subprocess.PIPE
+        ).stdout
+
+    def test_aggregates_workers(self):
+        """ Any worker renders the sum of the counters of every worker """
+        for _ in range(2):
+            self.run_python(
+                "from service import metrics\n"
+                "metrics.request_finished('GET', '/customers', 200, metrics.request_started())\n"
+            )
+        body = self.run_python(
+            "import sys\n"
+            "from service import metrics\n"
+            "sys.stdout.buffer.write(metrics.render()[0])\n"
+        )
+        self.assertIn(
+            b'customers_http_requests_total{method="GET",route="/customers",status="200"} 2.0', body
+        )
@@ -7,10 +7,15 @@ Test cases can be run with:
     coverage report -m
 """
 
+import mock
 import unittest
 import os
 import json
-from service.models import Customer, DataValidationError, db
+import tempfile
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import postgresql, sqlite
+from service import database
+from service.models import Customer, CustomerChange, DataValidationError, VersionConflictError, db
 from service.service import app, init_db
 
 DATABASE_URI = os.getenv(
@@ -45,6 +50,7 @@ class TestCustomerModel(unittest.TestCase):
         """ This runs before each test """
         db.drop_all()  # clean up the last tests
         db.create_all()  # make our sqlalchemy tables
+        Customer.cache.clear()  # forget the customers of the last tests
 
     def tearDown(self):
         """ This runs after each test """
@@ -112,6 +118,83 @@ class TestCustomerModel(unittest.TestCase):
         self.assertEqual(len(customers), 1)
         self.assertEqual(customers[0].address, "Times Sq 42nd St")
 
+    def test_update_changes_version(self):
+        """ Updating a Customer changes its version and ETag """
+        customer = Customer(
+            first_name="John",
+            last_name="Smith",
+            email="jsmith@gmail.com",
+            address="123 Brooklyn Ave",
+            active=True,
+        )
+        customer.create()
+        self.assertEqual(customer.version, 1)
+        self.assertIsNotNone(customer.updated_at)
+        etag = customer.etag()
+        customer.address = "Times Sq 42nd St"
+        customer.update()
+        self.assertEqual(customer.version, 2)
+        self.assertNotEqual(customer.etag(), etag)
+
+    def test_update_by_id(self):
+        """ Update a Customer with a conditional UPDATE """
+        customer = Customer(
+            first_name="John",
+            last_name="Smith",
+            email="jsmith@gmail.com",
+            address="123 Brooklyn Ave",
+            active=True,
+        )
+        customer.create()
+        updated = Customer.update_by_id(customer.id, {"address": "Times Sq 42nd St"}, 1)
+        self.assertEqual(updated.address, "Times Sq 42nd St")
+        self.assertEqual(updated.version, 2)
+        # a writer that read version 1 loses
+        self.assertRaises(
+            VersionConflictError, Customer.update_by_id, customer.id, {"active": False}, 1
+        )
+        self.assertEqual(Customer.find(customer.id).active, True)
+        # an unconditional write always applies
+        updated = Customer.update_by_id(customer.id, {"active": False})
+        self.assertEqual(updated.active, False)
+        self.assertEqual(updated.version, 3)
+        self.assertIsNone(Customer.update_by_id(0, {"active": False}, 1))
+        self.assertIsNone(Customer.update_by_id("abc", {"active": False}))
+
+    def test_delete_by_id(self):
+        """ Delete a Customer with a conditional DELETE """
+        customer = Customer(
+            first_name="John",
+            last_name="Smith",
+            email="jsmith@gmail.com",
+            address="123 Brooklyn Ave",
+            active=True,
+        )
+        customer.create()
+        customer_id = customer.id
+        self.assertRaises(VersionConflictError, Customer.delete_by_id, customer_id, 5)
+        self.assertTrue(Customer.delete_by_id(customer_id, 1))
+        self.assertFalse(Customer.delete_by_id(customer_id))
+        self.assertIsNone(Customer.find(customer_id))
+
+    def test_update_stale_customer(self):
+        """ An ORM update of a Customer changed by someone else fails """
+        customer = Customer(
+            first_name="John",
+            last_name="Smith",
+            email="jsmith@gmail.com",
+            address="123 Brooklyn Ave",
+            active=True,
+        )
+        customer.create()
+        self.assertEqual(customer.version, 1)
+        # another writer changes the row behind this session's back
+        db.engine.execute(
+            Customer.__table__.update().values(version=Customer.__table__.c.version + 1)
+        )
+        customer.address = "9 3/4 Gryffindor Lane"
+        self.assertRaises(VersionConflictError, customer.update)
+
     def test_delete_a_customer(self):
         """ Delete a Customer """
         customer = Customer(
@@ -234,6 +317,11 @@ class TestCustomerModel(unittest.TestCase):
         }
         self.assertRaises(DataValidationError, customer2.deserialize, data2)
 
+        data2["email"] = "jsmith@gmail.com"
+        for name, value in (("active", "yes"), ("active", 2), ("first_name", 7)):
+            bad = dict(data2, **{name: value})
+            self.assertRaises(DataValidationError, Customer().deserialize, bad)
+
     def test_find_customer(self):
         """ Find a Customer by ID """
         customer = Customer(
@@ -254,6 +342,121 @@ class TestCustomerModel(unittest.TestCase):
         self.assertEqual(result.address, "456 7th street, New York, NY, 10001")
         self.assertEqual(result.active, True)
 
+    def test_find_customer_cached(self):
+        """ Find a Customer from the cache and invalidate it on update """
+        customer = Customer(
+            first_name="John",
+            last_name="Smith",
+            email="jsmith@gmail.com",
+            address="123 Brooklyn Ave",
+            active=True,
+        )
+        customer.create()
+        self.assertEqual(Customer.find(customer.id).last_name, "Smith")
+        hits = Customer.cache.hits
+        db.session.remove()  # start over like a new request
+        found = Customer.find(str(customer.id))
+        self.assertEqual(Customer.cache.hits, hits + 1)
+        self.assertEqual(found.serialize(), customer.serialize())
+        # a cached customer can still be updated
+        found.address = "Times Sq 42nd St"
+        found.update()
+        db.session.remove()
+        self.assertEqual(Customer.find(customer.id).address, "Times Sq 42nd St")
+        self.assertEqual(Customer.cache.hits, hits + 1)
+        Customer.find(customer.id).delete()
+        self.assertIsNone(Customer.find(customer.id))
+
+    def test_find_does_not_cache_a_stale_read(self):
+        """ A row read before a write commits is not put in the cache after it """
+        customer = Customer(first_name="John", last_name="Smith", email="jsmith@gmail.com",
+                            address="123 Brooklyn Ave", active=True)
+        customer.create()
+        customer_id = customer.id
+        db.session.remove()
+        load_entry = Customer.load_entry
+
+        def read_then_write(session, key):
+            entry = load_entry(session, key)
+            # another request updates the Customer and commits meanwhile
+            with db.engine.begin() as connection:
+                connection.execute(Customer.__table__.update()
+                                   .where(Customer.__table__.c.id == key)
+                                   .values(address="Times Sq 42nd St", version=2))
+            Customer.cache.invalidate(key)
+            return entry
+
+        with mock.patch.object(Customer, "load_entry", side_effect=read_then_write):
+            self.assertEqual(Customer.find(customer_id).version, 1)
+        self.assertIsNone(Customer.cache.get(customer_id))
+        db.session.remove()
+        found = Customer.find(customer_id)
+        self.assertEqual((found.version, found.address), (2, "Times Sq 42nd St"))
+        # so an update without If-Match does not conflict
+        found.first_name = "Johnny"
+        found.update()
+        self.assertEqual(found.version, 3)
+
+    def test_find_many(self):
+        """ Find many Customers with one query """
+        customers = []
+        for i in range(3):
+            customer = Customer(first_name="First{}".format(i), last_name="Last",
+                                email="a@b.com", address="1 Main St", active=True)
+            customer.create()
+            customers.append(customer)
+        found = Customer.find_many([customers[1].id, 42, customers[0].id])
+        self.assertEqual(list(found), [customers[1].id, 42, customers[0].id])
+        self.assertIsNone(found[42])
+        self.assertEqual(found[customers[0].id]["first_name"], "First0")
+        # the Customers that were read are now cached
+        self.assertEqual(Customer.cache.get(customers[1].id)["first_name"], "First1")
+
+    def test_changes_are_recorded(self):
+        """ Every write adds to the change feed """
+        customer = Customer(first_name="John", last_name="Smith", email="a@b.com",
+                            address="1 Main St", active=True)
+        customer.create()
+        self.assertIsNotNone(customer.created_at)
+        customer.first_name = "Johnny"
+        customer.update()
+        Customer.update_by_id(customer.id, {"active": False})
+        others = [Customer(first_name="Jane", last_name="Doe", email="j@d.com",
+                           address="2 Main St", active=True) for _ in range(2)]
+        Customer.create_many(others)
+        Customer.delete_by_id(others[0].id)
+        app.config["CHANGES_SETTLE_SECONDS"], settle = 0, app.config["CHANGES_SETTLE_SECONDS"]
+        try:
+            changes, more = CustomerChange.since(0)
+        finally:
+            app.config["CHANGES_SETTLE_SECONDS"] = settle
+        self.assertFalse(more)
+        self.assertEqual(
+            [(change.customer_id, change.op) for change in changes],
+            [(customer.id, "create"), (customer.id, "update"), (customer.id, "update"),
+             (others[0].id, "create"), (others[1].id, "create"), (others[0].id, "delete")],
+        )
+        self.assertEqual(changes[0].first_name, "Johnny")
+        self.assertIsNone(changes[3].id)  # deleted since
+        self.assertEqual([c.seq for c in changes], sorted(c.seq for c in changes))
+        # changes younger than the settle time are held back
+        self.assertEqual(CustomerChange.since(0), ([], False))
+
+    def test_changes_stop_at_open_transactions(self):
+        """ On PostgreSQL the feed is ordered by transaction and ends at the oldest open one """
+        sql = str(CustomerChange.after(7, "postgresql").compile(dialect=postgresql.dialect()))
+        self.assertIn("customer_change.txid < txid_snapshot_xmin(txid_current_snapshot())", sql)
+        self.assertTrue(sql.endswith("ORDER BY customer_change.txid, customer_change.seq"))
+        self.assertNotIn("changed_at <=", sql)
+        sql = str(CustomerChange.after(7, "sqlite").compile(dialect=sqlite.dialect()))
+        self.assertIn("customer_change.changed_at <=", sql)
+        self.assertNotIn("txid", sql)
+
+    def test_find_customer_bad_id(self):
+        """ Find a Customer with an id that is not a number """
+        self.assertIsNone(Customer.find("abc"))
+        self.assertIsNone(Customer.find(None))
+
     def test_find_by_email(self):
         """ Find a Customer by email """
         Customer(
@@ -369,6 +572,270 @@ class TestCustomerModel(unittest.TestCase):
         self.assertEqual(customers[0].address, "42, Wallaby Way, Sydney, 'Straya")
         self.assertEqual(customers[0].active, False)
 
+    def test_create_many(self):
+        """ Create Customers in batches """
+        customers = [
+            Customer(
+                first_name="First{}".format(i),
+                last_name="Last",
+                email="user{}@gmail.com".format(i),
+                address="123 Brooklyn Ave",
+                active=True,
+            )
+            for i in range(5)
+        ]
+        Customer.create_many(customers, batch_size=2)
+        self.assertEqual([c.id for c in customers], [1, 2, 3, 4, 5])
+        found = Customer.all()
+        self.assertEqual(len(found), 5)
+        self.assertEqual(Customer.find(3).first_name, "First2")
+
+    def test_stream(self):
+        """ Stream Customers a batch at a time """
+        customers = [
+            Customer(
+                first_name="First{}".format(i),
+                last_name="Last",
+                email="user{}@gmail.com".format(i),
+                address="123 Brooklyn Ave",
+                active=True,
+            )
+            for i in range(5)
+        ]
+        Customer.create_many(customers)
+        streamed = [customer.id for customer in Customer.stream(batch_size=2)]
+        self.assertEqual(streamed, [1, 2, 3, 4, 5])
+
+    def test_find_by_filters(self):
+        """ Find Customers that match several filters at once """
+        for first_name, last_name, active in (
+            ("John", "Smith", True),
+            ("Jane", "Smith", False),
+            ("John", "Jones", True),
+            ("Joan", "Brown", True),
+        ):
+            Customer(
+                first_name=first_name,
+                last_name=last_name,
+                email="{}.{}@gmail.com".format(first_name, last_name),
+                address="123 Brooklyn Ave",
+                active=active,
+            ).create()
+        customers = Customer.find_by_filters({"last_name": "Smith", "active": True}).all()
+        self.assertEqual([c.first_name for c in customers], ["John"])
+        customers = Customer.find_by_filters({"last_name": ["Smith", "Jones"]}).all()
+        self.assertEqual(len(customers), 3)
+        customers = Customer.find_by_filters({"first_name": "Jo*", "active": True}).all()
+        self.assertEqual({c.last_name for c in customers}, {"Smith", "Jones", "Brown"})
+        customers = Customer.find_by_filters({"first_name": "J%*"}).all()
+        self.assertEqual(customers, [])
+        self.assertEqual(len(Customer.find_by_filters({}).all()), 4)
+        self.assertRaises(DataValidationError, Customer.find_by_filters, {"id": 1})
+
+    def test_paginate(self):
+        """ Page through Customers by id """
+        for i in range(5):
+            Customer(
+                first_name="First{}".format(i),
+                last_name="Last",
+                email="user{}@gmail.com".format(i),
+                address="123 Brooklyn Ave",
+                active=True,
+            ).create()
+        customers, next_cursor = Customer.paginate(limit=2)
+        self.assertEqual([c.id for c in customers], [1, 2])
+        self.assertEqual(next_cursor, 2)
+        customers, next_cursor = Customer.paginate(limit=2, after=next_cursor)
+        self.assertEqual([c.id for c in customers], [3, 4])
+        customers, next_cursor = Customer.paginate(limit=2, after=next_cursor)
+        self.assertEqual([c.id for c in customers], [5])
+        self.assertIsNone(next_cursor)
+
+    def test_paginate_fields(self):
+        """ Page through only some of the columns """
+        Customer(
+            first_name="John",
+            last_name="Smith",
+            email="jsmith@gmail.com",
+            address="123 Brooklyn Ave",
+            active=True,
+        ).create()
+        rows, next_cursor = Customer.paginate(fields=["email"])
+        self.assertIsNone(next_cursor)
+        self.assertEqual(rows[0].email, "jsmith@gmail.com")
+        self.assertEqual(rows[0].id, 1)
+        self.assertNotIn("address", dict(rows[0]))
+        self.assertRaises(DataValidationError, Customer.paginate, fields=["password"])
+
+    def test_paginate_max_page_size(self):
+        """ Page size is capped by PAGE_SIZE_MAX """
+        for i in range(3):
+            Customer(
+                first_name="First{}".format(i),
+                last_name="Last",
+                email="user{}@gmail.com".format(i),
+                address="123 Brooklyn Ave",
+                active=True,
+            ).create()
+        max_size = app.config["PAGE_SIZE_MAX"]
+        app.config["PAGE_SIZE_MAX"] = 2
+        try:
+            customers, next_cursor = Customer.paginate(limit=100)
+        finally:
+            app.config["PAGE_SIZE_MAX"] = max_size
+        self.assertEqual(len(customers), 2)
+        self.assertEqual(next_cursor, 2)
+
+
+######################################################################
+#  R E A D   R E P L I C A   T E S T   C A S E S
+######################################################################
+class TestReadReplicas(unittest.TestCase):
+    """ Test Cases for routing reads to the replicas """
+
+    @classmethod
+    def setUpClass(cls):
+        """ This runs once before the entire test suite """
+        app.debug = False
+        # Set up the test database
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        init_db()
+
+    @classmethod
+    def tearDownClass(cls):
+        """ This runs once after the entire test suite """
+        db.session.close()
+
+    def setUp(self):
+        """ This runs before each test """
+        db.drop_all()  # clean up the last tests
+        db.create_all()  # make our sqlalchemy tables
+        Customer.cache.clear()  # forget the customers of the last tests
+        self.directory = tempfile.TemporaryDirectory()
+        self.replica = create_engine(
+            "sqlite:///" + os.path.join(self.directory.name, "replica.db")
+        )
+        Customer.replicas = database.ReplicaRouter([self.replica])
+
+    def tearDown(self):
+        """ This runs after each test """
+        Customer.replicas = None
+        self.replica.dispose()
+        self.directory.cleanup()
+        db.session.remove()
+        db.drop_all()
+
+    def _add_to_replica(self, first_name):
+        """ Creates the customer table on the replica with one Customer in it """
+        db.metadata.create_all(self.replica)
+        self.replica.execute(
+            Customer.__table__.insert(),
+            first_name=first_name,
+            last_name="Smith",
+            email="jsmith@gmail.com",
+            address="123 Brooklyn Ave",
+            active=True,
+        )
+
+    def test_find_reads_replica(self):
+        """ Lookups are answered by the replica """
+        self._add_to_replica("Replica")
+        customer = Customer.find(1)
+        self.assertEqual(customer.first_name, "Replica")
+        self.assertIn(customer, db.session)
+        customers, _ = Customer.paginate(Customer.find_by_last_name("Smith"))
+        self.assertEqual(customers[0].first_name, "Replica")
+        customers, _ = Customer.paginate(fields=["first_name"])
+        self.assertEqual(customers[0].first_name, "Replica")
+        self.assertEqual(len(Customer.all()), 1)
+
+    def test_one_replica_per_read(self):
+        """ A filtered page or stream picks one replica and opens one session on it """
+        self._add_to_replica("Replica")
+        with mock.patch.object(Customer.replicas, "pick", wraps=Customer.replicas.pick) as pick, \
+                mock.patch.object(Customer.replicas, "session",
+                                  wraps=Customer.replicas.session) as session:
+            customers, _ = Customer.paginate(Customer.find_by_filters({"last_name": "Smith"}))
+            self.assertEqual(pick.call_count, 1)
+            rows = list(Customer.stream(Customer.find_by_filters({"active": True})))
+            self.assertEqual(pick.call_count, 2)
+        self.assertEqual(customers[0].first_name, "Replica")
+        self.assertEqual(rows[0].first_name, "Replica")
+        self.assertEqual(session.call_count, 2)
+
+    def test_failed_replica_is_ejected(self):
+        """ A replica that fails is skipped and the primary answers """
+        Customer(
+            first_name="Primary",
+            last_name="Smith",
+            email="jsmith@gmail.com",
+            address="123 Brooklyn Ave",
+            active=True,
+        ).create()
+        # the replica has no customer table, so every read fails
+        self.assertEqual(Customer.all()[0].first_name, "Primary")
+        self.assertEqual(Customer.replicas.healthy(), [])
+        self.assertIsNone(Customer.replica())
+
+    def test_read_own_writes(self):
+        """ A request that wrote reads from the primary """
+        self._add_to_replica("Replica")
+        with app.test_request_context("/customers", method="POST"):
+            app.preprocess_request()
+            self.assertIs(Customer.replica(), self.replica)
+            customer = Customer(
+                first_name="Primary",
+                last_name="Smith",
+                email="jsmith@gmail.com",
+                address="123 Brooklyn Ave",
+                active=True,
+            )
+            customer.create()
+            self.assertIsNone(Customer.replica())
+            self.assertEqual(Customer.find(customer.id).first_name, "Primary")
+
+    def test_strong_consistency_header(self):
+        """ X-Read-Consistency: strong reads from the primary """
+        with app.test_request_context(
+            "/customers", headers={"X-Read-Consistency": "strong"}
+        ):
+            app.preprocess_request()
+            self.assertIsNone(Customer.replica())
+
+    def test_strong_read_skips_cache(self):
+        """ A read that must see its own writes is not answered from the cache """
+        customer = Customer(first_name="Primary", last_name="Smith", email="jsmith@gmail.com",
+                            address="123 Brooklyn Ave", active=True)
+        customer.create()
+        # e.g. filled by another request from a lagging replica
+        Customer.cache.set(customer.id, dict(customer.cache_entry(), first_name="Stale"))
+        db.session.remove()
+        self.assertEqual(Customer.find(customer.id).first_name, "Stale")
+        db.session.remove()
+        with app.test_request_context(
+            "/customers/1", headers={"X-Read-Consistency": "strong"}
+        ):
+            app.preprocess_request()
+            self.assertEqual(Customer.find(customer.id).first_name, "Primary")
+            found = Customer.find_many([customer.id])
+            self.assertEqual(found[customer.id]["first_name"], "Primary")
+
+    def test_replica_read_after_write_is_not_cached(self):
+        """ A replica may lag behind a write, so its row is not cached after one """
+        self._add_to_replica("Replica")
+        Customer.cache.invalidate(1)  # as a write to the Customer does
+        self.assertEqual(Customer.find(1).first_name, "Replica")
+        self.assertIsNone(Customer.cache.get(1))
+        self.assertEqual(Customer.find_many([1])[1]["first_name"], "Replica")
+        self.assertIsNone(Customer.cache.get(1))
+        # a Customer that was not written is cached from the replica
+        self.replica.execute(
+            Customer.__table__.insert(), first_name="Other", last_name="Smith",
+            email="o@gmail.com", address="1 Main St", active=True,
+        )
+        self.assertEqual(Customer.find(2).first_name, "Other")
+        self.assertEqual(Customer.cache.get(2)["first_name"], "Other")
+
 
 ######################################################################
 #   M A I N
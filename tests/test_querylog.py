@@ -0,0 +1,98 @@
+"""
+Test cases for the per request SQL instrumentation
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+
+import mock
+import unittest
+from flask import g
+from sqlalchemy import create_engine, text
+from service import app, querylog
+
+
+######################################################################
+#  R E Q U E S T   Q U E R I E S   T E S T   C A S E S
+######################################################################
+class TestRequestQueries(unittest.TestCase):
+    """ Test Cases for RequestQueries """
+
+    def test_server_timing(self):
+        """ The count, total and slowest statement make a Server-Timing header """
+        queries = querylog.RequestQueries()
+        queries.add("SELECT", 0.002)
+        queries.add("UPDATE", 0.0035)
+        queries.add("COMMIT", 0.001)
+        self.assertEqual(queries.count, 3)
+        self.assertEqual(
+            queries.server_timing(),
+            'db;dur=6.500;desc="3 statements", db-slowest;dur=3.500;desc="UPDATE"',
+        )
+
+    def test_no_statements(self):
+        """ A request without statements reports none """
+        queries = querylog.RequestQueries()
+        self.assertEqual(queries.server_timing(), 'db;dur=0.000;desc="0 statements"')
+
+    def test_shape(self):
+        """ Parameters are described by type and length only """
+        self.assertEqual(querylog.shape(("Smith", 3, None)), ["str[5]", "int", "NoneType"])
+        self.assertEqual(querylog.shape({"email": "a@b.c", "active": True}),
+                         {"email": "str[5]", "active": "bool"})
+
+
+######################################################################
+#  Q U E R Y   L O G   T E S T   C A S E S
+######################################################################
+class TestQueryLog(unittest.TestCase):
+    """ Test Cases for QueryLog """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.engine = create_engine("sqlite://")
+        self.query_log = querylog.QueryLog()
+        self.query_log.install()
+
+    def tearDown(self):
+        """ This runs after each test """
+        self.query_log.slow_seconds = 0.0
+
+    def test_counts_request_statements(self):
+        """ Statements run during a request are added to it """
+        with app.test_request_context("/customers"):
+            g.queries = querylog.RequestQueries()
+            with self.engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+                connection.execute(text("SELECT 2"))
+            self.assertGreaterEqual(g.queries.count, 2)
+            self.assertEqual(g.queries.slowest_operation, "SELECT")
+
+    def test_logs_slow_statements(self):
+        """ Statements over the threshold are logged with their parameter shapes """
+        self.query_log.slow_seconds = 1e-9
+        with mock.patch.object(querylog.logger, "warning") as warning:
+            with app.test_request_context("/customers/1", method="PUT"):
+                with self.engine.connect() as connection:
+                    connection.execute(text("SELECT :name"), name="Smith")
+        self.assertTrue(warning.called)
+        fields = warning.call_args[1]["extra"]["fields"]
+        self.assertEqual(fields["operation"], "SELECT")
+        self.assertEqual(fields["route"], "PUT /customers/<customer_id>")
+        self.assertEqual(fields["parameters"], ["str[5]"])
+        self.assertNotIn("Smith", str(warning.call_args))
+
+    def test_off(self):
+        """ Nothing is logged while the threshold is 0 """
+        with mock.patch.object(querylog.logger, "warning") as warning:
+            with self.engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+        self.assertFalse(warning.called)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    unittest.main()
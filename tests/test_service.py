@@ -12,8 +12,10 @@ import unittest
 import json
 from flask_api import status  # HTTP Status Codes
 
+from service import limits
 from service.models import db, Customer
-from service.service import app, init_db
+from flask_restx import marshal
+from service.service import app, init_db, customer_model, BulkCollection
 
 from .customer_factory import CustomerFactory
 
@@ -55,6 +57,7 @@ class TestCustomers(unittest.TestCase):
         """ This runs before each test """
         db.drop_all()  # clean the last tests
         db.create_all()  # create new tables
+        Customer.cache.clear()  # forget the customers of the last tests
         self.app = app.test_client()
         self.headers = {'X-Api-Key': app.config['API_KEY']}
 
@@ -97,6 +100,68 @@ class TestCustomers(unittest.TestCase):
         data = resp.get_json()
         self.assertEqual(len(data), 3)
 
+    def test_get_customer_list_paged(self):
+        """ Page through the list of Customers """
+        self._create_customers(5)
+        resp = self.app.get("/customers", query_string="limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 2)
+        self.assertIn('rel="next"', resp.headers["Link"])
+        seen = [customer["id"] for customer in resp.get_json()]
+        while "X-Next-Cursor" in resp.headers:
+            resp = self.app.get(
+                "/customers",
+                query_string="limit=2&after={}".format(resp.headers["X-Next-Cursor"]),
+            )
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            seen.extend(customer["id"] for customer in resp.get_json())
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(seen, sorted(seen))
+        self.assertNotIn("Link", resp.headers)
+
+    def test_get_customer_list_bad_page(self):
+        """ Reject invalid pagination parameters """
+        resp = self.app.get("/customers", query_string="limit=abc")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/customers", query_string="limit=0")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_customer_list_matches_model(self):
+        """ The fast list path returns what customer_model marshalling would """
+        self._create_customers(3)
+        expected = [
+            dict(marshal(customer.serialize(), customer_model))
+            for customer in Customer.all()
+        ]
+        resp = self.app.get("/customers")
+        self.assertEqual(resp.get_json(), expected)
+        with mock.patch("service.service.orjson", None):
+            resp = self.app.get("/customers")
+        self.assertEqual(resp.get_json(), expected)
+
+    def test_get_customer_list_fields(self):
+        """ List only some of the fields of each Customer """
+        customers = self._create_customers(3)
+        resp = self.app.get("/customers", query_string="fields=id,email")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data), 3)
+        for customer, test_customer in zip(data, customers):
+            self.assertEqual(set(customer), {"id", "email"})
+            self.assertEqual(customer["id"], str(test_customer.id))
+            self.assertEqual(customer["email"], test_customer.email)
+        # a restricted list is a different representation
+        resp2 = self.app.get("/customers")
+        self.assertNotEqual(resp.headers["ETag"], resp2.headers["ETag"])
+        resp = self.app.get("/customers", query_string="fields=email&limit=2")
+        self.assertEqual([set(customer) for customer in resp.get_json()], [{"email"}] * 2)
+        self.assertIn("X-Next-Cursor", resp.headers)
+
+    def test_get_customer_list_bad_fields(self):
+        """ Reject fields that Customers do not have """
+        resp = self.app.get("/customers", query_string="fields=id,password")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_get_customer(self):
         """ Get a single Customer """
         # get the id of a customer
@@ -109,6 +174,50 @@ class TestCustomers(unittest.TestCase):
         data = resp.get_json()
         self.assertEqual(data["last_name"], test_customer.last_name)
 
+    def test_get_customer_not_modified(self):
+        """ Answer a conditional GET of an unchanged Customer with 304 """
+        test_customer = self._create_customers(1)[0]
+        url = "/customers/{}".format(test_customer.id)
+        resp = self.app.get(url)
+        etag = resp.headers["ETag"]
+        modified = resp.headers["Last-Modified"]
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.data, b"")
+        self.assertEqual(resp.headers["ETag"], etag)
+        resp = self.app.get(url, headers={"If-Modified-Since": modified})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        # a suspend changes the version, so the old ETag no longer matches
+        self.app.put(url + "/suspend")
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_get_customer_list_not_modified(self):
+        """ Answer a conditional GET of an unchanged list with 304 """
+        customers = self._create_customers(3)
+        resp = self.app.get("/customers")
+        etag = resp.headers["ETag"]
+        resp = self.app.get("/customers", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.data, b"")
+        self.app.put("/customers/{}/suspend".format(customers[1].id))
+        resp = self.app.get("/customers", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 3)
+
+    def test_get_customer_list_ignores_if_modified_since(self):
+        """ A list has no Last-Modified, as a delete can make it older """
+        customers = self._create_customers(2)
+        resp = self.app.get("/customers")
+        self.assertNotIn("Last-Modified", resp.headers)
+        self.app.delete("/customers/{}".format(customers[1].id), headers=self.headers)
+        resp = self.app.get("/customers", headers={
+            "If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"
+        })
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 1)
+
     # def test_get_customer_not_found(self):
     #     """ Get a Customer thats not found """
     #     resp = self.app.get("/customers/0")
@@ -201,6 +310,281 @@ class TestCustomers(unittest.TestCase):
             new_customer["active"], test_customer.active, "active does not match"
         )
 
+    def test_create_customer_idempotent(self):
+        """ A retry with the same Idempotency-Key gets the first response """
+        test_customer = CustomerFactory()
+        headers = dict(self.headers, **{"Idempotency-Key": "create-1"})
+        resp = self.app.post("/customers", json=test_customer.serialize(), headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn("Idempotent-Replayed", resp.headers)
+        replay = self.app.post("/customers", json=test_customer.serialize(), headers=headers)
+        self.assertEqual(replay.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(replay.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(replay.get_json(), resp.get_json())
+        self.assertEqual(replay.headers["Location"], resp.headers["Location"])
+        self.assertEqual(len(Customer.all()), 1)
+        # the same key for another body is refused
+        other = dict(test_customer.serialize(), first_name="Someone else")
+        resp = self.app.post("/customers", json=other, headers=headers)
+        self.assertEqual(resp.status_code, 422)
+        # a failed request does not keep its key
+        headers["Idempotency-Key"] = "create-2"
+        resp = self.app.post("/customers", json={"first_name": "x"}, headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post("/customers", json=test_customer.serialize(), headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(Customer.all()), 2)
+
+    def test_bulk_create_customers(self):
+        """ Create many Customers from a JSON array """
+        customers = [CustomerFactory().serialize() for _ in range(5)]
+        resp = self.app.post(
+            "/customers/bulk", json=customers, content_type="application/json",
+            headers=self.headers
+        )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = resp.get_json()
+        self.assertEqual(data["created"], 5)
+        self.assertEqual([result["index"] for result in data["results"]], list(range(5)))
+        for result, customer in zip(data["results"], customers):
+            resp = self.app.get("/customers/{}".format(result["id"]))
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.get_json()["email"], customer["email"])
+
+    def test_bulk_create_customers_ndjson(self):
+        """ Create many Customers from NDJSON and report the invalid ones """
+        customers = [CustomerFactory().serialize() for _ in range(3)]
+        del customers[1]["email"]
+        lines = [json.dumps(customer) for customer in customers] + ["not json", ""]
+        resp = self.app.post(
+            "/customers/bulk", data="\n".join(lines), content_type="application/x-ndjson",
+            headers=self.headers
+        )
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        data = resp.get_json()
+        self.assertEqual(data["created"], 2)
+        self.assertEqual(data["failed"], 2)
+        statuses = [result["status"] for result in data["results"]]
+        self.assertEqual(statuses, [201, 400, 201, 400])
+        self.assertIn("email", data["results"][1]["error"])
+        resp = self.app.get("/customers")
+        self.assertEqual(len(resp.get_json()), 2)
+
+    def test_bulk_create_bad_value(self):
+        """ A Customer with a value of the wrong type fails alone """
+        customers = [CustomerFactory().serialize() for _ in range(4)]
+        customers[1]["active"] = "yes"
+        resp = self.app.post(
+            "/customers/bulk", json=customers, content_type="application/json",
+            headers=self.headers
+        )
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        data = resp.get_json()
+        self.assertEqual([result["status"] for result in data["results"]], [201, 400, 201, 201])
+        self.assertIn("active", data["results"][1]["error"])
+        self.assertEqual(len(self.app.get("/customers").get_json()), 3)
+
+    def test_bulk_create_failed_batch(self):
+        """ A batch that the database rejects is retried one Customer at a time """
+        customers = [Customer().deserialize(CustomerFactory().serialize()) for _ in range(4)]
+        customers[1].active = "yes"  # past deserialize(), so only the database rejects it
+        batch = [({"index": index, "status": 201}, customer)
+                 for index, customer in enumerate(customers)]
+        with app.test_request_context("/customers/bulk", method="POST"):
+            BulkCollection.create_batch(batch)
+        results = [result for result, _ in batch]
+        self.assertEqual([result["status"] for result in results], [201, 400, 201, 201])
+        self.assertIn("yes", results[1]["error"])
+        self.assertNotIn("error", results[2])
+        self.assertTrue(all("id" in results[index] for index in (0, 2, 3)))
+        self.assertEqual(len(Customer.all()), 3)
+
+    def test_bulk_create_too_many(self):
+        """ Stop reading a bulk create after the most Customers it may have """
+        max_items = app.config["BULK_MAX_ITEMS"]
+        app.config["BULK_MAX_ITEMS"] = 2
+        self.addCleanup(app.config.__setitem__, "BULK_MAX_ITEMS", max_items)
+        customers = [CustomerFactory().serialize() for _ in range(5)]
+        resp = self.app.post(
+            "/customers/bulk", json=customers, content_type="application/json",
+            headers=self.headers
+        )
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        data = resp.get_json()
+        self.assertEqual(data["created"], 2)
+        self.assertEqual([result["status"] for result in data["results"]], [201, 201, 413])
+
+    def test_bulk_create_not_a_list(self):
+        """ Reject a bulk create that is not a JSON array """
+        resp = self.app.post(
+            "/customers/bulk", json={"first_name": "x"}, content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_customers(self):
+        """ Export every Customer as NDJSON """
+        customers = self._create_customers(5)
+        resp = self.app.get("/customers/export")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        lines = resp.get_data(as_text=True).splitlines()
+        data = [json.loads(line) for line in lines]
+        self.assertEqual([int(customer["id"]) for customer in data],
+                         sorted(int(customer.id) for customer in customers))
+        test_active = customers[0].active
+        resp = self.app.get("/customers/export", query_string="active={}".format(test_active))
+        for line in resp.get_data(as_text=True).splitlines():
+            self.assertEqual(json.loads(line)["active"], bool(test_active))
+
+    def test_batch_get_customers(self):
+        """ Get many Customers by id at once """
+        customers = []
+        for i in range(3):
+            customer = Customer(first_name="First{}".format(i), last_name="Last",
+                                email="a@b.com", address="1 Main St", active=True)
+            customer.create()
+            customers.append(customer)
+        Customer.find(customers[0].id)  # one of them is answered from the cache
+        ids = [customers[2].id, customers[0].id, 999, customers[1].id]
+        resp = self.app.post("/customers:batchGet", json={"ids": ids})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(list(data["customers"]), [str(i) for i in ids])
+        self.assertIsNone(data["customers"]["999"])
+        self.assertEqual(data["not_found"], ["999"])
+        self.assertEqual(data["customers"][str(customers[1].id)],
+                         marshal(customers[1].serialize(), customer_model))
+
+    def test_batch_get_bad_request(self):
+        """ Reject a batch get without a list of integer ids """
+        resp = self.app.post("/customers:batchGet", json={"ids": "1,2"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        for bad_id in ("x", 1.5, 2.0, True, None, "-1", " 1"):
+            resp = self.app.post("/customers:batchGet", json={"ids": [1, bad_id]})
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, bad_id)
+        resp = self.app.post("/customers:batchGet", json={"ids": [1, "2"]})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(list(resp.get_json()["customers"]), ["1", "2"])
+        max_ids = app.config["BATCH_GET_MAX_IDS"]
+        resp = self.app.post("/customers:batchGet", json={"ids": list(range(max_ids + 1))})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_customer_changes(self):
+        """ Pull the changes to Customers since a cursor """
+        settle = app.config["CHANGES_SETTLE_SECONDS"]
+        app.config["CHANGES_SETTLE_SECONDS"] = 0
+        self.addCleanup(app.config.__setitem__, "CHANGES_SETTLE_SECONDS", settle)
+        for name in ("John", "Jane", "Jim"):
+            resp = self.app.post("/customers", json={"first_name": name, "last_name": "Doe",
+                                                     "email": "a@b.com", "address": "1 Main St",
+                                                     "active": True})
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        ids = [customer["id"] for customer in self.app.get("/customers").get_json()]
+        resp = self.app.get("/customers/changes", query_string="limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([change["id"] for change in resp.get_json()], ids[:2])
+        self.assertIn('rel="next"', resp.headers["Link"])
+        cursor = resp.headers["X-Next-Cursor"]
+        self.app.delete("/customers/{}".format(ids[0]))
+        resp = self.app.get("/customers/changes", query_string={"since": cursor})
+        changes = resp.get_json()
+        self.assertEqual([(c["id"], c["op"]) for c in changes],
+                         [(ids[2], "create"), (ids[0], "delete")])
+        self.assertEqual(changes[0]["customer"]["first_name"], "Jim")
+        self.assertIsNone(changes[1]["customer"])
+        self.assertNotIn("Link", resp.headers)
+        cursor = resp.headers["X-Next-Cursor"]
+        resp = self.app.get("/customers/changes", query_string={"since": cursor})
+        self.assertEqual(resp.get_json(), [])
+        self.assertEqual(resp.headers["X-Next-Cursor"], cursor)
+
+    def test_customer_changes_bad_cursor(self):
+        """ Reject a cursor that is not an integer """
+        resp = self.app.get("/customers/changes", query_string="since=abc")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_customer_event_stream(self):
+        """ Stream the writes to Customers as Server-Sent Events """
+        resp = self.app.get("/customers/stream", buffered=False)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "text/event-stream")
+        events = iter(resp.response)
+        self.assertEqual(next(events), b": connected\n\n")
+        customer = Customer(first_name="John", last_name="Smith", email="a@b.com",
+                            address="1 Main St", active=True)
+        customer.create()
+        expected = marshal(customer.serialize(), customer_model)
+        self.app.put("/customers/{}/suspend".format(expected["id"]), headers=self.headers)
+        self.app.delete("/customers/{}".format(expected["id"]), headers=self.headers)
+        received = []
+        for _ in range(3):
+            name, data = next(events).decode().rstrip("\n").split("\n")
+            received.append((name, json.loads(data[len("data: "):])))
+        self.assertEqual([name for name, _ in received],
+                         ["event: create", "event: suspend", "event: delete"])
+        self.assertEqual(received[0][1]["customer"], expected)
+        self.assertFalse(received[1][1]["customer"]["active"])
+        self.assertEqual(received[2][1], {"op": "delete", "id": expected["id"], "customer": None})
+        resp.close()
+        self.assertEqual(len(Customer.events), 0)
+
+    def test_event_stream_limit(self):
+        """ Refuse more open streams than EVENTS_MAX_STREAMS """
+        with mock.patch.object(Customer.events, "max_subscribers", 1):
+            first = self.app.get("/customers/stream", buffered=False)
+            self.assertEqual(first.status_code, status.HTTP_200_OK)
+            resp = self.app.get("/customers/stream", buffered=False)
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertIn("Retry-After", resp.headers)
+            first.close()
+            resp = self.app.get("/customers/stream", buffered=False)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            resp.close()
+
+    def test_search_customers(self):
+        """ Search Customers by part of a name, best matches first """
+        for first_name, last_name in (("Anna", "Rossmith"), ("Mike", "Smith"), ("Smithers", "Jones"),
+                                      ("Jane", "Doe")):
+            Customer(first_name=first_name, last_name=last_name, email="a@b.com",
+                     address="1 Main St", active=True).create()
+        resp = self.app.get("/customers/search", query_string="q=SMITH")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        names = [customer["first_name"] for customer in resp.get_json()]
+        self.assertEqual(names, ["Mike", "Smithers", "Anna"])
+        # short terms only match by prefix
+        resp = self.app.get("/customers/search", query_string="q=sm")
+        self.assertEqual([c["first_name"] for c in resp.get_json()], ["Mike", "Smithers"])
+
+    def test_search_customers_paged(self):
+        """ Page through search results with the cursor """
+        for i in range(5):
+            Customer(first_name="Al{}".format(i), last_name="Smith" if i % 2 else "Smithson",
+                     email="a@b.com", address="1 Main St", active=True).create()
+        resp = self.app.get("/customers/search", query_string="q=smith&limit=2&fields=id")
+        seen = [customer["id"] for customer in resp.get_json()]
+        self.assertEqual(list(resp.get_json()[0]), ["id"])
+        while "X-Next-Cursor" in resp.headers:
+            resp = self.app.get("/customers/search", query_string={
+                "q": "smith", "limit": 2, "after": resp.headers["X-Next-Cursor"]
+            })
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            seen.extend(customer["id"] for customer in resp.get_json())
+        self.assertEqual(seen, ["2", "4", "1", "3", "5"])
+
+    def test_search_customers_bad_request(self):
+        """ Reject an empty search or a bad cursor """
+        resp = self.app.get("/customers/search")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/customers/search", query_string="q=smith&after=abc")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_search_escapes_wildcards(self):
+        """ Wildcards in the search term are matched literally """
+        Customer(first_name="John", last_name="Smith", email="a@b.com",
+                 address="1 Main St", active=True).create()
+        resp = self.app.get("/customers/search", query_string="q=%25")
+        self.assertEqual(resp.get_json(), [])
+
     def test_update_customer(self):
         """ Update an existing Customer """
         # create a customer to update
@@ -226,6 +610,47 @@ class TestCustomers(unittest.TestCase):
         updated_customer = resp.get_json()
         self.assertEqual(updated_customer["address"], "2014 Forest Hills Drive")
 
+    def test_update_customer_without_name(self):
+        """ Reject an update that removes the name of a Customer """
+        test_customer = self._create_customers(1)[0]
+        url = "/customers/{}".format(test_customer.id)
+        data = self.app.get(url).get_json()
+        data["first_name"] = data["last_name"] = ""
+        resp = self.app.put(url, json=data, headers=self.headers)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get(url)
+        self.assertEqual(resp.get_json()["last_name"], test_customer.last_name)
+
+    def test_update_customer_if_match(self):
+        """ Update a Customer only at the version that was read """
+        test_customer = self._create_customers(1)[0]
+        url = "/customers/{}".format(test_customer.id)
+        resp = self.app.get(url)
+        etag = resp.headers["ETag"]
+        data = resp.get_json()
+        data["address"] = "2014 Forest Hills Drive"
+        resp = self.app.put(url, json=data, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        # the same ETag is now stale
+        data["address"] = "1 Lost Update Lane"
+        resp = self.app.put(url, json=data, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.put(url, json=data, headers={"If-Match": '"not-a-version"'})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.put(url + "/suspend", headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.delete(url, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.get(url)
+        self.assertEqual(resp.get_json()["address"], "2014 Forest Hills Drive")
+
+    def test_update_customer_not_found(self):
+        """ Update a Customer that does not exist """
+        data = CustomerFactory().serialize()
+        resp = self.app.put("/customers/0", json=data, headers=self.headers)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_delete_a_customer(self):
         """ Delete a Customer """
         test_customer = self._create_customers(1)[0]
@@ -365,6 +790,142 @@ class TestCustomers(unittest.TestCase):
         for customer in active_customers:
             self.assertEqual(customer["active"], test_active)
 
+    def test_query_customer_list_by_several_filters(self):
+        """ Query Customers by last name and active together """
+        customers = self._create_customers(10)
+        test_last_name = customers[0].last_name
+        resp = self.app.get(
+            "/customers", query_string="last_name={}&active=false".format(test_last_name)
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        expected = [
+            customer for customer in customers
+            if customer.last_name == test_last_name and not customer.active
+        ]
+        self.assertEqual(len(data), len(expected))
+        for customer in data:
+            self.assertEqual(customer["last_name"], test_last_name)
+            self.assertEqual(customer["active"], False)
+
+    def test_query_customer_list_by_prefix_and_list(self):
+        """ Query Customers by a name prefix and a list of names """
+        customers = self._create_customers(10)
+        names = sorted({customer.last_name for customer in customers})
+        resp = self.app.get(
+            "/customers", query_string=[("last_name", name) for name in names[:2]]
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        for customer in resp.get_json():
+            self.assertIn(customer["last_name"], names[:2])
+        prefix = names[0][:2]
+        resp = self.app.get("/customers", query_string="last_name={}*".format(prefix))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertTrue(data)
+        for customer in data:
+            self.assertTrue(customer["last_name"].startswith(prefix))
+
+    def test_query_customer_list_bad_active(self):
+        """ Reject an active filter that is not a boolean """
+        resp = self.app.get("/customers", query_string="active=maybe")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_cache_stats(self):
+        """ Get the counters of the Customer cache """
+        test_customer = self._create_customers(1)[0]
+        self.app.get("/customers/{}".format(test_customer.id))
+        self.app.get("/customers/{}".format(test_customer.id))
+        resp = self.app.get("/cache/stats")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        for name in ("hits", "misses", "evictions", "size"):
+            self.assertIn(name, data)
+        self.assertGreaterEqual(data["hits"], 1)
+
+    def test_metrics(self):
+        """ Requests are counted in the Prometheus metrics by route """
+        resp = self.app.get("/customers/0")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.get("/metrics")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.content_type.startswith("text/plain"))
+        body = resp.get_data(as_text=True)
+        self.assertIn(
+            'customers_http_requests_total{method="GET",route="/customers/<customer_id>",status="404"}',
+            body,
+        )
+        self.assertIn("customers_db_statements_total", body)
+        self.assertIn('customers_cache_events_total{event="miss"}', body)
+
+    def test_server_timing(self):
+        """ Responses say how many SQL statements they ran """
+        self._create_customers(3)
+        resp = self.app.get("/customers")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        timing = resp.headers.get("Server-Timing")
+        self.assertRegex(timing, r'^db;dur=[0-9.]+;desc="[1-9][0-9]* statements?", db-slowest;dur=')
+
+    def test_group_commit_stats(self):
+        """ Group commit statistics say when it is off """
+        resp = self.app.get("/group-commit/stats")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"enabled": False})
+
+    def test_rate_limit(self):
+        """ Requests over the rate limit of their API key get 429 """
+        limiter = limits.RateLimiter(rate=0.5, burst=2)
+        with mock.patch("service.service.rate_limiter", limiter):
+            for _ in range(2):
+                resp = self.app.get("/customers", headers=self.headers)
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            resp = self.app.get("/customers", headers=self.headers)
+            self.assertEqual(resp.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertEqual(resp.headers["Retry-After"], "2")
+            # other clients and the statistics are not limited
+            resp = self.app.get("/customers", headers={"X-Api-Key": "other"})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            resp = self.app.get("/cache/stats", headers=self.headers)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_rate_limit_made_up_keys(self):
+        """ A new unknown API key per request does not get a new bucket """
+        limiter = limits.RateLimiter(rate=0.5, burst=2)
+        with mock.patch("service.service.rate_limiter", limiter):
+            codes = [
+                self.app.get("/customers", headers={"X-Api-Key": "key-{}".format(n)}).status_code
+                for n in range(3)
+            ]
+            self.assertEqual(codes, [200, 200, 429])
+            # the configured key still has its own bucket
+            resp = self.app.get("/customers", headers=self.headers)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_streams_are_not_in_flight(self):
+        """ Long lived streams are not counted against the in flight limit """
+        shedder = limits.LoadShedder(max_in_flight=1)
+        with mock.patch("service.service.load_shedder", shedder):
+            resp = self.app.get("/customers/export")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(shedder.in_flight, 0)
+            shedder.enter()  # a request that is still running
+            resp = self.app.get("/customers/export")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(shedder.shed, 0)
+
+    def test_load_shedding(self):
+        """ Requests are shed with 503 while too many are in flight """
+        shedder = limits.LoadShedder(max_in_flight=1)
+        with mock.patch("service.service.load_shedder", shedder):
+            resp = self.app.get("/customers")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(shedder.in_flight, 0)
+            shedder.enter()  # a request that is still running
+            resp = self.app.get("/customers")
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertEqual(resp.headers["Retry-After"], "1")
+            self.assertEqual(shedder.shed, 1)
+
     def test_method_not_supported(self):
         resp = self.app.put('/customers')
         self.assertEqual(resp.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)